@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+"""
+Moves the months everyone's paid for off of the RentBot Google Sheet and onto
+yearly archive worksheets ("RentBot Archive <year>"), so the live sheet stays
+small. Requires the v2 layout (see migrateSheet.py).
+"""
+
+import sys
+
+from .sheet import UnwrittenUpdatesError, openSheetForMaintenance
+
+
+def main():
+    try:
+        googleSheet = openSheetForMaintenance()
+    except UnwrittenUpdatesError as e:
+        print(e)
+        sys.exit(1)
+    archivedMonths = googleSheet.archivePaidMonths()
+    if not archivedMonths:
+        print("No fully paid months to archive")
+
+
+if __name__ == "__main__":
+    main()
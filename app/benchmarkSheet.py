@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Measures how many Sheets API calls, how many bytes, and how much time each
+GoogleSheet operation takes, using in-memory sheets (see fakeSheet.py) holding
+a few different amounts of history.
+"""
+
+import argparse
+import time
+import typing
+from datetime import datetime
+
+from .fakeSheet import FakeConnection, FakeSpreadsheet
+from .sheet import GoogleSheet
+
+TENANT_NAMES = [
+    "Jake Deerin",
+    "Mac Mathis",
+    "Taylor Daniel",
+    "Andrew Dallas",
+    "Josh Minter",
+    "Manny Jonson",
+]
+LAST_YEAR = 2024
+# How many of the most recent months are left unpaid
+UNPAID_MONTHS = 2
+
+# (name, setup, run), where setup (if any) runs before the calls start being
+# counted; each gets a fresh copy of the sheet and the most recent month
+BENCHMARKS: typing.List[
+    typing.Tuple[
+        str,
+        typing.Optional[typing.Callable[[GoogleSheet, datetime], None]],
+        typing.Callable[[GoogleSheet, datetime], typing.Any],
+    ]
+] = [
+    ("getSnapshot", None, lambda sheet, month: sheet.getSnapshot()),
+    ("getAmountsOwed (cold)", None, lambda sheet, month: sheet.getAmountsOwed()),
+    (
+        "getAmountsOwed (cached)",
+        lambda sheet, month: sheet.getAmountsOwed(),
+        lambda sheet, month: sheet.getAmountsOwed(),
+    ),
+    ("addTenant", None, lambda sheet, month: sheet.addTenant("New Tenant", month)),
+    (
+        "removeTenant",
+        None,
+        lambda sheet, month: sheet.removeTenant(TENANT_NAMES[-1], month),
+    ),
+    (
+        "markRentAsPaid",
+        None,
+        lambda sheet, month: sheet.markRentAsPaid(TENANT_NAMES[0], month),
+    ),
+    ("setTotalRent", None, lambda sheet, month: sheet.setTotalRent(1697.0, month)),
+    (
+        "setTotalUtility",
+        None,
+        lambda sheet, month: sheet.setTotalUtility(413.18, month),
+    ),
+    (
+        "setWeeksStayed",
+        None,
+        lambda sheet, month: sheet.setWeeksStayed(2.0, TENANT_NAMES[0], month),
+    ),
+    (
+        "createNewMonth",
+        None,
+        lambda sheet, month: sheet.createNewMonth(datetime(LAST_YEAR + 1, 1, 1)),
+    ),
+    ("archivePaidMonths", None, lambda sheet, month: sheet.archivePaidMonths()),
+]
+
+
+def makeSheetWithHistory(years: int) -> FakeSpreadsheet:
+    """
+    Returns an in-memory sheet with the given number of years of months (ending
+    in December LAST_YEAR), all paid except the last few
+    """
+    connection = FakeConnection()
+    googleSheet = GoogleSheet(connection=connection)
+    snapshot = googleSheet.getSnapshot()
+    for name in TENANT_NAMES:
+        snapshot.addTenant(name, datetime(LAST_YEAR - years + 1, 1, 1))
+
+    months = [
+        datetime(year, month, 1)
+        for year in range(LAST_YEAR - years + 1, LAST_YEAR + 1)
+        for month in range(1, 13)
+    ]
+    for i, month in enumerate(months):
+        snapshot.createNewMonth(month)
+        snapshot.setTotalRent(1697.0, month)
+        snapshot.setTotalUtility(413.18, month)
+        if i < len(months) - UNPAID_MONTHS:
+            for name in TENANT_NAMES:
+                snapshot.markRentAsPaid(name, month)
+    googleSheet.commitSnapshot(snapshot)
+    return connection.spreadsheet
+
+
+def runBenchmarks(
+    years: int, latencySeconds: float
+) -> typing.List[typing.Tuple[str, int, int, float]]:
+    """
+    Returns (name, API calls, bytes transferred, seconds) for each benchmark on
+    a sheet with the given years of history
+    """
+    seedSpreadsheet = makeSheetWithHistory(years)
+    lastMonth = datetime(LAST_YEAR, 12, 1)
+    results = []
+    for name, setup, run in BENCHMARKS:
+        spreadsheet = seedSpreadsheet.copy()
+        googleSheet = GoogleSheet(connection=FakeConnection(spreadsheet))
+        if setup:
+            setup(googleSheet, lastMonth)
+        spreadsheet.latencySeconds = latencySeconds
+        spreadsheet.resetCalls()
+
+        start = time.perf_counter()
+        run(googleSheet, lastMonth)
+        seconds = time.perf_counter() - start
+        results.append(
+            (
+                name,
+                len(spreadsheet.calls),
+                spreadsheet.getBytesTransferred(),
+                seconds,
+            )
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--years",
+        type=int,
+        nargs="+",
+        default=[1, 5, 20],
+        help="years of history to put in the benchmark sheets",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0.0,
+        help="simulated latency for each API call",
+    )
+    args = parser.parse_args()
+
+    print(f"{'operation':<25} {'years':>5} {'calls':>5} {'bytes':>10} {'ms':>9}")
+    for years in args.years:
+        for name, calls, numBytes, seconds in runBenchmarks(
+            years, args.latency_ms / 1000
+        ):
+            print(
+                f"{name:<25} {years:>5} {calls:>5} {numBytes:>10} {seconds * 1000:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Measures how long the webhook takes to ignore a GroupMe message that isn't a
+RentBot command (i.e. nearly all of them), comparing the raw-body pre-filter
+against parsing the message first, both on their own and through the whole
+FastAPI app.
+
+    python -m app.benchmarkWebhook --number 20000
+"""
+
+import argparse
+import json
+import os
+import timeit
+import typing
+
+from .loadTest import SCRAPER_CREDENTIALS
+
+# What GroupMe sends for a typical chat message
+CHATTER_MESSAGE = {
+    "attachments": [
+        {"type": "image", "url": "https://i.groupme.com/1024x768.jpeg.0123456789"}
+    ],
+    "avatar_url": "https://i.groupme.com/123456789",
+    "created_at": 1724371200,
+    "group_id": "52458108",
+    "id": "172437120012345678",
+    "name": "Mac Mathis",
+    "sender_id": "12345678",
+    "sender_type": "user",
+    "source_guid": "6f1c0bd0-4b43-013d-5a2e-2a5bd54e3ab1",
+    "system": False,
+    "text": "anyone want tacos tonight? \U0001f32e",
+    "user_id": "12345678",
+}
+
+
+def runBenchmarks(number: int) -> typing.List[typing.Tuple[str, float]]:
+    """Returns (name, seconds per message) for each way of ignoring chatter"""
+    from fastapi.testclient import TestClient
+
+    from . import main as rentbot
+
+    body = json.dumps(CHATTER_MESSAGE).encode()
+    # Mentions "/rent", so it gets past the pre-filter and has to be parsed
+    mentionBody = json.dumps(
+        dict(CHATTER_MESSAGE, text="tacos after we pay /rent?")
+    ).encode()
+
+    def parseThenMatch(messageBody: bytes):
+        msg = rentbot.GroupMeMessage.model_validate_json(messageBody)
+        rentbot.BOT_TRIGGER_REGEX.search(msg.text)
+
+    client = TestClient(rentbot.app)
+    benchmarks: typing.List[typing.Tuple[str, typing.Callable[[], typing.Any]]] = [
+        ("pre-filter", lambda: rentbot.mightBeCommand(body)),
+        ("parse + match", lambda: parseThenMatch(body)),
+        (
+            "parse + match (old)",
+            lambda: rentbot.BotCommand().isCommand(
+                rentbot.GroupMeMessage(**json.loads(body)).text
+            ),
+        ),
+        ("endpoint: chatter", lambda: client.post("/", content=body)),
+        ("endpoint: mentions /rent", lambda: client.post("/", content=mentionBody)),
+    ]
+    results = []
+    for name, run in benchmarks:
+        # The endpoint goes through the whole HTTP stack, so it's a lot slower
+        runNumber = number // 100 if name.startswith("endpoint") else number
+        run()
+        seconds = timeit.timeit(run, number=runNumber)
+        results.append((name, seconds / runNumber))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--number",
+        type=int,
+        default=100000,
+        help="messages to time for each benchmark (1%% of this for the endpoint)",
+    )
+    args = parser.parse_args()
+
+    # These have to be set before the server is imported
+    os.environ["RENTBOT_GSHEETS_BACKEND"] = "memory"
+    os.environ.setdefault("RENTBOT_GSHEETS_URL", "memory://rentbot")
+    os.environ.setdefault("RENTBOT_START_TIME", "2021-08-01")
+    os.environ.setdefault("GROUPME_BOT_ID", "benchmark-bot")
+    for name in SCRAPER_CREDENTIALS:
+        os.environ.setdefault(name, "")
+
+    print(f"{'ignoring chatter with':<25} {'us/message':>10} {'messages/s':>12}")
+    for name, seconds in runBenchmarks(args.number):
+        print(f"{name:<25} {seconds * 1e6:>10.2f} {1 / seconds:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""
+Waits for each month's bills to actually be posted before setting the month's
+rent and utilities, instead of scraping once when the reminder goes out (and
+quietly getting the wrong totals if a bill isn't up yet).
+
+For each provider, the scheduler learns when in the month its bill usually
+posts (from the dates of the charges it scrapes), and polls it
+- right away when the month starts (i.e. on /reminder)
+- then, until its bill shows up, no earlier than when it's expected, backing
+  off after each miss or failed scrape (from RENTBOT_BILL_POLL_MIN_BACKOFF_SECONDS,
+  doubling up to a day)
+- only during quiet hours (RENTBOT_SCRAPE_QUIET_HOURS, e.g. "1-6" for 1am to
+  6am server time), a few minutes apart for each provider so the portals
+  aren't all scraped at once
+
+Once every provider's bill is in, the month's charges are worked out and
+passed to onBillsReady (which sets them in the sheet); if they aren't all in
+by RENTBOT_BILL_GIVE_UP_DAY, onGiveUp gets the providers still missing
+instead. The schedule is saved to RENTBOT_BILL_SCHEDULE_PATH after every poll,
+so a restarted server picks up where it left off (and hitting /bills/poll,
+e.g. hourly from Cloud Scheduler, keeps it going even if the server was scaled
+down in between). If setting the charges fails, the error is kept in the
+status and the next /bills/poll tries again.
+"""
+
+import json
+import os
+import statistics
+import threading
+import traceback
+import typing
+from dataclasses import asdict, dataclass
+from datetime import date, datetime
+from datetime import time as dayTime
+from datetime import timedelta
+
+from . import metrics, tracing
+from .getRents import (
+    PROVIDERS,
+    MonthlyCharges,
+    RecentCharges,
+    get_monthly_charges,
+    recent_charges_from_records,
+    recent_charges_to_records,
+)
+
+BILL_SCHEDULE_PATH = os.environ.get(
+    "RENTBOT_BILL_SCHEDULE_PATH", "rentbot-bill-schedule.json"
+)
+MIN_BACKOFF_SECONDS = float(
+    os.environ.get("RENTBOT_BILL_POLL_MIN_BACKOFF_SECONDS", "3600")
+)
+MAX_BACKOFF_SECONDS = 24 * 60 * 60
+# Give up on the month's bills after this day of the month (before the bot's
+# commands move on to the new month; see getDefaultTimeForCommand)
+GIVE_UP_DAY = int(os.environ.get("RENTBOT_BILL_GIVE_UP_DAY", "13"))
+# How much earlier than usual a bill can post and still count for the month
+# (less than half a month, so last month's bill never does)
+BILL_WINDOW_DAYS = 7
+# Time between each provider's polls
+STAGGER_SECONDS = 10 * 60
+# Longest the background thread sleeps before checking the schedule again
+MAX_SLEEP_SECONDS = 15 * 60
+
+
+def parseQuietHours(text: str) -> typing.Optional[typing.Tuple[int, int]]:
+    """Parses e.g. "1-6" (or "22-5") to (start hour, end hour)"""
+    if not text:
+        return None
+    start, end = text.split("-")
+    return int(start), int(end)
+
+
+QUIET_HOURS = parseQuietHours(os.environ.get("RENTBOT_SCRAPE_QUIET_HOURS", "1-6"))
+
+
+def getNextQuietTime(
+    when: datetime, quietHours: typing.Optional[typing.Tuple[int, int]]
+) -> datetime:
+    """Returns the given time, or the start of the next quiet hours after it"""
+    if quietHours is None:
+        return when
+    start, end = quietHours
+    if start <= end:
+        isQuiet = start <= when.hour < end
+    else:
+        isQuiet = when.hour >= start or when.hour < end
+    if isQuiet:
+        return when
+    quietStart = when.replace(hour=start, minute=0, second=0, microsecond=0)
+    return quietStart if quietStart > when else quietStart + timedelta(days=1)
+
+
+def getPostingOffset(chargeDate: date) -> int:
+    """
+    Returns how many days after the nearest 1st of a month the charge was
+    posted (negative if it was before)
+    """
+    if chargeDate.day <= 15:
+        return chargeDate.day - 1
+    nextMonth = (chargeDate.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return (chargeDate - nextMonth).days
+
+
+def learnPostingOffset(charges: RecentCharges) -> typing.Optional[int]:
+    """
+    Returns the typical posting offset (see getPostingOffset) of the given
+    charges, or None if there aren't any
+    """
+    offsets = [
+        getPostingOffset(chargeDate)
+        for chargeDate in charges.loc[charges.charge_cents > 0].date
+    ]
+    return statistics.median_low(offsets) if offsets else None
+
+
+@dataclass
+class ProviderSchedule:
+    nextPollAt: datetime
+    # Polls in a row that didn't find the bill
+    misses: int = 0
+    isPosted: bool = False
+    # The most recently scraped charges (as JSON-able records)
+    records: typing.Optional[typing.List[typing.Dict[str, typing.Any]]] = None
+
+    def toDict(self) -> dict:
+        return dict(asdict(self), nextPollAt=self.nextPollAt.isoformat())
+
+    @classmethod
+    def fromDict(cls, data: dict) -> "ProviderSchedule":
+        return cls(**dict(data, nextPollAt=datetime.fromisoformat(data["nextPollAt"])))
+
+
+class BillScheduler:
+    """
+    Polls each provider until its bill for the month is posted, then passes
+    the month's charges to onBillsReady
+    """
+
+    def __init__(
+        self,
+        scrape: typing.Callable[[str], RecentCharges],
+        onBillsReady: typing.Callable[[MonthlyCharges], None],
+        onGiveUp: typing.Callable[[typing.List[str]], None] = lambda missing: None,
+        statePath: str = BILL_SCHEDULE_PATH,
+        quietHours: typing.Optional[typing.Tuple[int, int]] = QUIET_HOURS,
+        now: typing.Callable[[], datetime] = datetime.now,
+    ):
+        self.scrape = scrape
+        self.onBillsReady = onBillsReady
+        self.onGiveUp = onGiveUp
+        self.statePath = statePath
+        self.quietHours = quietHours
+        self.now = now
+        # Guards the schedule; never held while scraping or setting the
+        # charges, so e.g. getStatus doesn't wait minutes on a slow portal
+        self._lock = threading.RLock()
+        # Only 1 tick at a time
+        self._pollLock = threading.Lock()
+        self._wakeUp = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+        # (the 1st of the month whose bills are being waited for)
+        self.month: typing.Optional[date] = None
+        self.isDone = True
+        self.schedules: typing.Dict[str, ProviderSchedule] = {}
+        # Provider -> typical posting offset, learned from its past charges
+        self.postingOffsets: typing.Dict[str, int] = {}
+        # Why the last attempt at the month failed (if it did)
+        self.lastError: typing.Optional[str] = None
+        self._load()
+
+    def _load(self):
+        if not self.statePath:
+            return
+        try:
+            with open(self.statePath) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable bill schedule '{self.statePath}' ({e!r})")
+            return
+        self.month = date.fromisoformat(data["month"])
+        self.isDone = data["isDone"]
+        self.schedules = {
+            provider: ProviderSchedule.fromDict(schedule)
+            for provider, schedule in data["schedules"].items()
+        }
+        self.postingOffsets = data["postingOffsets"]
+        self.lastError = data.get("lastError")
+
+    def _save(self):
+        if not self.statePath:
+            return
+        tempPath = f"{self.statePath}.tmp"
+        with open(tempPath, "w") as f:
+            json.dump(self.getStatus(), f)
+        os.replace(tempPath, self.statePath)
+
+    def getStatus(self) -> dict:
+        with self._lock:
+            return {
+                "month": self.month.isoformat() if self.month else None,
+                "isDone": self.isDone,
+                "schedules": {
+                    provider: schedule.toDict()
+                    for provider, schedule in self.schedules.items()
+                },
+                "postingOffsets": self.postingOffsets,
+                "lastError": self.lastError,
+            }
+
+    def isPending(self) -> bool:
+        return not self.isDone
+
+    def startMonth(self, month: date):
+        """
+        Starts waiting for the given month's bills (unless it already is, or
+        already got them), with every provider due to be polled right away
+        """
+        month = month.replace(day=1)
+        with self._lock:
+            if self.month != month:
+                self.month = month
+                self.isDone = False
+                self.lastError = None
+                self.schedules = {
+                    provider: ProviderSchedule(nextPollAt=self.now())
+                    for provider in PROVIDERS
+                }
+                self._save()
+
+    def getExpectedDate(self, provider: str) -> date:
+        """When the provider's bill for the month should be posted"""
+        return self.month + timedelta(days=self.postingOffsets.get(provider, 0))
+
+    def _isBillPosted(self, provider: str, charges: RecentCharges) -> bool:
+        earliestDate = self.getExpectedDate(provider) - timedelta(days=BILL_WINDOW_DAYS)
+        return bool(((charges.date >= earliestDate) & (charges.charge_cents > 0)).any())
+
+    def _getNextPollTime(self, index: int, misses: int) -> datetime:
+        backoffSeconds = min(
+            MIN_BACKOFF_SECONDS * 2 ** (misses - 1), MAX_BACKOFF_SECONDS
+        )
+        nextPollAt = self.now() + timedelta(seconds=backoffSeconds)
+        return getNextQuietTime(nextPollAt, self.quietHours) + timedelta(
+            seconds=index * STAGGER_SECONDS
+        )
+
+    def _poll(self, index: int, provider: str, month: date):
+        """Scrapes the provider (without holding the lock) and records it"""
+        with tracing.startTrace("job.pollBill", provider=provider) as span:
+            try:
+                charges = self.scrape(provider)
+            except Exception:
+                print(traceback.format_exc())
+                charges = None
+            with self._lock:
+                if self.month != month:
+                    # (a new month started while scraping)
+                    return
+                outcome = self._recordPoll(index, provider, charges)
+                self._save()
+            span.setAttribute("outcome", outcome)
+        metrics.BILL_POLLS.inc(provider=provider, outcome=outcome)
+
+    def _recordPoll(
+        self, index: int, provider: str, charges: typing.Optional[RecentCharges]
+    ) -> str:
+        """
+        Updates the provider's schedule with what was scraped (None if the
+        scrape failed), returning the poll's outcome
+        """
+        schedule = self.schedules[provider]
+        if charges is not None:
+            offset = learnPostingOffset(charges)
+            if offset is not None:
+                self.postingOffsets[provider] = offset
+            schedule.records = recent_charges_to_records(charges)
+            schedule.isPosted = self._isBillPosted(provider, charges)
+        if schedule.isPosted:
+            print(f"The {provider} bill for {self.month:%B} is in")
+            return "posted"
+        schedule.misses += 1
+        expectedAt = datetime.combine(self.getExpectedDate(provider), dayTime())
+        schedule.nextPollAt = max(
+            self._getNextPollTime(index, schedule.misses),
+            getNextQuietTime(expectedAt, self.quietHours),
+        )
+        print(
+            f"No {provider} bill for {self.month:%B} yet; "
+            f"checking again at {schedule.nextPollAt.isoformat()}"
+        )
+        return "error" if charges is None else "notPosted"
+
+    def _getMonthlyCharges(self) -> MonthlyCharges:
+        charges = {
+            provider: recent_charges_from_records(schedule.records)
+            for provider, schedule in self.schedules.items()
+        }
+        return get_monthly_charges(
+            charges["apartment"],
+            charges["electricity"],
+            charges["internet"],
+            self.month,
+            electricity_window=self._getBillWindow("electricity"),
+            internet_window=self._getBillWindow("internet"),
+        )
+
+    def _getBillWindow(self, provider: str) -> typing.Tuple[date, date]:
+        """When the provider's bill for the month could've been posted"""
+        expectedDate = self.getExpectedDate(provider)
+        return (
+            expectedDate - timedelta(days=BILL_WINDOW_DAYS),
+            expectedDate + timedelta(days=BILL_WINDOW_DAYS),
+        )
+
+    def tick(self) -> bool:
+        """
+        Polls the providers that are due, and sets the month's charges once
+        every bill is in; returns whether it's done with the month
+        """
+        with self._pollLock:
+            with self._lock:
+                if self.isDone:
+                    return True
+                month = self.month
+                duePolls = [
+                    (index, provider)
+                    for index, (provider, schedule) in enumerate(self.schedules.items())
+                    if not schedule.isPosted and schedule.nextPollAt <= self.now()
+                ]
+            for index, provider in duePolls:
+                self._poll(index, provider, month)
+
+            with self._lock:
+                if self.month != month:
+                    return False
+                missing = [
+                    provider
+                    for provider, schedule in self.schedules.items()
+                    if not schedule.isPosted
+                ]
+                if missing and self.now().date() <= month.replace(day=GIVE_UP_DAY):
+                    return False
+                charges = None if missing else self._getMonthlyCharges()
+            if missing:
+                print(f"Giving up on the {', '.join(missing)} bills for {month:%B}")
+                self.onGiveUp(missing)
+            else:
+                self.onBillsReady(charges)
+            with self._lock:
+                if self.month == month:
+                    # (only once the charges are set, so a failure gets retried)
+                    self.isDone = True
+                    self.lastError = None
+                    self._save()
+            return True
+
+    def _getSecondsUntilNextPoll(self) -> float:
+        with self._lock:
+            nextPollTimes = [
+                schedule.nextPollAt
+                for schedule in self.schedules.values()
+                if not schedule.isPosted
+            ]
+        if not nextPollTimes:
+            return 0
+        seconds = (min(nextPollTimes) - self.now()).total_seconds()
+        return min(max(seconds, 0), MAX_SLEEP_SECONDS)
+
+    def _run(self):
+        try:
+            while not self.tick():
+                self._wakeUp.wait(self._getSecondsUntilNextPoll())
+                self._wakeUp.clear()
+        except Exception as e:
+            # (the month stays pending, so the next runInBackground retries)
+            print(traceback.format_exc())
+            with self._lock:
+                self.lastError = repr(e)
+                self._save()
+
+    def runInBackground(self):
+        """Polls in a background thread until done with the month"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._wakeUp.set()
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
@@ -0,0 +1,93 @@
+"""
+Helpers for collapsing bursts of identical work into one, e.g. when half the
+group types "/rent show" right after the reminder goes out.
+
+- SingleFlight: concurrent calls with the same key share 1 call's result
+instead of each making it themselves
+- Debouncer: drops repeats of the same thing (e.g. an identical bot reply)
+within a short window
+"""
+
+import threading
+import time
+import typing
+
+from . import metrics, tracing
+
+T = typing.TypeVar("T")
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: typing.Any = None
+        self.error: typing.Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Runs a function for each key at most once at a time; anyone calling it
+    with the same key while it's running waits for that call and gets its
+    result (or exception) too
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights: typing.Dict[typing.Hashable, _Flight] = {}
+
+    def do(self, key: typing.Hashable, func: typing.Callable[[], T]) -> T:
+        with self._lock:
+            flight = self._flights.get(key)
+            isLeader = flight is None
+            if isLeader:
+                flight = self._flights[key] = _Flight()
+
+        if not isLeader:
+            metrics.COALESCED_CALLS.inc(operation=self.name)
+            with tracing.span(f"{self.name}.coalesced"):
+                flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class Debouncer:
+    """
+    Says whether something should go ahead, or whether the same thing (by key)
+    already went ahead in the last windowSeconds
+    """
+
+    def __init__(
+        self,
+        windowSeconds: float,
+        clock: typing.Callable[[], float] = time.monotonic,
+    ):
+        self.windowSeconds = windowSeconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._lastAllowed: typing.Dict[typing.Hashable, float] = {}
+
+    def shouldProceed(self, key: typing.Hashable) -> bool:
+        now = self._clock()
+        with self._lock:
+            # Forget anything old enough that it can't match anymore
+            for oldKey in [
+                k for k, t in self._lastAllowed.items() if now - t >= self.windowSeconds
+            ]:
+                del self._lastAllowed[oldKey]
+            if key in self._lastAllowed:
+                return False
+            self._lastAllowed[key] = now
+            return True
@@ -0,0 +1,162 @@
+"""
+A tiny stand-in for a Redis server, with just the commands RedisSharedCache
+uses (GET, SET with EX, PUBLISH, SUBSCRIBE, UNSUBSCRIBE, SELECT, and PING), so
+the shared cache can be tested (and tried out with several local instances)
+without a real Redis. Everything lives in memory and is shared across
+databases.
+
+    server = FakeRedisServer()
+    server.start()
+    cache = RedisSharedCache(server.url)
+"""
+
+import socketserver
+import threading
+import time
+import typing
+
+from .sharedCache import SharedCacheError, _readReply
+
+
+def _encodeBulk(value: typing.Optional[bytes]) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    return f"${len(value)}\r\n".encode() + value + b"\r\n"
+
+
+class _FakeRedisHandler(socketserver.StreamRequestHandler):
+    server: "FakeRedisServer"
+
+    def handle(self):
+        while True:
+            try:
+                command = _readReply(self.rfile)
+            except (OSError, SharedCacheError):
+                return
+            if not isinstance(command, list) or not command:
+                self.wfile.write(b"-ERR expected a command\r\n")
+                continue
+            name, args = command[0].decode().upper(), command[1:]
+            with self.server.lock:
+                self.server.commands.append(name)
+            handler = getattr(self, f"_do{name.title()}", None)
+            if handler is None:
+                self.wfile.write(f"-ERR unknown command '{name}'\r\n".encode())
+                continue
+            handler(args)
+
+    def _doPing(self, args: typing.List[bytes]):
+        self.wfile.write(b"+PONG\r\n")
+
+    def _doSelect(self, args: typing.List[bytes]):
+        self.wfile.write(b"+OK\r\n")
+
+    def _doGet(self, args: typing.List[bytes]):
+        self.wfile.write(_encodeBulk(self.server.getValue(args[0])))
+
+    def _doSet(self, args: typing.List[bytes]):
+        ttlSeconds = None
+        if len(args) >= 4 and args[2].upper() == b"EX":
+            ttlSeconds = int(args[3])
+        self.server.setValue(args[0], args[1], ttlSeconds)
+        self.wfile.write(b"+OK\r\n")
+
+    def _doPublish(self, args: typing.List[bytes]):
+        numReceivers = self.server.publish(args[0], args[1])
+        self.wfile.write(f":{numReceivers}\r\n".encode())
+
+    def _doSubscribe(self, args: typing.List[bytes]):
+        for channel in args:
+            self.server.subscribe(channel, self.wfile)
+
+    def _doUnsubscribe(self, args: typing.List[bytes]):
+        for channel in args:
+            self.server.unsubscribe(channel, self.wfile)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int = 0):
+        super().__init__(("127.0.0.1", port), _FakeRedisHandler)
+        self.lock = threading.Lock()
+        # Every command received, by name (e.g. to check what got cached)
+        self.commands: typing.List[str] = []
+        # Key -> (value, when it expires, if ever)
+        self._values: typing.Dict[
+            bytes, typing.Tuple[bytes, typing.Optional[float]]
+        ] = {}
+        self._subscribers: typing.Dict[bytes, typing.List[typing.BinaryIO]] = {}
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"redis://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def getValue(self, key: bytes) -> typing.Optional[bytes]:
+        with self.lock:
+            value, expiresAt = self._values.get(key, (None, None))
+            if expiresAt is not None and expiresAt <= time.monotonic():
+                del self._values[key]
+                return None
+            return value
+
+    def setValue(self, key: bytes, value: bytes, ttlSeconds: typing.Optional[int]):
+        with self.lock:
+            expiresAt = None if ttlSeconds is None else time.monotonic() + ttlSeconds
+            self._values[key] = (value, expiresAt)
+
+    def _writeSubscriptionReply(
+        self, writer: typing.BinaryIO, kind: bytes, channel: bytes
+    ):
+        # (only call this while holding self.lock)
+        numChannels = sum(writer in writers for writers in self._subscribers.values())
+        writer.write(
+            b"*3\r\n"
+            + _encodeBulk(kind)
+            + _encodeBulk(channel)
+            + f":{numChannels}\r\n".encode()
+        )
+
+    def subscribe(self, channel: bytes, writer: typing.BinaryIO):
+        # (writes to subscribers happen while holding the lock, so 2 messages
+        # can't get mixed together)
+        with self.lock:
+            self._subscribers.setdefault(channel, []).append(writer)
+            self._writeSubscriptionReply(writer, b"subscribe", channel)
+
+    def unsubscribe(self, channel: bytes, writer: typing.BinaryIO):
+        with self.lock:
+            writers = self._subscribers.get(channel, [])
+            if writer in writers:
+                writers.remove(writer)
+            self._writeSubscriptionReply(writer, b"unsubscribe", channel)
+
+    def getNumSubscribers(self, channel: str) -> int:
+        with self.lock:
+            return len(self._subscribers.get(channel.encode(), []))
+
+    def publish(self, channel: bytes, message: bytes) -> int:
+        data = (
+            b"*3\r\n"
+            + _encodeBulk(b"message")
+            + _encodeBulk(channel)
+            + _encodeBulk(message)
+        )
+        numReceivers = 0
+        with self.lock:
+            for writer in list(self._subscribers.get(channel, [])):
+                try:
+                    writer.write(data)
+                    numReceivers += 1
+                except OSError:
+                    self._subscribers[channel].remove(writer)
+        return numReceivers
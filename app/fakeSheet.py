@@ -0,0 +1,364 @@
+"""
+An in-memory stand-in for the parts of gspread that GoogleSheet uses, so the
+sheet code can be tested and benchmarked without Google credentials or a
+network connection.
+
+Every API call is recorded (with rough request/response sizes), and you can
+inject latency, failures, and the Sheets per-minute quotas to see how the
+sheet code holds up:
+
+    connection = FakeConnection(latencySeconds=0.2, readsPerMinute=60)
+    googleSheet = GoogleSheet(connection=connection)
+    googleSheet.addTenant("Jake Deerin", datetime.now())
+    print(connection.spreadsheet.calls)
+
+Set RENTBOT_GSHEETS_BACKEND=memory to have GoogleSheet() use one of these
+instead of connecting to Google.
+"""
+
+import collections
+import json
+import random
+import threading
+import time
+import typing
+from dataclasses import dataclass
+
+import requests
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import a1_range_to_grid_range
+
+READ_OPERATIONS = {"get_all_values", "batch_get", "get_lastUpdateTime"}
+
+
+def makeAPIError(statusCode: int, message: str = "") -> APIError:
+    """Builds the same kind of error gspread raises for a failed request"""
+    response = requests.Response()
+    response.status_code = statusCode
+    response._content = json.dumps(
+        {"error": {"code": statusCode, "message": message}}
+    ).encode()
+    return APIError(response)
+
+
+def _jsonSize(data) -> int:
+    return len(json.dumps(data, default=str))
+
+
+@dataclass
+class FakeCall:
+    operation: str
+    worksheet: str
+    bytesSent: int
+    bytesReceived: int
+    seconds: float
+    error: typing.Optional[str] = None
+
+
+class FakeWorksheet:
+    """
+    A worksheet held as a list of rows; values are stored as-is (like gspread's
+    default RAW input) and read back as strings unless UNFORMATTED_VALUE is
+    asked for; like a real worksheet, it only grows when rows are added
+    """
+
+    def __init__(
+        self,
+        spreadsheet: "FakeSpreadsheet",
+        title: str,
+        id: int,
+        rows: int = 1000,
+        cols: int = 26,
+    ):
+        self._spreadsheet = spreadsheet
+        self.title = title
+        self.id = id
+        self._rowCount = rows
+        self.col_count = cols
+        self.rows: typing.List[list] = []
+
+    @property
+    def row_count(self) -> int:
+        return self._rowCount
+
+    def add_rows(self, rows: int):
+        def add():
+            self._rowCount += rows
+            self._spreadsheet._version += 1
+
+        return self._spreadsheet._call("add_rows", self, {"rows": rows}, add)
+
+    def update_title(self, title: str):
+        self.title = title
+
+    def _getValues(self, valueRenderOption=None) -> typing.List[list]:
+        # Like the real API, trailing empty rows/cells are left off, and every
+        # row is padded out to the same width
+        rows = list(self.rows)
+        while rows and not any(cell != "" for cell in rows[-1]):
+            rows.pop()
+        width = max((len(row) for row in rows), default=0)
+        render = (
+            (lambda cell: cell)
+            if str(valueRenderOption) == "UNFORMATTED_VALUE"
+            else (lambda cell: str(cell))
+        )
+        return [
+            [render(cell) for cell in row] + [""] * (width - len(row)) for row in rows
+        ]
+
+    def get_all_values(self, **kwargs) -> typing.List[list]:
+        return self._spreadsheet._call(
+            "get_all_values",
+            self,
+            kwargs,
+            lambda: self._getValues(kwargs.get("value_render_option")),
+        )
+
+    def batch_get(self, ranges: typing.List[str], **kwargs) -> typing.List[list]:
+        def getRanges():
+            allValues = self._getValues(kwargs.get("value_render_option"))
+            results = []
+            for a1Range in ranges:
+                gridRange = a1_range_to_grid_range(a1Range)
+                firstCol = gridRange.get("startColumnIndex", 0)
+                lastCol = gridRange.get("endColumnIndex")
+                values = [
+                    row[firstCol:lastCol]
+                    for row in allValues[
+                        gridRange.get("startRowIndex", 0) : gridRange.get("endRowIndex")
+                    ]
+                ]
+                while values and not any(cell != "" for cell in values[-1]):
+                    values.pop()
+                results.append(values)
+            return results
+
+        return self._spreadsheet._call(
+            "batch_get", self, {"ranges": ranges, **kwargs}, getRanges
+        )
+
+    def batch_update(self, data: typing.List[dict], **kwargs) -> dict:
+        def update():
+            for update in data:
+                gridRange = a1_range_to_grid_range(update["range"])
+                lastRow = gridRange.get("startRowIndex", 0) + len(update["values"])
+                if lastRow > self._rowCount:
+                    # Like the real API, nothing's written if any of it
+                    # doesn't fit
+                    raise makeAPIError(
+                        400,
+                        f"Range ('{self.title}'!{update['range']}) exceeds grid "
+                        f"limits. Max rows: {self._rowCount}",
+                    )
+            for update in data:
+                gridRange = a1_range_to_grid_range(update["range"])
+                for i, values in enumerate(update["values"]):
+                    rowIndex = gridRange.get("startRowIndex", 0) + i
+                    while len(self.rows) <= rowIndex:
+                        self.rows.append([])
+                    row = self.rows[rowIndex]
+                    for j, value in enumerate(values):
+                        colIndex = gridRange.get("startColumnIndex", 0) + j
+                        while len(row) <= colIndex:
+                            row.append("")
+                        row[colIndex] = value
+            self._spreadsheet._version += 1
+            return {"totalUpdatedCells": sum(len(u["values"]) for u in data)}
+
+        return self._spreadsheet._call(
+            "batch_update", self, {"data": data, **kwargs}, update
+        )
+
+
+class FakeSpreadsheet:
+    """
+    A spreadsheet of FakeWorksheets; every worksheet's API calls go through
+    _call, which applies the injected latency/failures/quotas and records the
+    call in "calls"
+    """
+
+    def __init__(
+        self,
+        latencySeconds: float = 0.0,
+        failureRate: float = 0.0,
+        readsPerMinute: typing.Optional[int] = None,
+        writesPerMinute: typing.Optional[int] = None,
+        clock: typing.Callable[[], float] = time.monotonic,
+        sleep: typing.Callable[[float], None] = time.sleep,
+        seed: typing.Optional[int] = None,
+    ):
+        self.latencySeconds = latencySeconds
+        # Chance that any given call fails with an HTTP 500
+        self.failureRate = failureRate
+        # None means unlimited; otherwise, calls over the limit in any 60
+        # second window fail with an HTTP 429
+        self.readsPerMinute = readsPerMinute
+        self.writesPerMinute = writesPerMinute
+        self._clock = clock
+        self._sleep = sleep
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._failures: typing.List[Exception] = []
+        self._recentCalls: typing.Dict[str, typing.Deque[float]] = {
+            "read": collections.deque(),
+            "write": collections.deque(),
+        }
+        self._version = 0
+
+        self.calls: typing.List[FakeCall] = []
+        self._worksheets = [FakeWorksheet(self, "Sheet1", 0)]
+
+    @property
+    def sheet1(self) -> FakeWorksheet:
+        return self._worksheets[0]
+
+    def failNext(self, *errors: Exception):
+        """Makes the next API calls raise the given errors, in order"""
+        self._failures.extend(errors)
+
+    def resetCalls(self):
+        self.calls = []
+
+    def getCallCounts(self) -> typing.Counter[str]:
+        return collections.Counter(call.operation for call in self.calls)
+
+    def getBytesTransferred(self) -> int:
+        return sum(call.bytesSent + call.bytesReceived for call in self.calls)
+
+    def _checkQuota(self, operation: str):
+        if operation in READ_OPERATIONS:
+            kind, limit = "read", self.readsPerMinute
+        else:
+            kind, limit = "write", self.writesPerMinute
+        if limit is None:
+            return
+        now = self._clock()
+        recentCalls = self._recentCalls[kind]
+        while recentCalls and recentCalls[0] <= now - 60:
+            recentCalls.popleft()
+        if len(recentCalls) >= limit:
+            raise makeAPIError(429, f"Quota exceeded for {kind} requests per minute")
+        recentCalls.append(now)
+
+    def _call(
+        self,
+        operation: str,
+        worksheet: typing.Optional[FakeWorksheet],
+        request,
+        func: typing.Callable,
+    ):
+        start = time.perf_counter()
+        if self.latencySeconds:
+            self._sleep(self.latencySeconds)
+        call = FakeCall(
+            operation=operation,
+            worksheet=worksheet.title if worksheet else "",
+            bytesSent=_jsonSize(request),
+            bytesReceived=0,
+            seconds=0.0,
+        )
+        try:
+            with self._lock:
+                self._checkQuota(operation)
+                if self._failures:
+                    raise self._failures.pop(0)
+                if self._random.random() < self.failureRate:
+                    raise makeAPIError(500, "Injected failure")
+                result = func()
+            call.bytesReceived = _jsonSize(result)
+            return result
+        except Exception as e:
+            call.error = repr(e)
+            raise
+        finally:
+            call.seconds = time.perf_counter() - start
+            self.calls.append(call)
+
+    def worksheets(self) -> typing.List[FakeWorksheet]:
+        return list(self._worksheets)
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        for worksheet in self._worksheets:
+            if worksheet.title == title:
+                return worksheet
+        raise WorksheetNotFound(title)
+
+    def add_worksheet(
+        self, title: str, rows: int, cols: int, index: typing.Optional[int] = None
+    ) -> FakeWorksheet:
+        def add():
+            worksheet = FakeWorksheet(
+                self, title, max(w.id for w in self._worksheets) + 1, rows, cols
+            )
+            self._worksheets.insert(
+                len(self._worksheets) if index is None else index, worksheet
+            )
+            self._version += 1
+            return worksheet
+
+        return self._call("add_worksheet", None, {"title": title}, add)
+
+    def reorder_worksheets(self, worksheetsInOrder: typing.List[FakeWorksheet]):
+        def reorder():
+            self._worksheets = list(worksheetsInOrder) + [
+                w for w in self._worksheets if w not in worksheetsInOrder
+            ]
+            self._version += 1
+
+        return self._call(
+            "reorder_worksheets",
+            None,
+            [w.id for w in worksheetsInOrder],
+            reorder,
+        )
+
+    def get_lastUpdateTime(self) -> str:
+        # Stands in for the Drive "modifiedTime"; all that matters is that it
+        # changes whenever the spreadsheet does
+        return self._call(
+            "get_lastUpdateTime", None, {}, lambda: f"version-{self._version}"
+        )
+
+    def copy(self) -> "FakeSpreadsheet":
+        """Returns a copy of the worksheets' contents, with no calls recorded"""
+        spreadsheet = FakeSpreadsheet(
+            self.latencySeconds,
+            self.failureRate,
+            self.readsPerMinute,
+            self.writesPerMinute,
+            self._clock,
+            self._sleep,
+        )
+        spreadsheet._worksheets = []
+        for worksheet in self._worksheets:
+            worksheetCopy = FakeWorksheet(
+                spreadsheet,
+                worksheet.title,
+                worksheet.id,
+                worksheet._rowCount,
+                worksheet.col_count,
+            )
+            worksheetCopy.rows = [list(row) for row in worksheet.rows]
+            spreadsheet._worksheets.append(worksheetCopy)
+        return spreadsheet
+
+
+class FakeConnection:
+    """
+    Stands in for the gspread client; open_by_url returns the same
+    FakeSpreadsheet for the same URL (by default, everything goes to
+    "spreadsheet")
+    """
+
+    def __init__(self, spreadsheet: typing.Optional[FakeSpreadsheet] = None, **kwargs):
+        self.spreadsheet = spreadsheet or FakeSpreadsheet(**kwargs)
+        self._spreadsheetsByUrl: typing.Dict[str, FakeSpreadsheet] = {}
+        self._spreadsheetOptions = kwargs
+
+    def open_by_url(self, url: str) -> FakeSpreadsheet:
+        if not self._spreadsheetsByUrl:
+            self._spreadsheetsByUrl[url] = self.spreadsheet
+        elif url not in self._spreadsheetsByUrl:
+            self._spreadsheetsByUrl[url] = FakeSpreadsheet(**self._spreadsheetOptions)
+        return self._spreadsheetsByUrl[url]
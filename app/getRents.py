@@ -2,7 +2,9 @@
 Retrieve my current apartment billing information from various websites.
 
 Using Selenium instead of REST APIs directly because Centennial uses Cloudflare
-bot mitigation, which prevents most simple REST requests from my code.
+bot mitigation, which prevents most simple REST requests from my code. Portals
+that don't need a browser can be fetched over plain HTTP instead (see
+httpScrape.py and BillProvider), falling back to Selenium on a bot challenge.
 """
 
 import io
@@ -11,16 +13,21 @@ import time
 import traceback
 from dataclasses import dataclass
 from datetime import date, datetime, timedelta
-from typing import Any, Callable
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import pandas as pd
 import pandera as pa
+import requests
 from pandera.typing import DataFrame, Series
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 
+from app import metrics, tracing
+from app.httpScrape import BotChallengeError, HttpBillClient, HttpScrapeError
 from app.installSeleniumDrivers import get_driver
+from app.networkCapture import NetworkCapture
+from app.scrapeSandbox import runSandboxed
 
 APARTMENT_LOGIN_PAGE_URL = "https://centennialplaceapartments.securecafe.com/residentservices/centennial-place/userlogin.aspx"
 APARTMENT_USERNAME = os.environ["CENTENNIAL_APARTMENT_USERNAME"]
@@ -36,6 +43,36 @@ INTERNET_PASSWORD = os.environ["XFINITY_PASSWORD"]
 
 # Give lots of time because these sites are garbage slow
 HTTP_TIMEOUT_SECONDS = 60
+# Whether to scrape each provider in its own supervised subprocess (see
+# scrapeSandbox.py); turn this off ("0") to debug a scraper in-process
+SCRAPE_IN_SANDBOX = os.environ.get("RENTBOT_SCRAPE_SANDBOX", "1") != "0"
+# "dom" (the default) to read the charges off the rendered pages, or "network"
+# to read them from the portals' own JSON responses when possible (see
+# networkCapture.py), falling back to the page if none of them have charges
+SCRAPE_EXTRACTION = os.environ.get("RENTBOT_SCRAPE_EXTRACTION", "dom")
+# Which JSON responses might have each portal's bill history in them
+APARTMENT_JSON_URL_PATTERN = r"(?i)activity|ledger|transaction|charge"
+ELECTRICITY_JSON_URL_PATTERN = r"(?i)bill|payment|history"
+INTERNET_JSON_URL_PATTERN = r"(?i)transaction|billing|payment"
+
+
+def _get_http_client(provider: str) -> Optional[HttpBillClient]:
+    """
+    Returns a client for the given provider's billing API, if its URL is set
+    (RENTBOT_<PROVIDER>_HTTP_BILLING_URL, and RENTBOT_<PROVIDER>_HTTP_LOGIN_URL
+    to log in with the provider's username and password when needed)
+    """
+    prefix = f"RENTBOT_{provider.upper()}_HTTP_"
+    billing_url = os.environ.get(prefix + "BILLING_URL", "")
+    if not billing_url:
+        return None
+    return HttpBillClient(
+        provider,
+        billing_url,
+        loginUrl=os.environ.get(prefix + "LOGIN_URL", ""),
+        usernameField=os.environ.get(prefix + "USERNAME_FIELD", "username"),
+        passwordField=os.environ.get(prefix + "PASSWORD_FIELD", "password"),
+    )
 
 
 class RecentCharges(pa.DataFrameModel):
@@ -54,11 +91,48 @@ class MonthlyCharges:
     utilities_cents: int
 
 
+@dataclass
+class BillProvider:
+    """A bill portal, and the ways to get its recent charges"""
+
+    name: str
+    username: str
+    password: str
+    # Logs in to the portal with a real browser and reads the charges
+    browser_scraper: Callable[[str, str], DataFrame[RecentCharges]]
+    # Calls the portal's billing API directly (if it works without a browser)
+    http_client: Optional[HttpBillClient] = None
+
+    def scrape_with_browser(self) -> DataFrame[RecentCharges]:
+        return self.browser_scraper(self.username, self.password)
+
+    def fetch_over_http(self) -> Optional[DataFrame[RecentCharges]]:
+        """
+        Returns the charges from the portal's billing API, or None if the
+        browser is needed instead (no API set up, a bot challenge, or the
+        API didn't work)
+        """
+        if self.http_client is None:
+            return None
+        try:
+            records = self.http_client.fetchChargeRecords(self.username, self.password)
+        except BotChallengeError as e:
+            print(f"{e}; using the browser instead")
+            return None
+        except (HttpScrapeError, requests.RequestException, ValueError):
+            print(traceback.format_exc())
+            print(f"Couldn't get the {self.name} charges over HTTP; using the browser")
+            return None
+        return recent_charges_from_records(records)
+
+
 def get_monthly_charges(
     apartment: RecentCharges,
     electricity: RecentCharges,
     internet: RecentCharges,
     month: date,
+    electricity_window: Optional[Tuple[date, date]] = None,
+    internet_window: Optional[Tuple[date, date]] = None,
 ) -> MonthlyCharges:
     start = date(month.year, month.month, 1)
     # TODO: get the actual last day of the month?
@@ -73,52 +147,144 @@ def get_monthly_charges(
     utility_amt = apartment_charges.charge_cents.sum() - rent_amt
 
     # Electricity bill is usually posted within a week of the end of the month
-    elec_start = start - timedelta(days=7)
-    elec_end = start + timedelta(days=7)
+    # (unless the bill scheduler has learned when it really is)
+    elec_start, elec_end = electricity_window or (
+        start - timedelta(days=7),
+        start + timedelta(days=7),
+    )
     electricity_charges: RecentCharges = electricity.loc[
         (elec_start <= electricity.date) & (electricity.date <= elec_end)
     ]
     utility_amt += electricity_charges.charge_cents.sum()
 
-    # Internet bill I only fetch the most recent payment
-    utility_amt += internet.charge_cents.sum()
+    # Internet is billed once a month, so only the latest bill in the month
+    # leading up to (or the bill scheduler's window around) when the bills are
+    # due counts; the scrapers get the whole transaction history
+    internet_start, internet_end = internet_window or (
+        start - timedelta(days=31),
+        start + timedelta(days=7),
+    )
+    internet_charges: RecentCharges = internet.loc[
+        (internet_start <= internet.date)
+        & (internet.date <= internet_end)
+        & (internet.charge_cents > 0)
+    ]
+    if len(internet_charges):
+        latest_date = internet_charges.date.max()
+        utility_amt += internet_charges.loc[
+            internet_charges.date == latest_date
+        ].charge_cents.sum()
 
     return MonthlyCharges(rent_cents=int(rent_amt), utilities_cents=int(utility_amt))
 
 
-def retry_func(func: Callable, max_retries: int) -> Any:
+def retry_func(func: Callable, max_retries: int, provider: str = "unknown") -> Any:
     for i in range(max_retries + 1):
         try:
-            return func()
+            with metrics.SCRAPE_SECONDS.time(provider=provider):
+                with tracing.span(f"scrape.{provider}", attempt=i):
+                    return func()
         except Exception:
             print(traceback.format_exc())
             print(f"{max_retries - i} retries remaining...")
+            if i < max_retries:
+                metrics.SCRAPE_RETRIES.inc(provider=provider)
+    metrics.SCRAPE_FAILURES.inc(provider=provider)
     raise RuntimeError(f"Function failed after {max_retries} retries")
 
 
+def recent_charges_to_records(charges: RecentCharges) -> List[Dict[str, Any]]:
+    """Converts the given charges to JSON-able records"""
+    return [
+        {
+            "date": row.date.isoformat(),
+            "description": row.description,
+            "charge_cents": int(row.charge_cents),
+            "payment_cents": int(row.payment_cents),
+            "balance_cents": int(row.balance_cents),
+        }
+        for row in charges.itertuples()
+    ]
+
+
+def recent_charges_from_records(
+    records: List[Dict[str, Any]],
+) -> DataFrame[RecentCharges]:
+    """Converts records from recent_charges_to_records back to charges"""
+    return RecentCharges.validate(
+        pd.DataFrame(
+            [
+                dict(record, date=date.fromisoformat(record["date"]))
+                for record in records
+            ]
+        )
+    )
+
+
+def scrape_provider(provider: str) -> DataFrame[RecentCharges]:
+    """Scrapes the recent charges from the given provider's website"""
+    if provider not in PROVIDERS:
+        raise ValueError(f'Unknown provider "{provider}"')
+    return PROVIDERS[provider].scrape_with_browser()
+
+
+def scrape_provider_records(provider: str) -> List[Dict[str, Any]]:
+    """scrape_provider, but returning JSON-able records (for the sandbox)"""
+    return recent_charges_to_records(scrape_provider(provider))
+
+
+def scrape_provider_sandboxed(provider: str) -> DataFrame[RecentCharges]:
+    """
+    Scrapes the given provider in a supervised subprocess (if
+    SCRAPE_IN_SANDBOX), so a hung or runaway browser can't take down the
+    server
+    """
+    if not SCRAPE_IN_SANDBOX:
+        return scrape_provider(provider)
+    records = runSandboxed("app.getRents:scrape_provider_records", [provider])
+    return recent_charges_from_records(records)
+
+
+def fetch_provider_charges(provider: str) -> DataFrame[RecentCharges]:
+    """
+    Gets the given provider's recent charges over plain HTTP if it can, or
+    else by scraping its website with a browser
+    """
+    with tracing.span("scrape.fetch", provider=provider) as span:
+        charges = PROVIDERS[provider].fetch_over_http()
+        path = "browser" if charges is None else "http"
+        if charges is None:
+            charges = scrape_provider_sandboxed(provider)
+        span.setAttribute("path", path)
+    print(f"Got the {provider} charges with {path}")
+    metrics.SCRAPE_PATHS.inc(provider=provider, path=path)
+    return charges
+
+
 def get_current_charges(max_retries: int = 3, verbose: bool = False) -> MonthlyCharges:
     start_time = time.time()
     internet_charges = retry_func(
-        lambda: get_internet_recent_charges(INTERNET_USERNAME, INTERNET_PASSWORD),
+        lambda: fetch_provider_charges("internet"),
         max_retries,
+        "internet",
     )
     if verbose:
         print(f"Internet ({time.time() - start_time:.2f}s):")
         print(internet_charges)
 
     electricity_charges = retry_func(
-        lambda: get_electricity_recent_charges(
-            ELECTRICITY_USERNAME, ELECTRICITY_PASSWORD
-        ),
+        lambda: fetch_provider_charges("electricity"),
         max_retries,
+        "electricity",
     )
     if verbose:
         print(f"Electricity ({time.time() - start_time:.2f}s):")
         print(electricity_charges)
 
     apartment_charges = retry_func(
-        lambda: get_apartment_recent_charges(APARTMENT_USERNAME, APARTMENT_PASSWORD),
+        lambda: fetch_provider_charges("apartment"),
         max_retries,
+        "apartment",
     )
     if verbose:
         print(f"Apartment ({time.time() - start_time:.2f}s):")
@@ -135,6 +301,45 @@ def get_current_charges(max_retries: int = 3, verbose: bool = False) -> MonthlyC
     return monthly_charges
 
 
+def _open_page(url: str):
+    """Starts a browser and loads the given page in it"""
+    with tracing.span("scrape.start_browser"):
+        driver = get_driver(log_cdp_events=SCRAPE_EXTRACTION == "network")
+    with tracing.span("scrape.load_page", url=url):
+        driver.get(url)
+    return driver
+
+
+def _capture_recent_charges(
+    driver, url_pattern: str, by: str, value: str
+) -> Optional[DataFrame[RecentCharges]]:
+    """
+    Returns the charges from the first JSON response (with a URL matching the
+    given pattern) that has any, if extracting them from the network; returns
+    None (to scrape the page instead) otherwise, or if none show up before
+    the given element (the rendered charges) does
+    """
+    if SCRAPE_EXTRACTION != "network":
+        return None
+    records = NetworkCapture(driver, url_pattern).waitForChargeRecords(
+        HTTP_TIMEOUT_SECONDS, giveUpWhen=lambda: bool(driver.find_elements(by, value))
+    )
+    if not records:
+        print("No charges in the portal's responses; reading the page instead")
+        return None
+    return recent_charges_from_records(records)
+
+
+def _wait_for_element(
+    driver, by: str, value: str, timeout: float = HTTP_TIMEOUT_SECONDS
+):
+    """Waits for the given element to show up on the page"""
+    with tracing.span("scrape.wait", element=value):
+        WebDriverWait(driver, timeout).until(
+            EC.presence_of_element_located((by, value))
+        )
+
+
 def _dollar_str_to_cents(s: str) -> int:
     dollars_str, cents_str = s.strip().replace("$", "").replace(",", "").split(".")
     return (100 * int(dollars_str)) + int(cents_str)
@@ -157,13 +362,10 @@ def get_internet_recent_charges(
     login_page_url = INTERNET_LOGIN_PAGE_URL
 
     # initialize browser
-    driver = get_driver()
-    driver.get(login_page_url)
+    driver = _open_page(login_page_url)
     print("Loaded page")
 
-    WebDriverWait(driver, HTTP_TIMEOUT_SECONDS).until(
-        EC.presence_of_element_located((By.ID, "user"))
-    )
+    _wait_for_element(driver, By.ID, "user")
     print("User page started")
 
     # log in via login page
@@ -177,9 +379,7 @@ def get_internet_recent_charges(
     submit.click()
     print("Clicked sign_in button")
 
-    WebDriverWait(driver, HTTP_TIMEOUT_SECONDS).until(
-        EC.presence_of_element_located((By.ID, "passwd"))
-    )
+    _wait_for_element(driver, By.ID, "passwd")
     print("Found passwd")
 
     passw = driver.find_element(By.ID, "passwd")
@@ -191,12 +391,19 @@ def get_internet_recent_charges(
     submit.click()
     print("Clicked sign_in button")
 
-    # wait for page to load
-    WebDriverWait(driver, HTTP_TIMEOUT_SECONDS).until(
-        EC.presence_of_element_located(
-            (By.CSS_SELECTOR, "[data-testid='TransactionsHistory']")
-        )
+    # The whole transaction history, rather than just the most recent payment
+    captured_charges = _capture_recent_charges(
+        driver,
+        INTERNET_JSON_URL_PATTERN,
+        By.CSS_SELECTOR,
+        "[data-testid='TransactionsHistory']",
     )
+    if captured_charges is not None:
+        driver.quit()
+        return captured_charges
+
+    # wait for page to load
+    _wait_for_element(driver, By.CSS_SELECTOR, "[data-testid='TransactionsHistory']")
 
     most_recent_payment = driver.find_element(
         By.CSS_SELECTOR, "[data-testid='TransactionsHistory']"
@@ -259,11 +466,8 @@ def get_electricity_recent_charges(
     login_page_url = ELECTRICITY_LOGGING_PAGE_URL
 
     # initialize browser
-    driver = get_driver()
-    driver.get(login_page_url)
-    WebDriverWait(driver, HTTP_TIMEOUT_SECONDS).until(
-        EC.presence_of_element_located((By.ID, "mat-input-0"))
-    )
+    driver = _open_page(login_page_url)
+    _wait_for_element(driver, By.ID, "mat-input-0")
 
     # log in via login page
     user = driver.find_element(By.ID, "mat-input-0")
@@ -275,10 +479,15 @@ def get_electricity_recent_charges(
     submit = driver.find_element(By.CSS_SELECTOR, ".mat-raised-button.mat-primary")
     submit.click()
 
-    # wait for page to load
-    WebDriverWait(driver, HTTP_TIMEOUT_SECONDS).until(
-        EC.presence_of_element_located((By.ID, "BillHistoryTable"))
+    captured_charges = _capture_recent_charges(
+        driver, ELECTRICITY_JSON_URL_PATTERN, By.ID, "BillHistoryTable"
     )
+    if captured_charges is not None:
+        driver.quit()
+        return captured_charges
+
+    # wait for page to load
+    _wait_for_element(driver, By.ID, "BillHistoryTable")
 
     bill_history = (
         driver.find_element(By.ID, "BillHistoryTable")
@@ -311,8 +520,7 @@ def get_apartment_recent_charges(
 ) -> DataFrame[RecentCharges]:
     login_page_url = APARTMENT_LOGIN_PAGE_URL
     # initialize browser
-    driver = get_driver()
-    driver.get(login_page_url)
+    driver = _open_page(login_page_url)
 
     # log in via login page
     reject_cookies = driver.find_element(By.ID, "onetrust-reject-all-handler")
@@ -328,17 +536,20 @@ def get_apartment_recent_charges(
     submit.click()
 
     # wait for page to load
-    WebDriverWait(driver, HTTP_TIMEOUT_SECONDS).until(
-        EC.presence_of_element_located((By.ID, "tabs"))
-    )
+    _wait_for_element(driver, By.ID, "tabs")
 
     # navigate to recent charge activity table
     recent_activity = driver.find_element(By.ID, "LinkRecentActivity")
     recent_activity.click()
 
-    WebDriverWait(driver, 10).until(
-        EC.presence_of_element_located((By.ID, "PendingActivityDetails"))
+    captured_charges = _capture_recent_charges(
+        driver, APARTMENT_JSON_URL_PATTERN, By.ID, "PendingActivityDetails"
     )
+    if captured_charges is not None:
+        driver.quit()
+        return captured_charges
+
+    _wait_for_element(driver, By.ID, "PendingActivityDetails", timeout=10)
 
     recent_activity_table = driver.find_element(By.ID, "PendingActivityDetails")
     table_html = recent_activity_table.get_attribute("outerHTML")
@@ -361,6 +572,32 @@ def get_apartment_recent_charges(
     )
 
 
+PROVIDERS: Dict[str, BillProvider] = {
+    "internet": BillProvider(
+        "internet",
+        INTERNET_USERNAME,
+        INTERNET_PASSWORD,
+        get_internet_recent_charges,
+        _get_http_client("internet"),
+    ),
+    "electricity": BillProvider(
+        "electricity",
+        ELECTRICITY_USERNAME,
+        ELECTRICITY_PASSWORD,
+        get_electricity_recent_charges,
+        _get_http_client("electricity"),
+    ),
+    # (behind Cloudflare, so this one will usually need the browser)
+    "apartment": BillProvider(
+        "apartment",
+        APARTMENT_USERNAME,
+        APARTMENT_PASSWORD,
+        get_apartment_recent_charges,
+        _get_http_client("apartment"),
+    ),
+}
+
+
 def main():
     get_current_charges(verbose=True)
 
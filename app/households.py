@@ -0,0 +1,274 @@
+"""
+Lets one RentBot server handle many apartments ("households"), each with its
+own GroupMe group, bot, and sheet.
+
+Households are listed in a JSON file at RENTBOT_HOUSEHOLDS_PATH, e.g.
+
+    [
+        {
+            "groupId": "52458108",
+            "botId": "<GroupMe bot ID>",
+            "sheetsUrl": "https://docs.google.com/spreadsheets/d/...",
+            "startTime": "2021-08-01",
+            "landlordName": "Jake Deerin",
+            "landlordVenmo": "https://venmo.com/Jake-Deerin",
+            "landlordPaypal": "https://paypal.me/jhdeerin"
+        }
+    ]
+
+and incoming messages are routed by their GroupMe group_id. Without that file,
+there's just 1 household, set up from the usual environment variables
+(GROUPME_BOT_ID, RENTBOT_GSHEETS_URL, RENTBOT_START_TIME), that handles every
+message.
+
+Opening a sheet means downloading it, so the opened sheets are kept in a
+SheetPool: the most recently used RENTBOT_SHEET_POOL_SIZE of them stay open,
+and any that haven't been used in RENTBOT_SHEET_POOL_IDLE_SECONDS are closed.
+They all share 1 authenticated Google client and its Sheets API quota (and the
+shared cache, if there is one; see sharedCache.py).
+"""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+import typing
+from dataclasses import dataclass
+from datetime import datetime
+
+from . import sheet
+from .fakeSheet import FakeConnection
+from .sharedCache import SharedCache
+from .sheet import GoogleSheet
+from .sheetsClient import SheetsQuota
+
+HOUSEHOLDS_PATH = os.environ.get("RENTBOT_HOUSEHOLDS_PATH", "")
+SHEET_POOL_SIZE = int(os.environ.get("RENTBOT_SHEET_POOL_SIZE", "100"))
+SHEET_POOL_IDLE_SECONDS = float(
+    os.environ.get("RENTBOT_SHEET_POOL_IDLE_SECONDS", "3600")
+)
+
+DEFAULT_LANDLORD_NAME = "Jake Deerin"
+DEFAULT_LANDLORD_VENMO = "https://venmo.com/Jake-Deerin"
+DEFAULT_LANDLORD_PAYPAL = "https://paypal.me/jhdeerin"
+
+
+@dataclass(frozen=True)
+class Household:
+    # The GroupMe group this household chats in ("" for the only household of
+    # a single-household server, which handles every group)
+    groupId: str
+    botId: str
+    sheetsUrl: str
+    # Only the year/month matter (it's the sheet's first month)
+    startTime: datetime
+    landlordName: str = DEFAULT_LANDLORD_NAME
+    landlordVenmo: str = DEFAULT_LANDLORD_VENMO
+    landlordPaypal: str = DEFAULT_LANDLORD_PAYPAL
+    # Whether to scrape the bills each month (the scrapers only have 1 set of
+    # credentials, so only the single-household setup does this)
+    scrapeBills: bool = False
+
+    @classmethod
+    def fromDict(cls, config: dict) -> "Household":
+        return cls(
+            **dict(config, startTime=datetime.fromisoformat(config["startTime"]))
+        )
+
+    def _getOwnPath(self, path: str) -> str:
+        """Returns the given file path with this household's group ID added"""
+        if not path or not self.groupId:
+            return path
+        base, extension = os.path.splitext(path)
+        return f"{base}-{self.groupId}{extension}"
+
+    def getJournalPath(self) -> str:
+        """Where this household's sheet updates are journaled (see journal.py)"""
+        return self._getOwnPath(sheet.JOURNAL_PATH)
+
+    def getSheetCachePath(self) -> str:
+        """Where this household's sheet is cached (see sheetCache.py)"""
+        return self._getOwnPath(sheet.SHEET_CACHE_PATH)
+
+
+class HouseholdRouter:
+    """Finds the household a GroupMe message came from"""
+
+    def __init__(
+        self,
+        households: typing.List[Household],
+        defaultHousehold: typing.Optional[Household] = None,
+    ):
+        self._households = {household.groupId: household for household in households}
+        self.defaultHousehold = defaultHousehold
+
+    @classmethod
+    def fromEnvironment(cls) -> "HouseholdRouter":
+        if HOUSEHOLDS_PATH:
+            with open(HOUSEHOLDS_PATH) as f:
+                households = [Household.fromDict(config) for config in json.load(f)]
+            print(f"Loaded {len(households)} households from '{HOUSEHOLDS_PATH}'")
+            return cls(households)
+        household = Household(
+            groupId="",
+            botId=os.environ["GROUPME_BOT_ID"],
+            sheetsUrl=sheet.SHEETS_URL,
+            startTime=sheet.RENTBOT_START_TIME,
+            scrapeBills=True,
+        )
+        return cls([], defaultHousehold=household)
+
+    def getHousehold(self, groupId: str) -> typing.Optional[Household]:
+        """
+        Returns the household for the given GroupMe group, or None if we don't
+        know it
+        """
+        return self._households.get(groupId, self.defaultHousehold)
+
+    def getAllHouseholds(self) -> typing.List[Household]:
+        households = list(self._households.values())
+        if self.defaultHousehold:
+            households.append(self.defaultHousehold)
+        return households
+
+
+@dataclass
+class _PooledSheet:
+    googleSheet: GoogleSheet
+    lastUsed: float
+    numUsers: int = 0
+
+
+class SheetPool:
+    """
+    Keeps recently used households' sheets open (up to maxSheets of them), and
+    closes any that have been idle for more than idleSeconds
+
+    Sheets that are in use, or that still have journaled updates waiting to be
+    written, are never closed.
+    """
+
+    def __init__(
+        self,
+        maxSheets: int = SHEET_POOL_SIZE,
+        idleSeconds: float = SHEET_POOL_IDLE_SECONDS,
+        openSheet: typing.Optional[typing.Callable[[Household], GoogleSheet]] = None,
+        clock: typing.Callable[[], float] = time.monotonic,
+        sharedCache: typing.Optional[SharedCache] = None,
+    ):
+        self.maxSheets = maxSheets
+        self.idleSeconds = idleSeconds
+        self._openSheet = openSheet or self._openGoogleSheet
+        self._clock = clock
+        self._sharedCache = sharedCache
+        self._lock = threading.Lock()
+        # Household group ID -> its open sheet, least recently used first
+        self._sheets: typing.OrderedDict[str, _PooledSheet] = collections.OrderedDict()
+        # So 2 requests for the same household don't both open its sheet
+        self._openLocks: typing.Dict[str, threading.Lock] = {}
+        self._googleClient = None
+        # (Google's quota is for the whole service account, not each sheet)
+        self._quota = SheetsQuota()
+        # Sheet URL -> its in-memory sheet (for RENTBOT_GSHEETS_BACKEND=memory),
+        # kept even when the sheet's closed so it isn't lost
+        self._fakeConnections: typing.Dict[str, FakeConnection] = {}
+
+    def _openGoogleSheet(self, household: Household) -> GoogleSheet:
+        if sheet.SHEETS_BACKEND == "memory":
+            with self._lock:
+                connection = self._fakeConnections.setdefault(
+                    household.sheetsUrl, FakeConnection()
+                )
+            return GoogleSheet(
+                connection=connection,
+                sheetsUrl=household.sheetsUrl,
+                startTime=household.startTime,
+                sharedCache=self._sharedCache,
+                quota=self._quota,
+            )
+        with self._lock:
+            if self._googleClient is None:
+                self._googleClient = sheet.connectToGoogle()
+        return GoogleSheet(
+            connection=self._googleClient,
+            journalPath=household.getJournalPath(),
+            sheetsUrl=household.sheetsUrl,
+            startTime=household.startTime,
+            cachePath=household.getSheetCachePath(),
+            sharedCache=self._sharedCache,
+            quota=self._quota,
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sheets)
+
+    def _checkOutOpenSheet(self, groupId: str) -> typing.Optional[GoogleSheet]:
+        # (only call this while holding self._lock)
+        pooledSheet = self._sheets.get(groupId)
+        if pooledSheet is None:
+            return None
+        self._sheets.move_to_end(groupId)
+        pooledSheet.numUsers += 1
+        pooledSheet.lastUsed = self._clock()
+        return pooledSheet.googleSheet
+
+    def _acquire(self, household: Household) -> GoogleSheet:
+        groupId = household.groupId
+        with self._lock:
+            googleSheet = self._checkOutOpenSheet(groupId)
+            if googleSheet:
+                return googleSheet
+            openLock = self._openLocks.setdefault(groupId, threading.Lock())
+
+        with openLock:
+            with self._lock:
+                # Someone else may have opened it while we were waiting
+                googleSheet = self._checkOutOpenSheet(groupId)
+                if googleSheet:
+                    return googleSheet
+            print(f'Opening the sheet for group "{groupId}"')
+            googleSheet = self._openSheet(household)
+            with self._lock:
+                self._sheets[groupId] = _PooledSheet(googleSheet, self._clock(), 1)
+                self._evict()
+            return googleSheet
+
+    def _release(self, household: Household):
+        with self._lock:
+            pooledSheet = self._sheets.get(household.groupId)
+            if pooledSheet:
+                pooledSheet.numUsers -= 1
+                pooledSheet.lastUsed = self._clock()
+            self._evict()
+
+    def _evict(self):
+        """
+        Closes idle sheets, and the least recently used ones if there are too
+        many open (only call this while holding self._lock)
+        """
+        now = self._clock()
+        numOpen = len(self._sheets)
+        for groupId, pooledSheet in list(self._sheets.items()):
+            isIdle = now - pooledSheet.lastUsed > self.idleSeconds
+            if not isIdle and numOpen <= self.maxSheets:
+                continue
+            if pooledSheet.numUsers or pooledSheet.googleSheet.hasUnwrittenUpdates():
+                continue
+            del self._sheets[groupId]
+            pooledSheet.googleSheet.close()
+            numOpen -= 1
+
+    @contextlib.contextmanager
+    def checkout(self, household: Household) -> typing.Iterator[GoogleSheet]:
+        """
+        Returns the household's sheet for the "with" block (opening it if it
+        isn't already)
+        """
+        googleSheet = self._acquire(household)
+        try:
+            yield googleSheet
+        finally:
+            self._release(household)
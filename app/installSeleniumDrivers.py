@@ -12,8 +12,17 @@ from seleniumbase import Driver
 CHROMIUM_ARGS = "disable-extensions,disable-gpu,no-sandbox"
 
 
-def get_driver() -> WebDriver:
-    return Driver(uc=True, headless=True, chromium_arg=CHROMIUM_ARGS)
+def get_driver(log_cdp_events: bool = False) -> WebDriver:
+    """
+    Starts a browser; with log_cdp_events, its network events (and so the
+    pages' XHR/fetch responses) can be read from its "performance" log
+    """
+    return Driver(
+        uc=True,
+        headless=True,
+        chromium_arg=CHROMIUM_ARGS,
+        log_cdp_events=log_cdp_events,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+"""
+A write-ahead journal for sheet updates, so a Google Sheets outage delays our
+writes instead of losing them.
+
+Every batch of sheet updates is appended (and fsync'd) to a local JSON-lines
+file before we try sending it to Google. Once an update has been written to
+the sheet, an "ack" line is appended for it; anything in the journal without
+an ack is still pending, and gets replayed in order (by the JournalReplayer)
+until the sheet accepts it, even across restarts. While updates are pending,
+reads of the sheet are patched with them (see applyUpdates), so commands
+still see their own changes.
+
+The journal assumes it's only used by 1 process at a time. Jobs that move the
+sheet's rows around (migrating and archiving) don't use it, and won't run
+while it has updates pending; see sheet.openSheetForMaintenance.
+"""
+
+import json
+import os
+import threading
+import time
+import typing
+from dataclasses import dataclass
+
+from gspread.utils import a1_range_to_grid_range, rowcol_to_a1
+
+
+@dataclass
+class JournalEntry:
+    seq: int
+    updates: typing.List[dict]
+
+
+def _paintCells(
+    cells: typing.Dict[typing.Tuple[int, int], typing.Any],
+    updates: typing.List[dict],
+):
+    """
+    Writes the given updates' values into a (row, col) -> value map (both
+    0-indexed), with later updates overwriting earlier ones
+    """
+    for update in updates:
+        gridRange = a1_range_to_grid_range(update["range"])
+        firstRow = gridRange.get("startRowIndex", 0)
+        firstCol = gridRange.get("startColumnIndex", 0)
+        for i, rowValues in enumerate(update["values"]):
+            for j, value in enumerate(rowValues):
+                cells[(firstRow + i, firstCol + j)] = value
+
+
+def coalesceUpdates(updateLists: typing.List[typing.List[dict]]) -> typing.List[dict]:
+    """
+    Merges the given batches of updates (in order) into 1 batch with no
+    overlapping ranges, where each cell ends up with the last value written
+    to it; each run of adjacent cells in a row becomes 1 range
+    """
+    cells: typing.Dict[typing.Tuple[int, int], typing.Any] = {}
+    for updates in updateLists:
+        _paintCells(cells, updates)
+
+    coalesced = []
+    runStart = None
+    runValues: typing.List[typing.Any] = []
+    for row, col in sorted(cells):
+        if runStart and runStart[0] == row and runStart[1] + len(runValues) == col:
+            runValues.append(cells[(row, col)])
+            continue
+        if runStart:
+            coalesced.append(_makeRowUpdate(runStart, runValues))
+        runStart = (row, col)
+        runValues = [cells[(row, col)]]
+    if runStart:
+        coalesced.append(_makeRowUpdate(runStart, runValues))
+    return coalesced
+
+
+def _makeRowUpdate(start: typing.Tuple[int, int], values: list) -> dict:
+    row, col = start
+    firstCell = rowcol_to_a1(row + 1, col + 1)
+    lastCell = rowcol_to_a1(row + 1, col + len(values))
+    return {"range": f"{firstCell}:{lastCell}", "values": [values]}
+
+
+def applyUpdates(
+    rows: typing.List[list], updates: typing.List[dict]
+) -> typing.List[list]:
+    """
+    Returns a copy of the given sheet rows (as read by get_all_values, unformatted) with the
+    given updates applied, as the sheet will look once they're written
+    """
+    cells: typing.Dict[typing.Tuple[int, int], typing.Any] = {}
+    _paintCells(cells, updates)
+    newRows = [list(row) for row in rows]
+    for (row, col), value in cells.items():
+        while len(newRows) <= row:
+            newRows.append([])
+        while len(newRows[row]) <= col:
+            newRows[row].append("")
+        newRows[row][col] = value
+
+    while newRows and not any(cell != "" for cell in newRows[-1]):
+        newRows.pop()
+    width = max((len(row) for row in newRows), default=0)
+    return [row + [""] * (width - len(row)) for row in newRows]
+
+
+class SheetJournal:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending: typing.List[JournalEntry] = []
+        self._nextSeq = 1
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        pending: typing.Dict[int, JournalEntry] = {}
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A write that was cut off by a crash (and so was never
+                    # confirmed to anyone)
+                    continue
+                if "ack" in record:
+                    for seq in [seq for seq in pending if seq <= record["ack"]]:
+                        del pending[seq]
+                    self._nextSeq = max(self._nextSeq, record["ack"] + 1)
+                else:
+                    pending[record["seq"]] = JournalEntry(
+                        record["seq"], record["updates"]
+                    )
+                    self._nextSeq = max(self._nextSeq, record["seq"] + 1)
+        self._pending = [pending[seq] for seq in sorted(pending)]
+        if self._pending:
+            print(f"Found {len(self._pending)} unwritten sheet updates in the journal")
+
+    def _appendRecord(self, record: dict):
+        isNewFile = not os.path.exists(self.path)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if isNewFile:
+            # Make sure the new file itself survives a crash, too
+            dirFd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(dirFd)
+            finally:
+                os.close(dirFd)
+
+    def append(self, updates: typing.List[dict]) -> int:
+        """
+        Durably records the given sheet updates as pending, returning their
+        sequence number
+        """
+        with self._lock:
+            seq = self._nextSeq
+            self._appendRecord({"seq": seq, "time": time.time(), "updates": updates})
+            self._pending.append(JournalEntry(seq, updates))
+            self._nextSeq += 1
+            return seq
+
+    def acknowledge(self, seq: int):
+        """
+        Records that every update up to (and including) the given sequence
+        number has been written to the sheet
+        """
+        with self._lock:
+            self._pending = [entry for entry in self._pending if entry.seq > seq]
+            if self._pending:
+                self._appendRecord({"ack": seq})
+                return
+            # Nothing's pending anymore, so start the journal over (keeping
+            # the sequence number going, in case an older copy of the file is
+            # ever restored)
+            tempPath = f"{self.path}.tmp"
+            with open(tempPath, "w") as f:
+                f.write(json.dumps({"ack": seq}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tempPath, self.path)
+
+    def getPending(self) -> typing.List[JournalEntry]:
+        with self._lock:
+            return list(self._pending)
+
+
+class JournalReplayer:
+    """
+    Writes the journal's pending updates to the sheet, all at once (coalesced
+    into 1 batch update) and in order; if the sheet can't be written to, a
+    background thread keeps retrying every "retrySeconds"
+    """
+
+    def __init__(
+        self,
+        journal: SheetJournal,
+        writeUpdates: typing.Callable[[typing.List[dict], typing.Optional[int]], None],
+        retrySeconds: float = 5.0,
+    ):
+        self.journal = journal
+        self._writeUpdates = writeUpdates
+        self.retrySeconds = retrySeconds
+        self._flushLock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def flush(self, maxRetries: typing.Optional[int] = None) -> bool:
+        """
+        Tries writing all the pending updates to the sheet, returning whether
+        there's nothing left pending
+        """
+        with self._flushLock:
+            pending = self.journal.getPending()
+            if not pending:
+                return True
+            try:
+                self._writeUpdates(
+                    coalesceUpdates([entry.updates for entry in pending]), maxRetries
+                )
+            except Exception as e:
+                print(f"Couldn't write {len(pending)} journaled updates yet ({e!r})")
+                return False
+            self.journal.acknowledge(pending[-1].seq)
+            return True
+
+    def flushInBackground(self):
+        """Keeps trying to flush the journal in a background thread"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while self.journal.getPending():
+            self._wake.wait(self.retrySeconds)
+            self._wake.clear()
+            if self.flush():
+                print("Wrote all the journaled updates to the sheet")
@@ -0,0 +1,162 @@
+"""
+Splits each month's bills between the tenants who stayed that month, in whole
+cents.
+
+All the months and tenants are held as (months x tenants) NumPy arrays, so the
+whole rent roll can be split in one pass instead of tenant-by-tenant.
+"""
+
+import typing
+
+import numpy as np
+
+if typing.TYPE_CHECKING:
+    from .sheet import MonthData
+
+# Weeks stayed are stored as whole hundredths of a week, so that splitting the
+# bill only ever needs integer math
+WEEK_UNITS = 100
+
+
+def _toCents(dollars: float) -> int:
+    return int(round(dollars * 100))
+
+
+def _toWeekUnits(weeks: float) -> int:
+    return int(round(weeks * WEEK_UNITS))
+
+
+class Ledger:
+    """
+    The bills, weeks stayed, and paid status for a set of months, like this:
+
+                    Jake Deerin     Mac Mathis      ...
+    8/2021          4 weeks/paid    2 weeks/unpaid
+    9/2021          4 weeks/unpaid  0 weeks/unpaid
+    ...
+
+    Each month's total (rent + utility) is split in proportion to weeks stayed
+    using largest-remainder rounding: everyone gets their share rounded down to
+    the cent, then the leftover cents go to whoever was rounded down the most
+    (ties go to whoever's listed first). That way the shares always add up to
+    exactly the month's total.
+    """
+
+    def __init__(
+        self,
+        months: typing.List[typing.Tuple[int, int]],
+        tenantNames: typing.List[str],
+        totalCents: np.ndarray,
+        weekUnits: np.ndarray,
+        isPaid: np.ndarray,
+        isListed: np.ndarray,
+    ):
+        self.months = months
+        self.tenantNames = tenantNames
+        # (months,) total bill for each month
+        self.totalCents = totalCents
+        # (months, tenants) how long each tenant stayed each month (0 if they
+        # weren't around)
+        self.weekUnits = weekUnits
+        # (months, tenants) whether each tenant has paid for each month
+        self.isPaid = isPaid
+        # (months, tenants) whether each tenant is listed on each month at all
+        self.isListed = isListed
+
+    @classmethod
+    def fromMonthData(
+        cls,
+        monthsData: typing.List["MonthData"],
+        tenantNames: typing.Optional[typing.List[str]] = None,
+    ) -> "Ledger":
+        """
+        Builds a ledger from the given months; every tenant who appears in any
+        of them gets a column, in addition to the given tenantNames
+        """
+        names = list(tenantNames or [])
+        for monthData in monthsData:
+            for name in monthData.tenants:
+                if name not in names:
+                    names.append(name)
+        columns = {name: i for i, name in enumerate(names)}
+
+        totalCents = np.zeros(len(monthsData), dtype=np.int64)
+        weekUnits = np.zeros((len(monthsData), len(names)), dtype=np.int64)
+        isPaid = np.zeros((len(monthsData), len(names)), dtype=bool)
+        isListed = np.zeros((len(monthsData), len(names)), dtype=bool)
+        for row, monthData in enumerate(monthsData):
+            totalCents[row] = _toCents(monthData.totalRent) + _toCents(
+                monthData.totalUtility
+            )
+            for tenant in monthData.tenants.values():
+                col = columns[tenant.name]
+                weekUnits[row, col] = _toWeekUnits(tenant.weeksStayed)
+                isPaid[row, col] = tenant.isPaid
+                isListed[row, col] = True
+
+        months = [(monthData.year, monthData.month) for monthData in monthsData]
+        return cls(months, names, totalCents, weekUnits, isPaid, isListed)
+
+    def getShareCents(self) -> np.ndarray:
+        """
+        Returns a (months, tenants) array of each tenant's share of each month's
+        bill, in cents; each row adds up to that month's total (unless no one
+        stayed that month, in which case no one owes anything)
+        """
+        totalWeekUnits = self.weekUnits.sum(axis=1, keepdims=True)
+        # Prevent division by 0 (no one stayed, so the shares are all 0 anyway)
+        divisor = np.where(totalWeekUnits == 0, 1, totalWeekUnits)
+
+        exactShares = self.totalCents[:, np.newaxis] * self.weekUnits
+        shares = exactShares // divisor
+        remainders = exactShares % divisor
+
+        leftoverCents = self.totalCents - shares.sum(axis=1)
+        leftoverCents = np.where(totalWeekUnits[:, 0] == 0, 0, leftoverCents)
+
+        # Rank everyone in each month by how much they were rounded down, and
+        # give 1 more cent to each of the top "leftoverCents" of them
+        order = np.argsort(-remainders, axis=1, kind="stable")
+        ranks = np.empty_like(order)
+        np.put_along_axis(
+            ranks, order, np.arange(order.shape[1])[np.newaxis, :], axis=1
+        )
+        shares += ranks < leftoverCents[:, np.newaxis]
+        return shares
+
+    def getOwedCents(self) -> np.ndarray:
+        """
+        Returns a (months, tenants) array of how much each tenant still owes for
+        each month, in cents
+        """
+        return np.where(self.isPaid, 0, self.getShareCents())
+
+    def getMonthAmountsOwedCents(
+        self,
+    ) -> typing.Dict[typing.Tuple[int, int], typing.Dict[str, int]]:
+        """
+        Returns how many cents each unpaid tenant listed on each month owes for
+        it
+        """
+        owedCents = self.getOwedCents()
+        isOwing = self.isListed & ~self.isPaid
+        monthAmounts = {}
+        for row, month in enumerate(self.months):
+            monthAmounts[month] = {
+                name: int(owedCents[row, col])
+                for col, name in enumerate(self.tenantNames)
+                if isOwing[row, col]
+            }
+        return monthAmounts
+
+    def getAmountsOwed(self, tenantNames: typing.List[str]) -> typing.Dict[str, float]:
+        """
+        Returns how many dollars each of the given tenants owes across all the
+        months in the ledger (0.0 for anyone not in it)
+        """
+        totalOwedCents = self.getOwedCents().sum(axis=0)
+        columns = {name: i for i, name in enumerate(self.tenantNames)}
+        return {
+            name: int(totalOwedCents[columns[name]]) / 100 if name in columns else 0.0
+            for name in tenantNames
+        }
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Floods a local copy of the RentBot server with synthetic GroupMe traffic and
+reports how it holds up (latency percentiles, error rate, and how many Sheets/
+GroupMe API calls each message costs).
+
+The server runs in-process against an in-memory sheet (see fakeSheet.py) and a
+local stand-in for the GroupMe API, so nothing real gets touched:
+
+    uv run python -m app.loadTest --rate 20 --duration 30 --sheet-latency-ms 150
+
+--server-concurrency caps how many requests the server handles at once (like
+Cloud Run's per-instance concurrency setting); requests over the cap get a 503.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import http.server
+import io
+import os
+import random
+import socket
+import threading
+import time
+import typing
+from dataclasses import dataclass
+
+import numpy as np
+import requests
+
+USER_NAMES = [
+    "Jake Deerin",
+    "Mac Mathis",
+    "Taylor Daniel",
+    "Andrew Dallas",
+    "Josh Minter",
+    "Manny Jonson",
+]
+CHATTER = [
+    "anyone want to get tacos tonight?",
+    "who left the oven on",
+    "lol",
+    "the wifi is down again",
+    "can someone take the trash out",
+    "I'll be back late, don't lock the door",
+    "did anyone order a package from amazon?",
+    "rent is due soon right?",
+]
+MALFORMED_COMMANDS = [
+    "/rent shwo",
+    "/rent pay",
+    "/rent utility 12",
+    "/rent batch\nshow\nbogus",
+]
+# getRents.py needs these to be set, though the load test never scrapes anything
+SCRAPER_CREDENTIALS = [
+    "CENTENNIAL_APARTMENT_USERNAME",
+    "CENTENNIAL_APARTMENT_PASSWORD",
+    "GEORGIA_POWER_USERNAME",
+    "GEORGIA_POWER_PASSWORD",
+    "XFINITY_USERNAME",
+    "XFINITY_PASSWORD",
+]
+# Relative weight of each kind of message in the default traffic mix; most of a
+# busy group chat isn't talking to the bot at all
+DEFAULT_MIX = "chatter=80,show=10,paid=4,add=3,malformed=3"
+
+
+def _makeMessage(kind: str, rng: random.Random) -> dict:
+    userName = rng.choice(USER_NAMES)
+    if kind == "chatter":
+        text = rng.choice(CHATTER)
+    elif kind == "show":
+        text = "/rent show"
+    elif kind == "paid":
+        text = "/rent paid"
+    elif kind == "add":
+        text = "/rent add"
+    elif kind == "malformed":
+        text = rng.choice(MALFORMED_COMMANDS)
+    else:
+        raise ValueError(f'Unknown message kind "{kind}"')
+    return {"text": text, "name": userName}
+
+
+def _parseMix(mix: str) -> typing.Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        kind, weight = item.split("=")
+        weights[kind.strip()] = float(weight)
+    return weights
+
+
+def _getFreePort() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class GroupMeStandIn:
+    """
+    A local HTTP server that accepts the bot's GroupMe API posts (after an
+    optional delay) and counts them
+    """
+
+    def __init__(self, latencySeconds: float = 0.0):
+        self.numPosts = 0
+        lock = threading.Lock()
+        standIn = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                time.sleep(latencySeconds)
+                with lock:
+                    standIn.numPosts += 1
+                self.send_response(202)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/v3"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+
+@dataclass
+class Result:
+    kind: str
+    statusCode: int
+    seconds: float
+
+
+def _send(session: requests.Session, url: str, kind: str, message: dict) -> Result:
+    start = time.perf_counter()
+    try:
+        response = session.post(url, json=message, timeout=60)
+        statusCode = response.status_code
+        # The webhook returns (message, status) pairs, which FastAPI sends back
+        # as a JSON list with a 200, so the real status is in the body
+        body = response.json() if statusCode == 200 else None
+        if isinstance(body, list) and len(body) == 2 and isinstance(body[1], int):
+            statusCode = body[1]
+    except (requests.RequestException, ValueError):
+        statusCode = 0
+    return Result(kind, statusCode, time.perf_counter() - start)
+
+
+def runLoad(
+    url: str,
+    rate: float,
+    duration: float,
+    mix: typing.Dict[str, float],
+    maxInFlight: int,
+    seed: int,
+) -> typing.List[Result]:
+    """
+    Sends messages at the given rate (per second) for the given duration,
+    without waiting on earlier responses (up to maxInFlight at once)
+    """
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    numMessages = int(rate * duration)
+    localSession = threading.local()
+
+    def send(kind: str, message: dict) -> Result:
+        if not hasattr(localSession, "session"):
+            localSession.session = requests.Session()
+        return _send(localSession.session, url, kind, message)
+
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(maxInFlight) as executor:
+        start = time.perf_counter()
+        for i in range(numMessages):
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            kind = rng.choices(kinds, weights)[0]
+            futures.append(executor.submit(send, kind, _makeMessage(kind, rng)))
+    return [future.result() for future in futures]
+
+
+def _printReport(
+    results: typing.List[Result],
+    wallSeconds: float,
+    sheetCalls: typing.Counter[str],
+    numGroupMePosts: int,
+):
+    def describe(label: str, results: typing.List[Result]):
+        latencies = np.array([r.seconds for r in results]) * 1000
+        numErrors = sum(1 for r in results if r.statusCode == 0 or r.statusCode >= 500)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(
+            f"{label:<12} {len(results):>6} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} "
+            f"{100 * numErrors / len(results):>7.1f}%"
+        )
+
+    print(
+        f"{'kind':<12} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>8}"
+    )
+    byKind = collections.defaultdict(list)
+    for result in results:
+        byKind[result.kind].append(result)
+    for kind, kindResults in sorted(byKind.items()):
+        describe(kind, kindResults)
+    describe("all", results)
+
+    statusCodes = collections.Counter(r.statusCode for r in results)
+    print()
+    print(f"Throughput: {len(results) / wallSeconds:.1f} messages/s")
+    print(f"Status codes: {dict(sorted(statusCodes.items()))} (0 = no response)")
+    print(
+        f"Sheets API calls: {sum(sheetCalls.values())} "
+        f"({sum(sheetCalls.values()) / len(results):.2f}/message) {dict(sheetCalls)}"
+    )
+    print(
+        f"GroupMe API calls: {numGroupMePosts} "
+        f"({numGroupMePosts / len(results):.2f}/message)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=10, help="messages per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run")
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help="relative weights of each kind of message (chatter, show, paid, add, malformed)",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=100,
+        help="most messages the load generator will wait on at once",
+    )
+    parser.add_argument(
+        "--server-concurrency",
+        type=int,
+        default=None,
+        help="most requests the server handles at once (default: no limit)",
+    )
+    parser.add_argument(
+        "--sheet-latency-ms",
+        type=float,
+        default=100,
+        help="simulated latency for each Sheets API call",
+    )
+    parser.add_argument(
+        "--groupme-latency-ms",
+        type=float,
+        default=50,
+        help="simulated latency for each GroupMe API call",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    groupMe = GroupMeStandIn(args.groupme_latency_ms / 1000)
+    # These have to be set before the server is imported
+    os.environ["RENTBOT_GSHEETS_BACKEND"] = "memory"
+    os.environ["RENTBOT_GROUPME_API_URL"] = groupMe.url
+    os.environ.setdefault("RENTBOT_GSHEETS_URL", "memory://rentbot")
+    os.environ.setdefault("RENTBOT_START_TIME", "2021-08-01")
+    os.environ.setdefault("GROUPME_BOT_ID", "load-test-bot")
+    for name in SCRAPER_CREDENTIALS:
+        os.environ.setdefault(name, "")
+    import uvicorn
+
+    from . import main as rentbot
+
+    with rentbot.SHEET_POOL.checkout(
+        rentbot.HOUSEHOLDS.defaultHousehold
+    ) as googleSheet:
+        for userName in USER_NAMES:
+            googleSheet.addTenant(userName, rentbot.getDefaultTimeForCommand())
+        spreadsheet = googleSheet._connection.spreadsheet
+    spreadsheet.latencySeconds = args.sheet_latency_ms / 1000
+    spreadsheet.resetCalls()
+
+    port = _getFreePort()
+    server = uvicorn.Server(
+        uvicorn.Config(
+            rentbot.app,
+            host="127.0.0.1",
+            port=port,
+            log_level="error",
+            limit_concurrency=args.server_concurrency,
+        )
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    print(
+        f"Sending {args.rate:g} messages/s for {args.duration:g}s "
+        f"(sheet latency {args.sheet_latency_ms:g}ms, "
+        f"GroupMe latency {args.groupme_latency_ms:g}ms)..."
+    )
+    start = time.perf_counter()
+    # The server prints a line or two for every command; keep them out of the
+    # report
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = runLoad(
+            f"http://127.0.0.1:{port}/",
+            args.rate,
+            args.duration,
+            _parseMix(args.mix),
+            args.max_in_flight,
+            args.seed,
+        )
+    wallSeconds = time.perf_counter() - start
+
+    server.should_exit = True
+    groupMe.stop()
+    _printReport(results, wallSeconds, spreadsheet.getCallCounts(), groupMe.numPosts)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,26 +4,50 @@ A quick script to create a GroupMe bot and have it send a reminder message to
 our apartment's GroupMe about the rent
 """
 
+import contextlib
+import dataclasses
 import os
 import re
+import threading
+import time
 import traceback
+import typing
 from datetime import datetime, timedelta
 
 import fastapi
+import pydantic
 import requests
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
 from pydantic import BaseModel
 
-from . import sheet
-from .getRents import get_current_charges
+from . import metrics, sheet, tracing
+from .billScheduler import BillScheduler
+from .coalescing import Debouncer
+from .getRents import (
+    MonthlyCharges,
+    fetch_provider_charges,
+    get_current_charges,
+    retry_func,
+)
+from .households import Household, HouseholdRouter, SheetPool
+from .profiler import PROFILER
+from .sharedCache import createSharedCache, makeKey
 from .sheet import GoogleSheet
 
 TOKEN = os.environ.get("GROUPME_TOKEN")
-BOT_ID = os.environ["GROUPME_BOT_ID"]
+# Can be pointed at a local stand-in for testing (see loadTest.py)
+GROUPME_API_URL = os.environ.get(
+    "RENTBOT_GROUPME_API_URL", "https://api.groupme.com/v3"
+)
 BOT_NAME = "RentBot"
-LANDLORD_GROUPME_NAME = "Jake Deerin"
-LANDLORD_VENMO = "https://venmo.com/Jake-Deerin"
-LANDLORD_PAYPAL = "https://paypal.me/jhdeerin"
-REMINDER_MESSAGE = f'It\'s RENT TIME again for the month!\n\nIn a few minutes, rents will be posted and you can type "/rent show" to see how much you owe @{LANDLORD_GROUPME_NAME}'
+BOT_TRIGGER = r"^\s*/rent\s+"
+BOT_TRIGGER_REGEX = re.compile(BOT_TRIGGER)
+# Identical "/rent show" replies within this many seconds of each other are
+# only posted once (e.g. when everyone checks right after the reminder)
+SHOW_DEBOUNCE_SECONDS = float(os.environ.get("RENTBOT_SHOW_DEBOUNCE_SECONDS", "10"))
+REMINDER_MESSAGE = 'It\'s RENT TIME again for the month!\n\nIn a few minutes, rents will be posted and you can type "/rent show" to see how much you owe @{landlordName}'
+MISSING_BILLS_MESSAGE = 'Hmmm, the {providers} bill(s) for this month still aren\'t posted, so I haven\'t set the rent; you can set it yourself with "/rent rent-amt $<amount>" and "/rent utility-amt $<amount>"'
 HELP_MESSAGE = """Hey! You can make me do things by typing "/rent <command name>" (without the quotes); here're the available commands:
 
 "/rent show"
@@ -43,16 +67,32 @@ HELP_MESSAGE = """Hey! You can make me do things by typing "/rent <command name>
 "/rent help"
     Have this chit-chat with me again, anytime
 
+You can also send several commands in one message, one "/rent ..." per line (or "/rent batch" on the first line, then one command per line without the "/rent"), and I'll do them all at once.
+
 If you need more info, you can poke around my insides here: https://github.com/JHDeerin/rentbot
 """
 
 
-app = fastapi.FastAPI()
-googleSheetConnection = GoogleSheet()
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    # Only the server waits on (and scrapes) the bills, not everything that
+    # imports this module (e.g. the pipeline job or the benchmarks)
+    getBillScheduler()
+    yield
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
+HOUSEHOLDS = HouseholdRouter.fromEnvironment()
+SHARED_CACHE = createSharedCache()
+SHEET_POOL = SheetPool(sharedCache=SHARED_CACHE)
+SHOW_DEBOUNCER = Debouncer(SHOW_DEBOUNCE_SECONDS)
+# Created when the server starts (see getBillScheduler)
+BILL_SCHEDULER: typing.Optional[BillScheduler] = None
+_BILL_SCHEDULER_LOCK = threading.Lock()
 
 
 def listGroups(token: str) -> str:
-    url = f"https://api.groupme.com/v3/groups?token={token}&per_page=499"
+    url = f"{GROUPME_API_URL}/groups?token={token}&per_page=499"
     result = requests.get(url)
     groups = result.json()["response"]
     groupInfo = []
@@ -70,15 +110,26 @@ def createBot(
     botCreationJSON = {
         "bot": {"name": botName, "group_id": groupID, "avatar_url": imageURL}
     }
-    url = f"https://api.groupme.com/v3/bots?token={token}"
+    url = f"{GROUPME_API_URL}/bots?token={token}"
     result = requests.post(url, json=botCreationJSON)
     return result.json()
 
 
 def sendBotMessage(botID: str, message: str):
     body = {"bot_id": botID, "text": message}
-    result = requests.post("https://api.groupme.com/v3/bots/post", json=body)
-    return result.text
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        with tracing.span("groupme.post") as span:
+            result = requests.post(f"{GROUPME_API_URL}/bots/post", json=body)
+            span.setAttribute("statusCode", result.status_code)
+        if result.ok:
+            outcome = "ok"
+        return result.text
+    finally:
+        metrics.GROUPME_POST_SECONDS.observe(
+            time.perf_counter() - start, outcome=outcome
+        )
 
 
 def getDefaultTimeForCommand() -> datetime:
@@ -92,23 +143,70 @@ def getDefaultTimeForCommand() -> datetime:
 
 class BotCommand:
     def __init__(self, cmdName: str = ""):
-        self.botTrigger = r"^\s*/rent\s+"
+        self.botTrigger = BOT_TRIGGER
         self.cmdRegex = re.compile(f"{self.botTrigger}{cmdName}")
         self.cmdName = cmdName
 
     def isCommand(self, userInput: str):
         return re.search(self.cmdRegex, userInput)
 
-    def execute(self, userInput: str, userName: str = ""):
-        pass
+    def getArgumentError(self, userInput: str) -> typing.Optional[str]:
+        """
+        Returns the message the bot should reply with if the command's
+        arguments can't be read (so nothing is applied), or None if they're OK
+        """
+        return None
+
+    def apply(
+        self,
+        userInput: str,
+        userName: str,
+        snapshot: sheet.SheetSnapshot,
+        household: Household,
+    ) -> str:
+        """
+        Applies the command to the given household's sheet snapshot (without
+        writing it back) and returns the message the bot should reply with
+        """
+        return ""
+
+    def execute(
+        self,
+        userInput: str,
+        userName: str,
+        household: Household,
+        googleSheet: GoogleSheet,
+    ):
+        snapshot = googleSheet.getSnapshot()
+        with tracing.span(f"command.{self.cmdName}"):
+            reply = self.apply(userInput, userName, snapshot, household)
+        googleSheet.commitSnapshot(snapshot)
+        if reply:
+            sendBotMessage(household.botId, reply)
 
 
 class HelpCommand(BotCommand):
     def __init__(self):
         super().__init__(cmdName="help")
 
-    def execute(self, userInput: str, userName: str = ""):
-        sendBotMessage(BOT_ID, HELP_MESSAGE)
+    def apply(
+        self,
+        userInput: str,
+        userName: str,
+        snapshot: sheet.SheetSnapshot,
+        household: Household,
+    ) -> str:
+        return HELP_MESSAGE
+
+    def execute(
+        self,
+        userInput: str,
+        userName: str,
+        household: Household,
+        googleSheet: GoogleSheet,
+    ):
+        # No need to download the sheet just to say hi
+        sendBotMessage(household.botId, HELP_MESSAGE)
 
 
 class AddCommand(BotCommand):
@@ -124,12 +222,18 @@ class AddCommand(BotCommand):
         user = matches.group(1)
         return user
 
-    def execute(self, userInput: str, userName: str = ""):
+    def apply(
+        self,
+        userInput: str,
+        userName: str,
+        snapshot: sheet.SheetSnapshot,
+        household: Household,
+    ) -> str:
         userToAdd = self.getCommandedUser(userInput)
         if not userToAdd:
             userToAdd = userName
-        googleSheetConnection.addTenant(userToAdd, getDefaultTimeForCommand())
-        sendBotMessage(BOT_ID, f"Added @{userToAdd} to the rent roll")
+        snapshot.addTenant(userToAdd, getDefaultTimeForCommand())
+        return f"Added @{userToAdd} to the rent roll"
 
 
 class RemoveCommand(BotCommand):
@@ -145,12 +249,18 @@ class RemoveCommand(BotCommand):
         user = matches.group(1)
         return user
 
-    def execute(self, userInput: str, userName: str = ""):
+    def apply(
+        self,
+        userInput: str,
+        userName: str,
+        snapshot: sheet.SheetSnapshot,
+        household: Household,
+    ) -> str:
         userToRemove = self.getCommandedUser(userInput)
         if not userToRemove:
             userToRemove = userName
-        googleSheetConnection.removeTenant(userToRemove, getDefaultTimeForCommand())
-        sendBotMessage(BOT_ID, f"Removed @{userToRemove} from the rent roll")
+        snapshot.removeTenant(userToRemove, getDefaultTimeForCommand())
+        return f"Removed @{userToRemove} from the rent roll"
 
 
 class PaidCommand(BotCommand):
@@ -158,19 +268,26 @@ class PaidCommand(BotCommand):
         super().__init__(cmdName="paid")
         self.parseCostRegex = re.compile(f"{self.cmdRegex.pattern}\s+()(\d*\.?\d+)")
 
-    def execute(self, userInput: str, userName: str = ""):
+    def apply(
+        self,
+        userInput: str,
+        userName: str,
+        snapshot: sheet.SheetSnapshot,
+        household: Household,
+    ) -> str:
         time = getDefaultTimeForCommand()
         try:
-            googleSheetConnection.markRentAsPaid(userName, time)
+            snapshot.markRentAsPaid(userName, time)
         except sheet.MonthNotFoundError:
             # Try going backwards 1 month; maybe the current month's data isn't
             # available yet and they intended to pay for the last month
             # TODO: Find a more robust/general solution, like specifying the
             # month you want to pay for
             time = time - timedelta(days=30)
-            googleSheetConnection.markRentAsPaid(userName, time)
+            with tracing.span("command.paid.previousMonthFallback"):
+                snapshot.markRentAsPaid(userName, time)
         monthStr = time.strftime("%B")
-        sendBotMessage(BOT_ID, f"@{userName} paid the rent for {monthStr} {time.year}")
+        return f"@{userName} paid the rent for {monthStr} {time.year}"
 
 
 class RentAmtCommand(BotCommand):
@@ -178,25 +295,30 @@ class RentAmtCommand(BotCommand):
         super().__init__(cmdName="rent-amt")
         self.parseCostRegex = re.compile(f"{self.cmdRegex.pattern}\s+\$?(\d*\.?\d+)")
 
-    def execute(self, userInput: str, userName: str = ""):
-        matches = self.parseCostRegex.search(userInput)
-        if not matches:
-            sendBotMessage(
-                BOT_ID,
-                'Hmmm, I couldn\'t read that amount (did you include it like "/rent rent-amt $1234.00"?)',
-            )
-            return
+    def getArgumentError(self, userInput: str) -> typing.Optional[str]:
+        if not self.parseCostRegex.search(userInput):
+            return 'Hmmm, I couldn\'t read that amount (did you include it like "/rent rent-amt $1234.00"?)'
+        return None
+
+    def apply(
+        self,
+        userInput: str,
+        userName: str,
+        snapshot: sheet.SheetSnapshot,
+        household: Household,
+    ) -> str:
+        argumentError = self.getArgumentError(userInput)
+        if argumentError:
+            return argumentError
 
+        matches = self.parseCostRegex.search(userInput)
         totalRent = float(matches.group(1))
         print(totalRent)
         time = getDefaultTimeForCommand()
-        googleSheetConnection.setTotalRent(totalRent, time)
+        snapshot.setTotalRent(totalRent, time)
 
         monthStr = time.strftime("%B")
-        sendBotMessage(
-            BOT_ID,
-            f"@{userName} set the total bill for {monthStr} {time.year} at ${totalRent:.2f}",
-        )
+        return f"@{userName} set the total bill for {monthStr} {time.year} at ${totalRent:.2f}"
 
 
 class UtilityAmtCommand(BotCommand):
@@ -205,25 +327,30 @@ class UtilityAmtCommand(BotCommand):
         # TODO: Try to reuse this pattern?
         self.parseCostRegex = re.compile(f"{self.cmdRegex.pattern}\s+\$?(\d*\.?\d+)")
 
-    def execute(self, userInput: str, userName: str = ""):
-        matches = self.parseCostRegex.search(userInput)
-        if not matches:
-            sendBotMessage(
-                BOT_ID,
-                'Hmmm, I couldn\'t read that amount (did you include it like "/rent utility-amt $1234.00"?)',
-            )
-            return
+    def getArgumentError(self, userInput: str) -> typing.Optional[str]:
+        if not self.parseCostRegex.search(userInput):
+            return 'Hmmm, I couldn\'t read that amount (did you include it like "/rent utility-amt $1234.00"?)'
+        return None
+
+    def apply(
+        self,
+        userInput: str,
+        userName: str,
+        snapshot: sheet.SheetSnapshot,
+        household: Household,
+    ) -> str:
+        argumentError = self.getArgumentError(userInput)
+        if argumentError:
+            return argumentError
 
+        matches = self.parseCostRegex.search(userInput)
         totalUtility = float(matches.group(1))
         print(totalUtility)
         time = getDefaultTimeForCommand()
-        googleSheetConnection.setTotalUtility(totalUtility, time)
+        snapshot.setTotalUtility(totalUtility, time)
 
         monthStr = time.strftime("%B")
-        sendBotMessage(
-            BOT_ID,
-            f"@{userName} set the total utility cost for {monthStr} {time.year} to ${totalUtility:.2f}",
-        )
+        return f"@{userName} set the total utility cost for {monthStr} {time.year} to ${totalUtility:.2f}"
 
 
 class WeeksStayedCommand(BotCommand):
@@ -232,33 +359,64 @@ class WeeksStayedCommand(BotCommand):
         # TODO: Try to reuse this pattern?
         self.parseWeeksRegex = re.compile(f"{self.cmdRegex.pattern}\s+(\d*\.?\d+)")
 
-    def execute(self, userInput: str, userName: str = ""):
-        matches = self.parseWeeksRegex.search(userInput)
-        if not matches:
-            sendBotMessage(
-                BOT_ID,
-                'Hmmm, I couldn\'t read how many weeks that was (did you include it like "/rent weeks-stayed 4"?)',
-            )
-            return
+    def getArgumentError(self, userInput: str) -> typing.Optional[str]:
+        if not self.parseWeeksRegex.search(userInput):
+            return 'Hmmm, I couldn\'t read how many weeks that was (did you include it like "/rent weeks-stayed 4"?)'
+        return None
+
+    def apply(
+        self,
+        userInput: str,
+        userName: str,
+        snapshot: sheet.SheetSnapshot,
+        household: Household,
+    ) -> str:
+        argumentError = self.getArgumentError(userInput)
+        if argumentError:
+            return argumentError
 
+        matches = self.parseWeeksRegex.search(userInput)
         weeksStr = matches.group(1)
         weeks = float(weeksStr)
         print(weeks)
         time = getDefaultTimeForCommand()
-        googleSheetConnection.setWeeksStayed(weeks, userName, time)
+        snapshot.setWeeksStayed(weeks, userName, time)
 
         monthStr = time.strftime("%B")
-        sendBotMessage(
-            BOT_ID, f"@{userName} stayed for {weeksStr} weeks in {monthStr} {time.year}"
-        )
+        return f"@{userName} stayed for {weeksStr} weeks in {monthStr} {time.year}"
 
 
 class ShowCommand(BotCommand):
     def __init__(self):
         super().__init__(cmdName="show")
 
-    def execute(self, userInput: str, userName: str = ""):
-        amountsOwed = googleSheetConnection.getAmountsOwed()
+    def apply(
+        self,
+        userInput: str,
+        userName: str,
+        snapshot: sheet.SheetSnapshot,
+        household: Household,
+    ) -> str:
+        return self.getRentsDueMessage(snapshot.getAmountsOwed(), household)
+
+    def execute(
+        self,
+        userInput: str,
+        userName: str,
+        household: Household,
+        googleSheet: GoogleSheet,
+    ):
+        # Read from the cached amounts owed instead of downloading the sheet
+        amountsOwed = googleSheet.getAmountsOwed()
+        message = self.getRentsDueMessage(amountsOwed, household)
+        if not SHOW_DEBOUNCER.shouldProceed((household.botId, message)):
+            print("Skipping reply; the same amounts were just posted")
+            return
+        sendBotMessage(household.botId, message)
+
+    def getRentsDueMessage(
+        self, amountsOwed: typing.Dict[str, float], household: Household
+    ) -> str:
         print(f"Amounts owed: {amountsOwed}")
         if amountsOwed:
             owedStrings = "\n".join(
@@ -266,26 +424,62 @@ class ShowCommand(BotCommand):
             )
         else:
             owedStrings = "...hmmm, I'm not sure who's paying rent right now (have you run \"/rent add\" to add yourself?)"
-        fullMessage = f"=== Rents Due ===\n{owedStrings}\n\nVenmo: {LANDLORD_VENMO}\nPayPal: {LANDLORD_PAYPAL}\nSpreadsheet for audits: {sheet.SHEETS_URL}"
-        sendBotMessage(BOT_ID, fullMessage)
+        return f"=== Rents Due ===\n{owedStrings}\n\nVenmo: {household.landlordVenmo}\nPayPal: {household.landlordPaypal}\nSpreadsheet for audits: {household.sheetsUrl}"
+
+
+class BatchCommand(BotCommand):
+    """
+    Runs several commands from one message, e.g.
+
+    /rent batch
+    rent-amt 1697
+    utility-amt 413.18
+    weeks-stayed 2
+
+    (sending several "/rent ..." lines in one message works the same way)
+    """
+
+    def __init__(self):
+        super().__init__(cmdName="batch")
+
+    def getCommandLines(self, userInput: str) -> typing.List[str]:
+        """
+        Splits a message into the individual "/rent ..." commands it contains
+        """
+        lines = [line.strip() for line in userInput.splitlines() if line.strip()]
+        if lines and self.isCommand(lines[0]):
+            # Everything after "/rent batch" is a command, with or without the
+            # "/rent" in front of it
+            return [
+                line if BOT_TRIGGER_REGEX.search(line) else f"/rent {line}"
+                for line in lines[1:]
+            ]
+        return [line for line in lines if BOT_TRIGGER_REGEX.search(line)]
+
+
+IGNORED_RESPONSE = ("Not a RentBot command", 200)
 
 
 class GroupMeMessage(BaseModel):
     text: str
     name: str
+    group_id: str = ""
+    # "user", "bot", or "system"
+    sender_type: str = "user"
 
 
-@app.post("/")
-def parseGroupMeMessage(msg: GroupMeMessage):
-    msgText = msg.text
-    msgUser = msg.name
-
-    if not BotCommand().isCommand(msgText):
-        return "Not a RentBot command", 200
+def mightBeCommand(body: bytes) -> bool:
+    """
+    Returns whether the raw JSON body of a GroupMe webhook request could hold
+    a RentBot command, without parsing it (so it's only ever wrong in saying
+    yes, e.g. if someone just mentions "/rent" in passing)
+    """
+    # (JSON can also escape "/" as "\/")
+    return b"/rent" in body or b"\\/rent" in body
 
-    print(f'Received message "{msgText}" from "{msgUser}"')
 
-    commands = [
+def getCommands() -> typing.List[BotCommand]:
+    return [
         HelpCommand(),
         AddCommand(),
         RemoveCommand(),
@@ -295,67 +489,421 @@ def parseGroupMeMessage(msg: GroupMeMessage):
         WeeksStayedCommand(),
         ShowCommand(),
     ]
+
+
+def findCommand(
+    userInput: str, commands: typing.List[BotCommand]
+) -> typing.Optional[BotCommand]:
     for cmd in commands:
-        if cmd.isCommand(msgText):
-            print(f"{cmd.cmdName} triggered")
-            try:
-                cmd.execute(msgText, msgUser)
-            except Exception:
-                print(traceback.format_exc())
-                sendBotMessage(
-                    BOT_ID,
-                    "🤒 Oh no - I'm feeling sick right now! Please try again when I'm feeling better (we'll send someone to patch me up)",
-                )
-                return "Internal server error", 500
-            return "Parsed message successfully", 200
-
-    sendBotMessage(
-        BOT_ID, 'Hmmm, I don\'t recognize that command (try typing "/rent help"?)'
+        if cmd.isCommand(userInput):
+            return cmd
+    return None
+
+
+def executeBatch(
+    cmdLines: typing.List[typing.Tuple[BotCommand, str]],
+    userName: str,
+    household: Household,
+    googleSheet: GoogleSheet,
+):
+    """
+    Applies all the given commands to one snapshot of the sheet, writes all of
+    their changes back at once, and sends a single combined reply
+
+    The commands' arguments should already be checked (see
+    BotCommand.getArgumentError); if any command fails, nothing is written to
+    the sheet.
+    """
+    snapshot = googleSheet.getSnapshot()
+    replies = []
+    for cmd, line in cmdLines:
+        print(f"{cmd.cmdName} triggered")
+        with tracing.span(f"command.{cmd.cmdName}"):
+            reply = cmd.apply(line, userName, snapshot, household)
+        if reply:
+            replies.append(reply)
+    googleSheet.commitSnapshot(snapshot)
+    sendBotMessage(household.botId, "\n\n".join(replies))
+
+
+@app.post("/")
+async def parseGroupMeMessage(
+    request: fastapi.Request,
+    profileSignature: typing.Optional[str] = fastapi.Header(
+        None, alias="X-RentBot-Profile"
+    ),
+):
+    """
+    Handles a GroupMe message (the JSON body is a GroupMeMessage)
+
+    Nearly every message is just chatter, so those are dropped before even
+    being parsed, right on the event loop; only possible commands are parsed
+    and handled (in a worker thread, since commands block on the sheet).
+    """
+    start = time.perf_counter()
+    body = await request.body()
+    if not mightBeCommand(body):
+        metrics.COMMAND_SECONDS.observe(
+            time.perf_counter() - start, command="none", outcome="ignored"
+        )
+        return IGNORED_RESPONSE
+    try:
+        msg = GroupMeMessage.model_validate_json(body)
+    except pydantic.ValidationError as e:
+        raise RequestValidationError(e.errors()) from e
+    return await run_in_threadpool(_handleWebhook, msg, profileSignature, start)
+
+
+def _handleWebhook(
+    msg: GroupMeMessage, profileSignature: typing.Optional[str], start: float
+) -> tuple:
+    forceProfile = PROFILER.isValidSignature(profileSignature)
+    with tracing.startTrace("webhook") as span:
+        with PROFILER.profile("webhook", force=forceProfile):
+            commandName, outcome, response = handleGroupMeMessage(msg)
+        span.setAttribute("groupId", msg.group_id)
+        span.setAttribute("command", commandName)
+        span.setAttribute("outcome", outcome)
+    metrics.COMMAND_SECONDS.observe(
+        time.perf_counter() - start, command=commandName, outcome=outcome
+    )
+    return response
+
+
+def handleGroupMeMessage(msg: GroupMeMessage) -> typing.Tuple[str, str, tuple]:
+    """
+    Runs the command(s) in the given message, returning the command's name
+    and outcome (for metrics) along with the response to send back
+    """
+    msgText = msg.text
+    msgUser = msg.name
+
+    if msg.sender_type == "bot":
+        # Never reply to bots (including ourselves), or we could end up
+        # talking to each other forever
+        return "none", "fromBot", IGNORED_RESPONSE
+    if not BOT_TRIGGER_REGEX.search(msgText):
+        return "none", "ignored", IGNORED_RESPONSE
+    household = HOUSEHOLDS.getHousehold(msg.group_id)
+    if household is None:
+        return "none", "unknownGroup", (f'Unknown group "{msg.group_id}"', 404)
+
+    print(
+        f'Received message "{msgText}" from "{msgUser}" '
+        f"(trace {tracing.getCurrentTraceId()})"
     )
-    return f'Unrecognized command "{msgText}"', 400
+
+    commands = getCommands()
+    batchCmd = BatchCommand()
+    lines = batchCmd.getCommandLines(msgText)
+    if len(lines) <= 1 and not batchCmd.isCommand(msgText):
+        # Plain single command; keep the whole message so that e.g. user names
+        # aren't cut off
+        lines = [msgText]
+
+    # Parse the whole batch up front so a typo doesn't apply half of it
+    cmdLines = []
+    for line in lines:
+        cmd = findCommand(line, commands)
+        if not cmd:
+            sendBotMessage(
+                household.botId,
+                'Hmmm, I don\'t recognize that command (try typing "/rent help"?)',
+            )
+            return "unknown", "unrecognized", (f'Unrecognized command "{line}"', 400)
+        argumentError = cmd.getArgumentError(line)
+        if argumentError:
+            sendBotMessage(household.botId, argumentError)
+            return cmd.cmdName, "badArguments", (f'Bad arguments in "{line}"', 400)
+        cmdLines.append((cmd, line))
+    if not cmdLines:
+        sendBotMessage(
+            household.botId,
+            'Hmmm, I didn\'t find any commands in that batch (try typing "/rent help"?)',
+        )
+        return "batch", "empty", (f'Empty batch "{msgText}"', 400)
+
+    commandName = cmdLines[0][0].cmdName if len(cmdLines) == 1 else "batch"
+    try:
+        with SHEET_POOL.checkout(household) as googleSheet:
+            if len(cmdLines) == 1:
+                cmd, line = cmdLines[0]
+                print(f"{cmd.cmdName} triggered")
+                cmd.execute(line, msgUser, household, googleSheet)
+            else:
+                executeBatch(cmdLines, msgUser, household, googleSheet)
+    except Exception:
+        print(traceback.format_exc())
+        sendBotMessage(
+            household.botId,
+            "🤒 Oh no - I'm feeling sick right now! Please try again when I'm feeling better (we'll send someone to patch me up)",
+        )
+        return commandName, "error", ("Internal server error", 500)
+    return commandName, "ok", ("Parsed message successfully", 200)
 
 
 def _cents_to_dollar_str(cents: int) -> str:
     return f"${cents / 100:.2f}"
 
 
+def _getCurrentCharges() -> MonthlyCharges:
+    """
+    Scrapes the charges for the current month, unless another instance already
+    has (and shared them)
+    """
+    key = makeKey("charges", datetime.now().strftime("%Y-%m"))
+    cachedCharges = SHARED_CACHE.getJson(key) if SHARED_CACHE else None
+    if cachedCharges:
+        print("Using the charges another instance already got")
+        return MonthlyCharges(**cachedCharges)
+    charges = get_current_charges(verbose=True)
+    if SHARED_CACHE:
+        SHARED_CACHE.setJson(key, dataclasses.asdict(charges))
+    return charges
+
+
+@tracing.traced("job.getCurrentRents", newTrace=True)
+@PROFILER.profiled("getCurrentRents")
 def _getCurrentRents():
     print("Getting charges for the current month in the background")
-    get_current_charges(verbose=True)
+    _getCurrentCharges()
     print("Got the charges")
 
 
-def _setCurrentRents():
-    print("Getting charges for the current month in the background")
-    charges = get_current_charges(verbose=True)
-    print("Got the charges; setting them now...")
-    rcmd = RentAmtCommand()
-    rcmd.execute(
-        userInput=f"/rent {rcmd.cmdName} {_cents_to_dollar_str(charges.rent_cents)}",
-        userName=BOT_NAME,
+def getChargeChanges(
+    monthData: typing.Optional[sheet.MonthData], charges: MonthlyCharges
+) -> typing.List[str]:
+    """
+    Describes how the given charges differ from the month's totals on the
+    sheet (e.g. "rent $0.00 -> $1697.00"), if at all
+    """
+    changes = []
+    for name, oldAmount, newCents in [
+        ("rent", monthData.totalRent if monthData else 0.0, charges.rent_cents),
+        (
+            "utilities",
+            monthData.totalUtility if monthData else 0.0,
+            charges.utilities_cents,
+        ),
+    ]:
+        oldCents = round(oldAmount * 100)
+        if oldCents != newCents:
+            changes.append(
+                f"{name} {_cents_to_dollar_str(oldCents)} -> {_cents_to_dollar_str(newCents)}"
+            )
+    return changes
+
+
+def getChargesChangedMessage(time: datetime, changes: typing.List[str]) -> str:
+    return f"@{BOT_NAME} updated the charges for {time:%B %Y}: {', '.join(changes)}"
+
+
+def writeScrapedCharges(
+    googleSheet: GoogleSheet,
+    charges: MonthlyCharges,
+    time: datetime,
+    isDryRun: bool = False,
+) -> typing.List[str]:
+    """
+    Sets the given month's scraped charges in the sheet, unless it already has
+    them (or it's a dry run), and returns what changed (see getChargeChanges)
+    """
+    snapshot = googleSheet.getSnapshot()
+    changes = getChargeChanges(snapshot.getMonthData(time), charges)
+    if changes and not isDryRun:
+        with tracing.span("command.setScrapedCharges", changes=len(changes)):
+            snapshot.setTotalRent(charges.rent_cents / 100, time)
+            snapshot.setTotalUtility(charges.utilities_cents / 100, time)
+        googleSheet.commitSnapshot(snapshot)
+    return changes
+
+
+def _setRents(household: Household, charges: MonthlyCharges):
+    """
+    Sets the month's scraped charges in the household's sheet, and announces
+    them, unless the sheet already has them
+    """
+    time = getDefaultTimeForCommand()
+    with SHEET_POOL.checkout(household) as googleSheet:
+        changes = writeScrapedCharges(googleSheet, charges, time)
+        if not changes:
+            print(f"The sheet already has the charges for {time:%B %Y}")
+            return
+        sendBotMessage(household.botId, getChargesChangedMessage(time, changes))
+        scmd = ShowCommand()
+        scmd.execute(
+            userInput=f"/rent {scmd.cmdName}",
+            userName=BOT_NAME,
+            household=household,
+            googleSheet=googleSheet,
+        )
+
+
+def _getScrapingHouseholds() -> typing.List[Household]:
+    return [
+        household
+        for household in HOUSEHOLDS.getAllHouseholds()
+        if household.scrapeBills
+    ]
+
+
+@tracing.traced("job.setCurrentRents", newTrace=True)
+@PROFILER.profiled("setCurrentRents")
+def _setScrapedRents(charges: MonthlyCharges):
+    """Sets the month's charges, once the bill scheduler has all the bills"""
+    print("Got all the bills; setting the charges now...")
+    if SHARED_CACHE:
+        key = makeKey("charges", datetime.now().strftime("%Y-%m"))
+        SHARED_CACHE.setJson(key, dataclasses.asdict(charges))
+    for household in _getScrapingHouseholds():
+        _setRents(household, charges)
+
+
+def _reportMissingBills(missingProviders: typing.List[str]):
+    for household in _getScrapingHouseholds():
+        sendBotMessage(
+            household.botId,
+            MISSING_BILLS_MESSAGE.format(providers=", ".join(missingProviders)),
+        )
+
+
+def getBillScheduler() -> BillScheduler:
+    """
+    Returns the server's bill scheduler, creating it (and resuming any month
+    it was still waiting on before a restart) the first time
+    """
+    global BILL_SCHEDULER
+    with _BILL_SCHEDULER_LOCK:
+        if BILL_SCHEDULER is None:
+            BILL_SCHEDULER = BillScheduler(
+                scrape=lambda provider: retry_func(
+                    lambda: fetch_provider_charges(provider), 1, provider
+                ),
+                onBillsReady=_setScrapedRents,
+                onGiveUp=_reportMissingBills,
+            )
+            if BILL_SCHEDULER.isPending():
+                # Keep waiting for the bills from before the restart
+                BILL_SCHEDULER.runInBackground()
+        return BILL_SCHEDULER
+
+
+@app.get("/metrics")
+def getMetrics():
+    """
+    Returns RentBot's metrics in the Prometheus text format
+    """
+    return fastapi.Response(
+        content=metrics.REGISTRY.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
     )
-    ucmd = UtilityAmtCommand()
-    ucmd.execute(
-        userInput=f"/rent {ucmd.cmdName} {_cents_to_dollar_str(charges.utilities_cents)}",
-        userName=BOT_NAME,
+
+
+def _requireDebugAccess(profileSignature: typing.Optional[str]):
+    """
+    Only lets requests signed like a profiling request (see
+    profiler.signProfileRequest) see the debug endpoints, since they show
+    what's in the requests
+    """
+    if not PROFILER.isValidSignature(profileSignature):
+        raise fastapi.HTTPException(status_code=403, detail="Not allowed")
+
+
+@app.get("/debug/traces")
+def getTraces(
+    traceId: typing.Optional[str] = None,
+    format: str = "jsonl",
+    profileSignature: typing.Optional[str] = fastapi.Header(
+        None, alias="X-RentBot-Profile"
+    ),
+):
+    """
+    Returns the spans for the given trace (or the most recent traces) as JSON
+    lines, or with format=chrome, as a Chrome trace to load into
+    chrome://tracing or https://ui.perfetto.dev
+    """
+    _requireDebugAccess(profileSignature)
+    spans = tracing.EXPORTER.getRecentSpans(traceId)
+    if format == "chrome":
+        return tracing.toChromeTrace(spans)
+    return fastapi.Response(
+        content=tracing.toJsonLines(spans), media_type="application/x-ndjson"
     )
-    scmd = ShowCommand()
-    scmd.execute(userInput=f"/rent {scmd.cmdName}", userName=BOT_NAME)
+
+
+@app.get("/debug/profiles")
+def listProfiles(
+    profileSignature: typing.Optional[str] = fastapi.Header(
+        None, alias="X-RentBot-Profile"
+    ),
+):
+    """
+    Lists the saved profiles (newest first); see profiler.py for turning
+    profiling on
+    """
+    _requireDebugAccess(profileSignature)
+    return {"profiles": PROFILER.listProfiles()}
+
+
+@app.get("/debug/profiles/{fileName}")
+def downloadProfile(
+    fileName: str,
+    profileSignature: typing.Optional[str] = fastapi.Header(
+        None, alias="X-RentBot-Profile"
+    ),
+):
+    _requireDebugAccess(profileSignature)
+    path = PROFILER.getProfilePath(fileName)
+    if not path:
+        raise fastapi.HTTPException(status_code=404, detail="No such profile")
+    return fastapi.responses.FileResponse(path, filename=fileName)
 
 
 @app.get("/reminder")
-def remindGroup(tasks: fastapi.BackgroundTasks):
+def remindGroup(tasks: fastapi.BackgroundTasks, groupId: typing.Optional[str] = None):
     """
-    Posts a reminder to pay the rent to the GroupMe
+    Posts a reminder to pay the rent to the given household's GroupMe (or to
+    every household's, if no group is given)
     """
     print("Received reminder request")
-    googleSheetConnection.createNewMonth(getDefaultTimeForCommand())
-    print(f"Made sure month data exists for {getDefaultTimeForCommand().isoformat()}")
-    sendBotMessage(BOT_ID, REMINDER_MESSAGE)
-    tasks.add_task(_setCurrentRents)
+    if groupId is None:
+        households = HOUSEHOLDS.getAllHouseholds()
+    else:
+        household = HOUSEHOLDS.getHousehold(groupId)
+        if household is None:
+            return f'Unknown group "{groupId}"', 404
+        households = [household]
+
+    for household in households:
+        with tracing.startTrace("reminder", groupId=household.groupId):
+            with SHEET_POOL.checkout(household) as googleSheet:
+                googleSheet.createNewMonth(getDefaultTimeForCommand())
+            print(
+                f"Made sure month data exists for {getDefaultTimeForCommand().isoformat()}"
+            )
+            sendBotMessage(
+                household.botId,
+                REMINDER_MESSAGE.format(landlordName=household.landlordName),
+            )
+        if household.scrapeBills:
+            billScheduler = getBillScheduler()
+            billScheduler.startMonth(datetime.now().date())
+            billScheduler.runInBackground()
     return "Reminder message sent", 200
 
 
+@app.get("/bills/poll")
+def pollBills():
+    """
+    Checks for this month's bills if any are due to be checked (e.g. for Cloud
+    Scheduler to call every hour, in case the server was scaled down), and
+    returns the bill schedule
+    """
+    billScheduler = getBillScheduler()
+    billScheduler.runInBackground()
+    return billScheduler.getStatus()
+
+
 @app.get("/test/getRents")
 def testGetRents(tasks: fastapi.BackgroundTasks):
     """
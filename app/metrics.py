@@ -0,0 +1,268 @@
+"""
+In-process counters and histograms for RentBot's hot paths (the webhook, the
+Sheets/GroupMe APIs, and the bill scrapers), served in the Prometheus text
+format from /metrics.
+
+These only live as long as the process does, which is fine for Prometheus
+(it's built to handle counters resetting when a server restarts).
+"""
+
+import contextlib
+import threading
+import time
+import typing
+
+# Bucket upper bounds (in seconds), from a quick API call up to a slow scrape
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+
+def _formatLabels(labels: typing.Iterable[typing.Tuple[str, str]]) -> str:
+    def escape(value: str) -> str:
+        return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+    labelStrs = [f'{name}="{escape(str(value))}"' for name, value in labels]
+    return "{" + ",".join(labelStrs) + "}" if labelStrs else ""
+
+
+def _formatValue(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    A named metric with a fixed set of label names; each combination of label
+    values gets its own series
+    """
+
+    type = ""
+
+    def __init__(
+        self, name: str, documentation: str, labelNames: typing.Sequence[str] = ()
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self._lock = threading.Lock()
+        self._series: typing.Dict[typing.Tuple[str, ...], typing.Any] = {}
+
+    def _getKey(self, labels: typing.Dict[str, str]) -> typing.Tuple[str, ...]:
+        if set(labels) != set(self.labelNames):
+            raise ValueError(
+                f"{self.name} needs labels {self.labelNames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelNames)
+
+    def render(self) -> typing.List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines += self._renderSeries(list(zip(self.labelNames, key)), value)
+        return lines
+
+    def _renderSeries(self, labels: list, value) -> typing.List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._getKey(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0.0) + amount
+
+    def get(self, **labels: str) -> float:
+        with self._lock:
+            return self._series.get(self._getKey(labels), 0.0)
+
+    def _renderSeries(self, labels: list, value: float) -> typing.List[str]:
+        return [f"{self.name}{_formatLabels(labels)} {_formatValue(value)}"]
+
+
+class _HistogramSeries:
+    def __init__(self, numBuckets: int):
+        self.bucketCounts = [0] * numBuckets
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelNames: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelNames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels: str):
+        key = self._getKey(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _HistogramSeries(len(self.buckets))
+            for i, upperBound in enumerate(self.buckets):
+                if value <= upperBound:
+                    series.bucketCounts[i] += 1
+            series.sum += value
+            series.count += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels: str):
+        """
+        Observes how long the "with" block takes; if the histogram has an
+        "outcome" label and it isn't given, it's filled in with "ok" (or
+        "error" if the block raises)
+        """
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            if "outcome" in self.labelNames and "outcome" not in labels:
+                labels = {**labels, "outcome": outcome}
+            self.observe(time.perf_counter() - start, **labels)
+
+    def getCount(self, **labels: str) -> int:
+        with self._lock:
+            series = self._series.get(self._getKey(labels))
+            return series.count if series else 0
+
+    def _renderSeries(self, labels: list, series: _HistogramSeries) -> typing.List[str]:
+        lines = []
+        for upperBound, bucketCount in zip(self.buckets, series.bucketCounts):
+            bucketLabels = _formatLabels(labels + [("le", _formatValue(upperBound))])
+            lines.append(f"{self.name}_bucket{bucketLabels} {bucketCount}")
+        lines.append(
+            f"{self.name}_sum{_formatLabels(labels)} {_formatValue(series.sum)}"
+        )
+        lines.append(f"{self.name}_count{_formatLabels(labels)} {series.count}")
+        return lines
+
+
+MetricT = typing.TypeVar("MetricT", bound=Metric)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: typing.List[Metric] = []
+
+    def register(self, metric: MetricT) -> MetricT:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Returns all the metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+COMMAND_SECONDS = REGISTRY.register(
+    Histogram(
+        "rentbot_command_duration_seconds",
+        "Time to handle a GroupMe message, by command and outcome",
+        ["command", "outcome"],
+    )
+)
+SHEETS_REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "rentbot_sheets_request_duration_seconds",
+        "Time for each Google Sheets API request, by operation and outcome",
+        ["operation", "outcome"],
+    )
+)
+SHEETS_THROTTLED_SECONDS = REGISTRY.register(
+    Counter(
+        "rentbot_sheets_throttled_seconds_total",
+        "Time spent waiting on the local Sheets quota before sending requests",
+    )
+)
+COALESCED_CALLS = REGISTRY.register(
+    Counter(
+        "rentbot_coalesced_calls_total",
+        "Calls that shared another in-flight call's result instead of making their own, by operation",
+        ["operation"],
+    )
+)
+SHARED_CACHE_REQUESTS = REGISTRY.register(
+    Counter(
+        "rentbot_shared_cache_requests_total",
+        "Requests to the shared cache, by operation and outcome (hit/miss/ok/error)",
+        ["operation", "outcome"],
+    )
+)
+GROUPME_POST_SECONDS = REGISTRY.register(
+    Histogram(
+        "rentbot_groupme_post_duration_seconds",
+        "Time to post a bot message to GroupMe, by outcome",
+        ["outcome"],
+    )
+)
+SCRAPE_SECONDS = REGISTRY.register(
+    Histogram(
+        "rentbot_scrape_duration_seconds",
+        "Time for each attempt at scraping a provider's recent charges",
+        ["provider", "outcome"],
+    )
+)
+SCRAPE_RETRIES = REGISTRY.register(
+    Counter(
+        "rentbot_scrape_retries_total",
+        "Scrape attempts that failed and were retried, by provider",
+        ["provider"],
+    )
+)
+SCRAPE_FAILURES = REGISTRY.register(
+    Counter(
+        "rentbot_scrape_failures_total",
+        "Scrapes that failed even after retrying, by provider",
+        ["provider"],
+    )
+)
+SCRAPE_PATHS = REGISTRY.register(
+    Counter(
+        "rentbot_scrape_path_total",
+        "Scrapes by provider and how they got the charges (http or browser)",
+        ["provider", "path"],
+    )
+)
+BILL_POLLS = REGISTRY.register(
+    Counter(
+        "rentbot_bill_polls_total",
+        "Polls for a provider's monthly bill, by whether it was posted yet",
+        ["provider", "outcome"],
+    )
+)
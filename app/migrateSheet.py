@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Converts the RentBot Google Sheet from the original (v1) layout to the compact
+v2 layout, a few months at a time; the old worksheet is kept as a backup.
+"""
+
+import argparse
+import sys
+
+from .sheet import UnwrittenUpdatesError, openSheetForMaintenance
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--chunk-months",
+        type=int,
+        default=12,
+        help="how many months to read from the old sheet at once",
+    )
+    args = parser.parse_args()
+
+    try:
+        googleSheet = openSheetForMaintenance()
+    except UnwrittenUpdatesError as e:
+        print(e)
+        sys.exit(1)
+    if googleSheet.formatVersion != 1:
+        print(f"Sheet is already format v{googleSheet.formatVersion}; nothing to do")
+        return
+    googleSheet.migrateToV2(chunkMonths=args.chunk_months)
+
+
+if __name__ == "__main__":
+    main()
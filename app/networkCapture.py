@@ -0,0 +1,244 @@
+"""
+Reads the bill portals' own JSON (their XHR/fetch responses, recorded through
+the Chrome DevTools protocol) instead of scraping the rendered page, so a
+scrape can finish as soon as the data arrives and gets the whole history
+rather than what happens to be on screen.
+
+The browser has to be started with CDP event logging on (see get_driver),
+which puts every network event in its "performance" log. The portals'
+responses aren't documented (and change), so instead of depending on their
+exact formats, findChargeRecords looks through the JSON for the list of
+objects that looks most like a bill history: ones with a date, and a charge,
+payment, or plain amount.
+"""
+
+import base64
+import json
+import re
+import time
+import typing
+from dataclasses import dataclass
+from datetime import date, datetime
+
+from . import tracing
+
+POLL_SECONDS = 0.25
+# Date formats seen in the portals (besides ISO 8601)
+DATE_FORMATS = ("%m/%d/%Y", "%m/%d/%y", "%b %d, %Y", "%Y%m%d")
+
+
+@dataclass
+class CapturedResponse:
+    url: str
+    status: int
+    body: typing.Any
+
+
+class NetworkCapture:
+    """
+    Collects the JSON responses (with URLs matching the given pattern) that
+    the browser has received, from its performance log
+    """
+
+    def __init__(self, driver, urlPattern: str):
+        self.driver = driver
+        self.urlPattern = re.compile(urlPattern)
+        # Request ID -> (URL, status) for matching JSON responses whose bodies
+        # haven't finished loading yet
+        self._pending: typing.Dict[str, typing.Tuple[str, int]] = {}
+        self.responses: typing.List[CapturedResponse] = []
+
+    def poll(self) -> typing.List[CapturedResponse]:
+        """
+        Reads the new network events, returning any matching responses that
+        finished loading since the last poll
+        """
+        newResponses = []
+        # (reading the log also clears it)
+        for entry in self.driver.get_log("performance"):
+            message = json.loads(entry["message"])["message"]
+            params = message.get("params", {})
+            if message.get("method") == "Network.responseReceived":
+                response = params["response"]
+                if "json" in response.get("mimeType", "") and self.urlPattern.search(
+                    response["url"]
+                ):
+                    self._pending[params["requestId"]] = (
+                        response["url"],
+                        response["status"],
+                    )
+            elif message.get("method") == "Network.loadingFinished":
+                if params["requestId"] not in self._pending:
+                    continue
+                url, status = self._pending.pop(params["requestId"])
+                body = self._getBody(params["requestId"])
+                if body is not None:
+                    newResponses.append(CapturedResponse(url, status, body))
+        self.responses += newResponses
+        return newResponses
+
+    def _getBody(self, requestId: str) -> typing.Any:
+        try:
+            result = self.driver.execute_cdp_cmd(
+                "Network.getResponseBody", {"requestId": requestId}
+            )
+        except Exception as e:
+            # e.g. the browser already dropped it from its buffer
+            print(f"Couldn't get the body of response {requestId} ({e!r})")
+            return None
+        text = result["body"]
+        if result.get("base64Encoded"):
+            text = base64.b64decode(text).decode()
+        try:
+            return json.loads(text)
+        except ValueError:
+            return None
+
+    def waitForChargeRecords(
+        self,
+        timeout: float,
+        giveUpWhen: typing.Callable[[], bool] = lambda: False,
+    ) -> typing.Optional[typing.List[typing.Dict[str, typing.Any]]]:
+        """
+        Waits for a matching response that has a bill history in it,
+        returning the charge records from it, or None if none shows up in time
+        (or before giveUpWhen says to stop waiting, e.g. because the page
+        already shows the charges)
+        """
+        with tracing.span("scrape.wait_for_json", pattern=self.urlPattern.pattern):
+            deadline = time.monotonic() + timeout
+            while True:
+                for response in self.poll():
+                    records = findChargeRecords(response.body)
+                    if records:
+                        print(f"Got {len(records)} charges from {response.url}")
+                        return records
+                if time.monotonic() > deadline or giveUpWhen():
+                    return None
+                time.sleep(POLL_SECONDS)
+
+
+def _normalizeKey(key: str) -> str:
+    return re.sub(r"[^a-z]", "", key.lower())
+
+
+def parseDate(value: typing.Any) -> typing.Optional[date]:
+    if not isinstance(value, str) or not value.strip():
+        return None
+    value = value.strip()
+    if re.match(r"\d{4}-\d{2}-\d{2}", value):
+        # ISO 8601, maybe with a time (which we don't need)
+        try:
+            return date.fromisoformat(value[:10])
+        except ValueError:
+            return None
+    for dateFormat in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, dateFormat).date()
+        except ValueError:
+            continue
+    return None
+
+
+def parseCents(value: typing.Any) -> typing.Optional[int]:
+    """Converts a dollar amount (e.g. 12.5, "$1,234.50", "(12.00)") to cents"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return round(value * 100)
+    if not isinstance(value, str):
+        return None
+    text = value.strip().replace("$", "").replace(",", "")
+    isNegative = text.startswith("(") and text.endswith(")")
+    try:
+        cents = round(float(text.strip("()")) * 100)
+    except ValueError:
+        return None
+    return -cents if isNegative else cents
+
+
+T = typing.TypeVar("T")
+
+
+def _findValue(
+    record: dict,
+    includes: typing.Tuple[str, ...],
+    parse: typing.Callable[[typing.Any], typing.Optional[T]],
+    excludes: typing.Tuple[str, ...] = (),
+) -> typing.Optional[T]:
+    """
+    Returns the first value in the record that parses, out of the ones whose
+    keys include any of the given words (and none of the excluded ones)
+    """
+    for key, value in record.items():
+        normalizedKey = _normalizeKey(key)
+        if not any(word in normalizedKey for word in includes):
+            continue
+        if any(word in normalizedKey for word in excludes):
+            continue
+        parsedValue = parse(value)
+        if parsedValue is not None:
+            return parsedValue
+    return None
+
+
+def _parseText(value: typing.Any) -> typing.Optional[str]:
+    return value if isinstance(value, str) else None
+
+
+def toChargeRecord(record: typing.Any) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """
+    Converts 1 item of a portal's bill history to a RecentCharges record
+    (with an ISO date), or returns None if it doesn't look like one
+    """
+    if not isinstance(record, dict):
+        return None
+    chargeDate = _findValue(record, ("date",), parseDate, ("due",)) or _findValue(
+        record, ("date",), parseDate
+    )
+    if chargeDate is None:
+        return None
+    description = (
+        _findValue(record, ("description", "desc", "type", "name"), _parseText) or ""
+    )
+
+    chargeCents = _findValue(record, ("charge", "billamount", "billed"), parseCents)
+    paymentCents = _findValue(record, ("payment", "paid"), parseCents)
+    if chargeCents is None and paymentCents is None:
+        # Just 1 amount, which is a payment if it's negative or says so
+        amountCents = _findValue(record, ("amount", "total"), parseCents)
+        if amountCents is None:
+            return None
+        isPayment = amountCents < 0 or "payment" in description.lower()
+        chargeCents = 0 if isPayment else amountCents
+        paymentCents = abs(amountCents) if isPayment else 0
+    return {
+        "date": chargeDate.isoformat(),
+        "description": description,
+        "charge_cents": chargeCents or 0,
+        "payment_cents": abs(paymentCents or 0),
+        "balance_cents": _findValue(record, ("balance",), parseCents) or 0,
+    }
+
+
+def findChargeRecords(body: typing.Any) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Returns the charge records from the longest list in the given JSON that's
+    entirely (or almost entirely) bill history items
+    """
+    best: typing.List[typing.Dict[str, typing.Any]] = []
+    toVisit = [body]
+    while toVisit:
+        value = toVisit.pop()
+        if isinstance(value, dict):
+            toVisit += value.values()
+        elif isinstance(value, list):
+            toVisit += value
+            records = [toChargeRecord(item) for item in value]
+            chargeRecords = [record for record in records if record]
+            # (allowing for the odd summary row)
+            if len(chargeRecords) > len(best) and len(chargeRecords) >= 0.8 * len(
+                value
+            ):
+                best = chargeRecords
+    return best
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Runs the monthly rent job as a one-shot batch task (e.g. a Cloud Run job on a
+schedule) instead of through the server's /reminder endpoint:
+
+    python -m app.pipeline run-month [--month 2025-03] [--dry-run] [--group-id ID]
+
+The job goes through these stages in order, timing each one:
+1. create-month: adds the month to each household's sheet
+2. scrape: gets each provider's recent charges (if any household's bills are
+   scraped)
+3. compute: works out the month's rent and utilities from them
+4. write: sets them in the sheets of the households whose bills are scraped
+   (unless the sheets already have them)
+5. announce: posts the rent reminder, and what changed and the amounts owed
+
+Each stage's results (saved after every provider/household, too) go in a local
+checkpoint file for the month (under RENTBOT_PIPELINE_CHECKPOINT_DIR), so
+rerunning a failed job picks up where it stopped instead of scraping (or
+posting) everything again. A run with --group-id gets its own checkpoint, so
+it doesn't mark the month done for the other households. With --dry-run, nothing is written to the sheets,
+posted, or checkpointed; the messages are printed instead.
+"""
+
+import argparse
+import dataclasses
+import json
+import os
+import sys
+import time
+import traceback
+import typing
+from datetime import date, datetime, timedelta
+
+from . import main as rentbot
+from . import tracing
+from .getRents import (
+    PROVIDERS,
+    MonthlyCharges,
+    RecentCharges,
+    fetch_provider_charges,
+    get_monthly_charges,
+    recent_charges_from_records,
+    recent_charges_to_records,
+    retry_func,
+)
+from .households import Household
+
+CHECKPOINT_DIR = os.environ.get("RENTBOT_PIPELINE_CHECKPOINT_DIR", "rentbot-pipeline")
+STAGES = ["create-month", "scrape", "compute", "write", "announce"]
+# (their sheet writes have to land before they count as done)
+STAGES_THAT_WRITE = {"create-month", "write"}
+
+
+class Checkpoint:
+    """Each stage's results so far, and whether it's done"""
+
+    def __init__(self, path: str, isReadOnly: bool = False):
+        self.path = path
+        self.isReadOnly = isReadOnly
+        # Stage -> {"isDone": ..., "seconds": ..., "results": {...}}
+        self.stages: typing.Dict[str, dict] = {}
+        try:
+            with open(path) as f:
+                self.stages = json.load(f)["stages"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable checkpoint '{path}' ({e!r})")
+
+    def isDone(self, stage: str) -> bool:
+        return self.stages.get(stage, {}).get("isDone", False)
+
+    def getResults(self, stage: str) -> dict:
+        return self.stages.setdefault(stage, {"isDone": False, "results": {}})[
+            "results"
+        ]
+
+    def complete(self, stage: str, seconds: float):
+        self.stages[stage].update(isDone=True, seconds=seconds)
+        self.save()
+
+    def save(self):
+        if self.isReadOnly:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tempPath = f"{self.path}.tmp"
+        with open(tempPath, "w") as f:
+            json.dump({"stages": self.stages}, f)
+        os.replace(tempPath, self.path)
+
+
+def getCheckpointPath(
+    sheetMonth: datetime, groupId: typing.Optional[str] = None
+) -> str:
+    """
+    Returns where the checkpoint for a run for the given month (and only the
+    given household, if any) goes; each stage is done for the households in
+    the run, so a run for just 1 household gets its own
+    """
+    fileName = f"run-month-{sheetMonth:%Y-%m}"
+    if groupId is not None:
+        fileName += f"-group-{groupId}"
+    return os.path.join(CHECKPOINT_DIR, f"{fileName}.json")
+
+
+def _scrapeProvider(provider: str) -> RecentCharges:
+    return retry_func(lambda: fetch_provider_charges(provider), 3, provider)
+
+
+class MonthPipeline:
+    def __init__(
+        self,
+        households: typing.List[Household],
+        sheetMonth: datetime,
+        billsMonth: date,
+        checkpoint: Checkpoint,
+        isDryRun: bool = False,
+        scrape: typing.Callable[[str], RecentCharges] = _scrapeProvider,
+    ):
+        self.households = households
+        # The month in the sheets, and the month whose bills pay for it
+        self.sheetMonth = sheetMonth
+        self.billsMonth = billsMonth
+        self.checkpoint = checkpoint
+        self.isDryRun = isDryRun
+        self.scrape = scrape
+
+    def _getScrapingHouseholds(self) -> typing.List[Household]:
+        return [household for household in self.households if household.scrapeBills]
+
+    def _createMonth(self, results: dict):
+        for household in self.households:
+            if household.groupId in results:
+                continue
+            with rentbot.SHEET_POOL.checkout(household) as googleSheet:
+                snapshot = googleSheet.getSnapshot()
+                if snapshot.getMonthData(self.sheetMonth) is not None:
+                    results[household.groupId] = "existed"
+                else:
+                    if not self.isDryRun:
+                        googleSheet.createNewMonth(self.sheetMonth)
+                    results[household.groupId] = "created"
+            self.checkpoint.save()
+
+    def _scrape(self, results: dict):
+        if not self._getScrapingHouseholds():
+            print("No household's bills are scraped")
+            return
+        for provider in PROVIDERS:
+            if provider in results:
+                continue
+            results[provider] = recent_charges_to_records(self.scrape(provider))
+            self.checkpoint.save()
+
+    def _compute(self, results: dict):
+        scraped = self.checkpoint.getResults("scrape")
+        if not scraped:
+            return
+        charges = get_monthly_charges(
+            recent_charges_from_records(scraped["apartment"]),
+            recent_charges_from_records(scraped["electricity"]),
+            recent_charges_from_records(scraped["internet"]),
+            self.billsMonth,
+        )
+        print(f"Charges for {self.billsMonth:%B %Y}: {charges}")
+        results.update(dataclasses.asdict(charges))
+
+    def _write(self, results: dict):
+        computed = self.checkpoint.getResults("compute")
+        if not computed:
+            return
+        charges = MonthlyCharges(**computed)
+        for household in self._getScrapingHouseholds():
+            if household.groupId in results:
+                continue
+            with rentbot.SHEET_POOL.checkout(household) as googleSheet:
+                results[household.groupId] = rentbot.writeScrapedCharges(
+                    googleSheet, charges, self.sheetMonth, self.isDryRun
+                )
+            self.checkpoint.save()
+
+    def _flushJournals(self):
+        """
+        Writes any sheet updates that are still only journaled (the job's
+        disk, and with it the journal, may be gone once it exits)
+        """
+        for household in self.households:
+            with rentbot.SHEET_POOL.checkout(household) as googleSheet:
+                googleSheet.flushJournal()
+
+    def _send(self, household: Household, message: str):
+        if self.isDryRun:
+            print(f"Would post to {household.botId}:\n{message}\n")
+        else:
+            rentbot.sendBotMessage(household.botId, message)
+
+    def _announce(self, results: dict):
+        written = self.checkpoint.getResults("write")
+        for household in self.households:
+            if household.groupId in results:
+                continue
+            messages = [
+                rentbot.REMINDER_MESSAGE.format(landlordName=household.landlordName)
+            ]
+            changes = written.get(household.groupId)
+            if changes:
+                messages.append(
+                    rentbot.getChargesChangedMessage(self.sheetMonth, changes)
+                )
+                with rentbot.SHEET_POOL.checkout(household) as googleSheet:
+                    amountsOwed = googleSheet.getAmountsOwed()
+                messages.append(
+                    rentbot.ShowCommand().getRentsDueMessage(amountsOwed, household)
+                )
+            for message in messages:
+                self._send(household, message)
+            results[household.groupId] = len(messages)
+            self.checkpoint.save()
+
+    def run(self) -> typing.Dict[str, float]:
+        """
+        Runs the stages that aren't done yet, returning how long each took (in
+        seconds)
+        """
+        stageFuncs = {
+            "create-month": self._createMonth,
+            "scrape": self._scrape,
+            "compute": self._compute,
+            "write": self._write,
+            "announce": self._announce,
+        }
+        timings = {}
+        with tracing.startTrace("job.runMonth", month=f"{self.sheetMonth:%Y-%m}"):
+            for stage in STAGES:
+                if self.checkpoint.isDone(stage):
+                    print(f"{stage}: already done")
+                    continue
+                start = time.perf_counter()
+                with tracing.span(f"pipeline.{stage}"):
+                    stageFuncs[stage](self.checkpoint.getResults(stage))
+                    if stage in STAGES_THAT_WRITE and not self.isDryRun:
+                        self._flushJournals()
+                timings[stage] = time.perf_counter() - start
+                self.checkpoint.complete(stage, timings[stage])
+                print(f"{stage}: done in {timings[stage]:.2f}s")
+        return timings
+
+
+def parseMonth(text: str) -> datetime:
+    return datetime.strptime(text, "%Y-%m")
+
+
+def getRunMonths(
+    month: typing.Optional[datetime] = None,
+) -> typing.Tuple[datetime, date]:
+    """
+    Returns the sheet month to run for (by default, the one /reminder uses),
+    and the month whose bills pay for it (the month after, like when the
+    reminder goes out on the 1st)
+    """
+    if month is None:
+        sheetMonth, billsMonth = rentbot.getDefaultTimeForCommand(), date.today()
+    else:
+        sheetMonth = month
+        billsMonth = (month.replace(day=28) + timedelta(days=4)).date()
+    sheetMonth = datetime(sheetMonth.year, sheetMonth.month, 1)
+    return sheetMonth, billsMonth.replace(day=1)
+
+
+def runMonth(args: argparse.Namespace) -> int:
+    if args.group_id is None:
+        households = rentbot.HOUSEHOLDS.getAllHouseholds()
+    else:
+        household = rentbot.HOUSEHOLDS.getHousehold(args.group_id)
+        if household is None:
+            print(f'Unknown group "{args.group_id}"')
+            return 1
+        households = [household]
+
+    sheetMonth, billsMonth = getRunMonths(args.month)
+    checkpoint = Checkpoint(
+        getCheckpointPath(sheetMonth, args.group_id), isReadOnly=args.dry_run
+    )
+    pipeline = MonthPipeline(
+        households, sheetMonth, billsMonth, checkpoint, isDryRun=args.dry_run
+    )
+    try:
+        timings = pipeline.run()
+    except Exception:
+        print(traceback.format_exc())
+        print(f"Failed; run it again to pick up from '{checkpoint.path}'")
+        return 1
+    print(f"Done in {sum(timings.values()):.2f}s")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    runMonthParser = subparsers.add_parser(
+        "run-month",
+        help="create the month, get the bills, set the charges, and post the reminder",
+    )
+    runMonthParser.add_argument(
+        "--month",
+        type=parseMonth,
+        help="the sheet month to run for, as YYYY-MM, using the next month's bills "
+        "(by default, the months /reminder uses)",
+    )
+    runMonthParser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="print what would be written and posted instead of doing it",
+    )
+    runMonthParser.add_argument(
+        "--group-id", help="only run for this household's GroupMe group"
+    )
+    args = parser.parse_args()
+    sys.exit(runMonth(args))
+
+
+if __name__ == "__main__":
+    main()
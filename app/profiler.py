@@ -0,0 +1,220 @@
+"""
+Opt-in profiling for the webhook and the scrape jobs, for slow paths that only
+show up in production.
+
+Profiling is off unless RENTBOT_PROFILE_RATE is set to the fraction of
+requests/jobs to profile (e.g. 0.05), or a webhook request comes with a valid
+X-RentBot-Profile header (see signProfileRequest; needs RENTBOT_PROFILE_SECRET).
+Profiles are written to RENTBOT_PROFILE_DIR (only the newest
+RENTBOT_PROFILE_MAX_FILES are kept) and can be listed/downloaded from
+/debug/profiles, with the same signed X-RentBot-Profile header.
+
+There are 2 kinds of profiles (RENTBOT_PROFILE_MODE):
+- "cprofile" (the default): a cProfile dump (.prof) for e.g. snakeviz or pstats
+- "sampling": wall-clock stack samples, in the "folded" format (.folded) that
+  flamegraph.pl and https://www.speedscope.app read; unlike cProfile, this
+  also shows time spent waiting on the network
+"""
+
+import collections
+import contextlib
+import cProfile
+import functools
+import hashlib
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+import typing
+from datetime import datetime
+
+PROFILE_RATE = float(os.environ.get("RENTBOT_PROFILE_RATE", "0"))
+PROFILE_MODE = os.environ.get("RENTBOT_PROFILE_MODE", "cprofile")
+PROFILE_DIR = os.environ.get("RENTBOT_PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.environ.get("RENTBOT_PROFILE_MAX_FILES", "50"))
+PROFILE_SECRET = os.environ.get("RENTBOT_PROFILE_SECRET", "")
+# How long a signed profiling header stays valid
+SIGNATURE_MAX_AGE_SECONDS = 300
+SAMPLE_INTERVAL_SECONDS = 0.005
+
+
+def signProfileRequest(secret: str, timestamp: typing.Optional[int] = None) -> str:
+    """
+    Returns an X-RentBot-Profile header value that asks the server to profile
+    the request, e.g.
+
+    curl -H "X-RentBot-Profile: $(python -c 'from app.profiler import *; print(signProfileRequest("<secret>"))')" ...
+    """
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(
+        secret.encode(), str(timestamp).encode(), hashlib.sha256
+    ).hexdigest()
+    return f"{timestamp}.{signature}"
+
+
+class StackSampler:
+    """
+    Samples the given thread's call stack every few milliseconds from a
+    background thread, counting how often each stack shows up
+    """
+
+    def __init__(self, threadId: int, intervalSeconds: float = SAMPLE_INTERVAL_SECONDS):
+        self.threadId = threadId
+        self.intervalSeconds = intervalSeconds
+        self.stackCounts: typing.Counter[str] = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.intervalSeconds):
+            frame = sys._current_frames().get(self.threadId)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stackCounts[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def toFolded(self) -> str:
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.stackCounts.items()
+        )
+
+
+class Profiler:
+    def __init__(
+        self,
+        directory: str = PROFILE_DIR,
+        sampleRate: float = PROFILE_RATE,
+        mode: str = PROFILE_MODE,
+        maxFiles: int = PROFILE_MAX_FILES,
+        secret: str = PROFILE_SECRET,
+    ):
+        if mode not in ("cprofile", "sampling"):
+            raise ValueError(f'Unknown profiling mode "{mode}"')
+        self.directory = directory
+        self.sampleRate = sampleRate
+        self.mode = mode
+        self.maxFiles = maxFiles
+        self.secret = secret
+        self._lock = threading.Lock()
+
+    def isValidSignature(self, headerValue: typing.Optional[str]) -> bool:
+        """Whether the X-RentBot-Profile header was signed with our secret"""
+        if not self.secret or not headerValue or "." not in headerValue:
+            return False
+        timestampStr, signature = headerValue.split(".", 1)
+        try:
+            timestamp = int(timestampStr)
+        except ValueError:
+            return False
+        if abs(time.time() - timestamp) > SIGNATURE_MAX_AGE_SECONDS:
+            return False
+        expected = signProfileRequest(self.secret, timestamp).split(".", 1)[1]
+        return hmac.compare_digest(signature, expected)
+
+    def shouldProfile(self, force: bool = False) -> bool:
+        return force or random.random() < self.sampleRate
+
+    @contextlib.contextmanager
+    def profile(self, name: str, force: bool = False):
+        """
+        Profiles the "with" block if it's sampled (or forced), saving the
+        profile under the given name
+        """
+        if not self.shouldProfile(force):
+            yield
+            return
+
+        if self.mode == "sampling":
+            sampler = StackSampler(threading.get_ident())
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                self._save(name, "folded", sampler.toFolded().encode())
+            return
+
+        cProfiler = cProfile.Profile()
+        try:
+            cProfiler.enable()
+        except ValueError:
+            # Only one cProfile can run at a time (in Python 3.12+), so skip
+            # this one if another request is already being profiled
+            yield
+            return
+        try:
+            yield
+        finally:
+            cProfiler.disable()
+            path = self._getNewPath(name, "prof")
+            cProfiler.dump_stats(path)
+            self._rotate()
+
+    def profiled(self, name: str) -> typing.Callable:
+        """Decorator that profiles a sample of calls to the function"""
+
+        def decorator(func: typing.Callable) -> typing.Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.profile(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def _getNewPath(self, name: str, extension: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        return os.path.join(self.directory, f"{timestamp}-{name}.{extension}")
+
+    def _save(self, name: str, extension: str, data: bytes):
+        with open(self._getNewPath(name, extension), "wb") as f:
+            f.write(data)
+        self._rotate()
+
+    def _rotate(self):
+        """Deletes the oldest profiles beyond maxFiles"""
+        with self._lock:
+            for fileName in self.listProfiles()[self.maxFiles :]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.directory, fileName))
+
+    def listProfiles(self) -> typing.List[str]:
+        """Returns the saved profiles' file names, newest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            (
+                fileName
+                for fileName in os.listdir(self.directory)
+                if fileName.endswith((".prof", ".folded"))
+            ),
+            reverse=True,
+        )
+
+    def getProfilePath(self, fileName: str) -> typing.Optional[str]:
+        """
+        Returns the path to the given saved profile, or None if there's no
+        such profile
+        """
+        if fileName not in self.listProfiles():
+            return None
+        return os.path.join(self.directory, fileName)
+
+
+PROFILER = Profiler()
@@ -0,0 +1,156 @@
+"""
+Runs bill scrapes in a supervised subprocess, so a hung portal or a runaway
+Chrome can't take the web server down with it.
+
+Each scrape runs in its own session (and so its own process group) along with
+whatever chromedriver/Chrome processes it starts, and the supervisor
+- kills the whole session if it isn't done by the deadline
+  (RENTBOT_SCRAPE_DEADLINE_SECONDS)
+- kills the whole session if all its processes together use more than
+  RENTBOT_SCRAPE_MAX_RSS_MB of memory
+- always kills anything left in the session afterwards (e.g. a Chrome that
+  didn't quit)
+
+The scrape's result comes back as JSON (written to a temp file, since the
+scrapers print their progress to stdout).
+
+    records = runSandboxed("app.getRents:scrape_provider_records", ["internet"])
+"""
+
+import contextlib
+import importlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+from . import tracing
+
+SCRAPE_DEADLINE_SECONDS = float(
+    os.environ.get("RENTBOT_SCRAPE_DEADLINE_SECONDS", "300")
+)
+SCRAPE_MAX_RSS_BYTES = (
+    int(os.environ.get("RENTBOT_SCRAPE_MAX_RSS_MB", "1536")) * 1024 * 1024
+)
+POLL_SECONDS = 0.25
+# So "python -m app.scrapeSandbox" works wherever the server was started from
+PACKAGE_PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ScrapeSandboxError(Exception):
+    pass
+
+
+def _getSessionPids(sessionId: int) -> typing.List[int]:
+    """
+    Returns the processes in the given session (only on Linux; elsewhere,
+    there's no /proc to look in, so this is always empty)
+    """
+    pids = []
+    with contextlib.suppress(OSError):
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    stat = f.read()
+            except OSError:
+                # It exited while we were looking
+                continue
+            # The command name (in parentheses) can have spaces, so count the
+            # fields from after it: state, ppid, pgrp, session, ...
+            fields = stat[stat.rfind(")") + 2 :].split()
+            if int(fields[3]) == sessionId:
+                pids.append(int(entry))
+    return pids
+
+
+def _getRssBytes(pids: typing.List[int]) -> int:
+    rssBytes = 0
+    pageSize = os.sysconf("SC_PAGE_SIZE")
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                rssBytes += int(f.read().split()[1]) * pageSize
+        except (OSError, IndexError, ValueError):
+            continue
+    return rssBytes
+
+
+def _killSession(sessionId: int):
+    """Kills every process in the given session (including any stragglers)"""
+    with contextlib.suppress(ProcessLookupError, PermissionError):
+        os.killpg(sessionId, signal.SIGKILL)
+    # Anything that moved to its own process group is still in the session
+    for pid in _getSessionPids(sessionId):
+        with contextlib.suppress(ProcessLookupError, PermissionError):
+            os.kill(pid, signal.SIGKILL)
+
+
+def runSandboxed(
+    target: str,
+    args: typing.List[typing.Any],
+    deadlineSeconds: float = SCRAPE_DEADLINE_SECONDS,
+    maxRssBytes: int = SCRAPE_MAX_RSS_BYTES,
+) -> typing.Any:
+    """
+    Calls the given function ("module:function") with the given (JSON-able)
+    args in a sandboxed subprocess, returning its (JSON-able) result, or
+    raising ScrapeSandboxError if it failed or went over its limits
+    """
+    with tracing.span("scrape.sandbox", target=target) as span:
+        fd, outputPath = tempfile.mkstemp(prefix="rentbot-scrape-", suffix=".json")
+        os.close(fd)
+        process = subprocess.Popen(
+            [sys.executable, "-m", "app.scrapeSandbox", target, json.dumps(args)]
+            + [outputPath],
+            cwd=PACKAGE_PARENT_DIR,
+            start_new_session=True,
+        )
+        deadline = time.monotonic() + deadlineSeconds
+        peakRssBytes = 0
+        try:
+            while True:
+                try:
+                    returnCode = process.wait(timeout=POLL_SECONDS)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if time.monotonic() > deadline:
+                    raise ScrapeSandboxError(
+                        f"{target} didn't finish within {deadlineSeconds}s"
+                    )
+                rssBytes = _getRssBytes(_getSessionPids(process.pid))
+                peakRssBytes = max(peakRssBytes, rssBytes)
+                if rssBytes > maxRssBytes:
+                    raise ScrapeSandboxError(
+                        f"{target} used {rssBytes // 2**20}MB of memory "
+                        f"(the limit is {maxRssBytes // 2**20}MB)"
+                    )
+            if returnCode != 0:
+                raise ScrapeSandboxError(f"{target} exited with code {returnCode}")
+            with open(outputPath) as f:
+                return json.load(f)
+        finally:
+            _killSession(process.pid)
+            process.wait()
+            span.setAttribute("peakRssBytes", peakRssBytes)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(outputPath)
+
+
+def main():
+    target, argsJson, outputPath = sys.argv[1:4]
+    moduleName, functionName = target.split(":")
+    func = getattr(importlib.import_module(moduleName), functionName)
+    result = func(*json.loads(argsJson))
+    with open(outputPath, "w") as f:
+        json.dump(result, f)
+
+
+if __name__ == "__main__":
+    main()
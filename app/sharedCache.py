@@ -0,0 +1,346 @@
+"""
+A cache shared by every RentBot instance (e.g. when Cloud Run scales up), so
+only 1 of them has to download the sheet, rebuild the amounts owed, or scrape
+the bills, and the rest just read the result.
+
+Set RENTBOT_SHARED_CACHE_URL to a Redis server (redis://host:port[/db]) to use
+it; without it, each instance only has its own caches. Keys are versioned:
+they start with CACHE_KEY_VERSION (bumped whenever what's stored changes), and
+anything derived from the sheet includes the sheet's last-modified time, so a
+stale entry is never read, just left to expire. Every write to the sheet is
+also published to the sheet's invalidation channel, so the other instances
+load the new amounts owed from the cache instead of rebuilding them.
+
+The shared cache is only ever an optimization: if Redis is down, requests to
+it are logged and treated as misses.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import typing
+from urllib.parse import urlparse
+
+from . import metrics
+
+SHARED_CACHE_URL = os.environ.get("RENTBOT_SHARED_CACHE_URL", "")
+# How long entries are kept (they're never read once the sheet changes, so
+# this just bounds how much is left lying around)
+SHARED_CACHE_TTL_SECONDS = int(
+    os.environ.get("RENTBOT_SHARED_CACHE_TTL_SECONDS", "86400")
+)
+SHARED_CACHE_TIMEOUT_SECONDS = 1.0
+CACHE_KEY_VERSION = 1
+
+
+class SharedCacheError(Exception):
+    pass
+
+
+def getSheetKey(sheetsUrl: str) -> str:
+    """Returns a short key for the given sheet, to build its cache keys from"""
+    return hashlib.sha1(sheetsUrl.encode()).hexdigest()[:16]
+
+
+def makeKey(*parts: typing.Any) -> str:
+    return ":".join(
+        ["rentbot", f"v{CACHE_KEY_VERSION}"] + [str(part) for part in parts]
+    )
+
+
+class SharedCache:
+    """
+    The shared cache interface: string values by key, and publish/subscribe
+    messages by channel
+    """
+
+    def get(self, key: str) -> typing.Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttlSeconds: int = SHARED_CACHE_TTL_SECONDS):
+        raise NotImplementedError
+
+    def publish(self, channel: str, message: str):
+        raise NotImplementedError
+
+    def subscribe(self, channel: str, callback: typing.Callable[[str], None]):
+        """Calls the callback (from another thread) with each message sent"""
+        raise NotImplementedError
+
+    def unsubscribe(self, channel: str, callback: typing.Callable[[str], None]):
+        """Stops calling the given (subscribed) callback"""
+        raise NotImplementedError
+
+    def getJson(self, key: str) -> typing.Any:
+        value = self.get(key)
+        return None if value is None else json.loads(value)
+
+    def setJson(
+        self, key: str, value: typing.Any, ttlSeconds: int = SHARED_CACHE_TTL_SECONDS
+    ):
+        self.set(key, json.dumps(value, separators=(",", ":")), ttlSeconds)
+
+
+class MemorySharedCache(SharedCache):
+    """
+    A shared cache that's only shared within this process (for tests, and
+    like RENTBOT_GSHEETS_BACKEND=memory, for trying things out locally)
+    """
+
+    def __init__(self, clock: typing.Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Key -> (value, when it expires)
+        self._values: typing.Dict[str, typing.Tuple[str, float]] = {}
+        self._subscribers: typing.Dict[str, typing.List[typing.Callable]] = {}
+
+    def get(self, key: str) -> typing.Optional[str]:
+        with self._lock:
+            value, expiresAt = self._values.get(key, (None, 0.0))
+            if value is None or expiresAt <= self._clock():
+                self._values.pop(key, None)
+                metrics.SHARED_CACHE_REQUESTS.inc(operation="get", outcome="miss")
+                return None
+        metrics.SHARED_CACHE_REQUESTS.inc(operation="get", outcome="hit")
+        return value
+
+    def set(self, key: str, value: str, ttlSeconds: int = SHARED_CACHE_TTL_SECONDS):
+        with self._lock:
+            self._values[key] = (value, self._clock() + ttlSeconds)
+        metrics.SHARED_CACHE_REQUESTS.inc(operation="set", outcome="ok")
+
+    def publish(self, channel: str, message: str):
+        with self._lock:
+            callbacks = list(self._subscribers.get(channel, []))
+        metrics.SHARED_CACHE_REQUESTS.inc(operation="publish", outcome="ok")
+        for callback in callbacks:
+            callback(message)
+
+    def subscribe(self, channel: str, callback: typing.Callable[[str], None]):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+    def unsubscribe(self, channel: str, callback: typing.Callable[[str], None]):
+        with self._lock:
+            callbacks = self._subscribers.get(channel, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._subscribers.pop(channel, None)
+
+
+def _encodeCommand(*args: typing.Union[str, int, bytes]) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+    return b"".join(parts)
+
+
+def _readReply(reader: typing.BinaryIO) -> typing.Any:
+    """Reads 1 reply in the Redis protocol (RESP2) from the given stream"""
+    line = reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise SharedCacheError("Connection closed")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body.decode()
+    if kind == b"-":
+        raise SharedCacheError(body.decode())
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise SharedCacheError("Connection closed")
+        return data[:-2]
+    if kind == b"*":
+        length = int(body)
+        if length < 0:
+            return None
+        return [_readReply(reader) for _ in range(length)]
+    raise SharedCacheError(f"Unexpected reply {line!r}")
+
+
+class _RedisConnection:
+    def __init__(
+        self, host: str, port: int, db: int, timeoutSeconds: typing.Optional[float]
+    ):
+        self._socket = socket.create_connection((host, port), timeout=timeoutSeconds)
+        self._reader = self._socket.makefile("rb")
+        if db:
+            self.command("SELECT", db)
+
+    def send(self, *args: typing.Union[str, int, bytes]):
+        self._socket.sendall(_encodeCommand(*args))
+
+    def readReply(self) -> typing.Any:
+        return _readReply(self._reader)
+
+    def command(self, *args: typing.Union[str, int, bytes]) -> typing.Any:
+        self.send(*args)
+        return self.readReply()
+
+    def close(self):
+        try:
+            self._reader.close()
+            self._socket.close()
+        except OSError:
+            pass
+
+
+class RedisSharedCache(SharedCache):
+    """
+    A shared cache on a Redis server (or anything else that speaks its
+    protocol), with 1 connection for commands and, once anything subscribes,
+    1 more for receiving messages
+    """
+
+    def __init__(
+        self,
+        url: str,
+        timeoutSeconds: float = SHARED_CACHE_TIMEOUT_SECONDS,
+        reconnectSeconds: float = 5.0,
+    ):
+        parsedUrl = urlparse(url)
+        if parsedUrl.scheme != "redis":
+            raise ValueError(f'Unsupported shared cache URL "{url}"')
+        self.host = parsedUrl.hostname or "localhost"
+        self.port = parsedUrl.port or 6379
+        self.db = int(parsedUrl.path.lstrip("/") or 0)
+        self.timeoutSeconds = timeoutSeconds
+        self.reconnectSeconds = reconnectSeconds
+        self._lock = threading.Lock()
+        self._connection: typing.Optional[_RedisConnection] = None
+        self._subscribeLock = threading.Lock()
+        self._callbacks: typing.Dict[str, typing.List[typing.Callable]] = {}
+        self._subscriber: typing.Optional[_RedisConnection] = None
+        self._subscriberThread: typing.Optional[threading.Thread] = None
+
+    def _command(
+        self, operation: str, *args: typing.Union[str, int, bytes]
+    ) -> typing.Any:
+        """
+        Runs the given command, returning its reply, or raising
+        SharedCacheError if it failed (after logging it and counting it)
+        """
+        with self._lock:
+            try:
+                if self._connection is None:
+                    self._connection = _RedisConnection(
+                        self.host, self.port, self.db, self.timeoutSeconds
+                    )
+                return self._connection.command(*args)
+            except (OSError, SharedCacheError) as e:
+                # Start over with a new connection next time, since this one
+                # may be in the middle of a reply
+                if self._connection:
+                    self._connection.close()
+                    self._connection = None
+                metrics.SHARED_CACHE_REQUESTS.inc(operation=operation, outcome="error")
+                print(f"Shared cache {operation} failed ({e!r})")
+                raise SharedCacheError(str(e)) from e
+
+    def get(self, key: str) -> typing.Optional[str]:
+        try:
+            value = self._command("get", "GET", key)
+        except SharedCacheError:
+            return None
+        outcome = "miss" if value is None else "hit"
+        metrics.SHARED_CACHE_REQUESTS.inc(operation="get", outcome=outcome)
+        return None if value is None else value.decode()
+
+    def set(self, key: str, value: str, ttlSeconds: int = SHARED_CACHE_TTL_SECONDS):
+        try:
+            self._command("set", "SET", key, value, "EX", ttlSeconds)
+        except SharedCacheError:
+            return
+        metrics.SHARED_CACHE_REQUESTS.inc(operation="set", outcome="ok")
+
+    def publish(self, channel: str, message: str):
+        try:
+            self._command("publish", "PUBLISH", channel, message)
+        except SharedCacheError:
+            return
+        metrics.SHARED_CACHE_REQUESTS.inc(operation="publish", outcome="ok")
+
+    def subscribe(self, channel: str, callback: typing.Callable[[str], None]):
+        with self._subscribeLock:
+            isNewChannel = channel not in self._callbacks
+            self._callbacks.setdefault(channel, []).append(callback)
+            if self._subscriberThread is None:
+                self._subscriberThread = threading.Thread(
+                    target=self._receiveMessages, daemon=True
+                )
+                self._subscriberThread.start()
+            elif isNewChannel and self._subscriber:
+                try:
+                    self._subscriber.send("SUBSCRIBE", channel)
+                except OSError:
+                    # The receiving thread will resubscribe when it reconnects
+                    pass
+
+    def unsubscribe(self, channel: str, callback: typing.Callable[[str], None]):
+        with self._subscribeLock:
+            callbacks = self._callbacks.get(channel, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if callbacks or channel not in self._callbacks:
+                return
+            del self._callbacks[channel]
+            if self._subscriber:
+                try:
+                    self._subscriber.send("UNSUBSCRIBE", channel)
+                except OSError:
+                    # (it won't be resubscribed to when the receiving
+                    # thread reconnects, either)
+                    pass
+
+    def _receiveMessages(self):
+        """Receives published messages (reconnecting as needed) forever"""
+        while True:
+            try:
+                with self._subscribeLock:
+                    # Blocks waiting for messages, so no timeout
+                    self._subscriber = _RedisConnection(
+                        self.host, self.port, self.db, None
+                    )
+                    if self._callbacks:
+                        self._subscriber.send("SUBSCRIBE", *self._callbacks)
+                while True:
+                    reply = self._subscriber.readReply()
+                    if reply[0] != b"message":
+                        continue
+                    channel, message = reply[1].decode(), reply[2].decode()
+                    with self._subscribeLock:
+                        callbacks = list(self._callbacks.get(channel, []))
+                    for callback in callbacks:
+                        try:
+                            callback(message)
+                        except Exception as e:
+                            print(f"Shared cache message handler failed ({e!r})")
+            except (OSError, SharedCacheError) as e:
+                print(f"Lost the shared cache subscription; reconnecting ({e!r})")
+                with self._subscribeLock:
+                    if self._subscriber:
+                        self._subscriber.close()
+                        self._subscriber = None
+                time.sleep(self.reconnectSeconds)
+
+
+def createSharedCache(url: str = SHARED_CACHE_URL) -> typing.Optional[SharedCache]:
+    """
+    Returns the shared cache at the given URL ("memory" for an in-process
+    one), or None if there isn't one
+    """
+    if not url:
+        return None
+    if url == "memory":
+        return MemorySharedCache()
+    return RedisSharedCache(url)
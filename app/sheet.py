@@ -1,20 +1,79 @@
+import copy
 import enum
 import json
 import os
+import threading
 import typing
+import weakref
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import gspread
+from gspread.utils import ValueRenderOption
+
+from . import metrics, tracing
+from .coalescing import SingleFlight
+from .fakeSheet import FakeConnection
+from .journal import JournalReplayer, SheetJournal, applyUpdates
+from .ledger import Ledger
+from .sharedCache import SharedCache, getSheetKey, makeKey
+from .sheetCache import SheetCache
+from .sheetsClient import GROW_ROWS, SheetsClient, SheetsQuota, getLastRow
 
 SHEETS_KEY_PATH = os.environ.get("RENTBOT_GSHEETS_KEY_PATH")
 SHEETS_KEY = os.environ.get("RENTBOT_GSHEETS_KEY")
-SHEETS_URL = os.environ["RENTBOT_GSHEETS_URL"]
-RENTBOT_START_TIME = datetime.fromisoformat(os.environ["RENTBOT_START_TIME"])
+# The sheet and first month to use if they aren't given to GoogleSheet (i.e.
+# for a single-household deployment; see households.py)
+SHEETS_URL = os.environ.get("RENTBOT_GSHEETS_URL", "")
+# "google" (the default) or "memory" to use an in-memory fake sheet instead
+# (see fakeSheet.py)
+SHEETS_BACKEND = os.environ.get("RENTBOT_GSHEETS_BACKEND", "google")
+RENTBOT_START_TIME = (
+    datetime.fromisoformat(os.environ["RENTBOT_START_TIME"])
+    if os.environ.get("RENTBOT_START_TIME")
+    else None
+)
+# Where sheet updates are journaled until Google accepts them (see journal.py);
+# set to "" to turn journaling off. This should be on a persistent volume, or
+# updates made during an outage are lost if the server restarts.
+JOURNAL_PATH = os.environ.get("RENTBOT_JOURNAL_PATH", "rentbot-journal.jsonl")
+# Where a copy of the sheet is saved for quick restarts (see sheetCache.py);
+# set to "" to turn this off. Like the journal, it should be on a persistent
+# volume.
+SHEET_CACHE_PATH = os.environ.get(
+    "RENTBOT_SHEET_CACHE_PATH", "rentbot-sheet-cache.json"
+)
+
+# Written to cell A1 (with the version in B1) on sheets newer than the original
+# layout, so we know how to read them
+FORMAT_MARKER = "RentBot Sheet Format"
+ARCHIVE_TITLE_PREFIX = "RentBot Archive"
+# Cells are read as their underlying values (numbers as numbers, checkboxes and
+# booleans as bools) rather than as displayed, so they don't depend on the
+# sheet's number formats or locale
+VALUE_RENDER_OPTION = ValueRenderOption.unformatted
+# Day 0 of the sheet's date serial numbers (what a date cell is read as)
+SHEETS_EPOCH = datetime(1899, 12, 30)
+
+
+def connectToGoogle() -> gspread.Client:
+    """
+    Returns a Google Sheets client authenticated with our service account
+    (which can open any number of sheets shared with it)
+    """
+    if SHEETS_KEY:
+        key = json.loads(SHEETS_KEY)
+        connection = gspread.service_account_from_dict(key)
+        print("Loaded connection from dict")
+    else:
+        connection = gspread.service_account(filename=SHEETS_KEY_PATH)
+        print(f"Loaded connection from key path '{SHEETS_KEY_PATH}'")
+    return connection
 
 
 @dataclass
 class MonthlyTenant:
+    __slots__ = ("name", "weeksStayed", "isPaid")
     name: str
     weeksStayed: float
     isPaid: bool
@@ -22,12 +81,25 @@ class MonthlyTenant:
 
 @dataclass
 class MonthData:
+    __slots__ = ("year", "month", "totalRent", "totalUtility", "tenants")
     year: int
     month: int
     totalRent: float
     totalUtility: float
     tenants: typing.Dict[str, MonthlyTenant]
 
+    def copy(self) -> "MonthData":
+        return MonthData(
+            self.year,
+            self.month,
+            self.totalRent,
+            self.totalUtility,
+            {
+                name: MonthlyTenant(t.name, t.weeksStayed, t.isPaid)
+                for name, t in self.tenants.items()
+            },
+        )
+
 
 class StaySchedule(enum.Enum):
     """The type of tenants a given person could be."""
@@ -45,10 +117,14 @@ class StaySchedule(enum.Enum):
 
 @dataclass
 class CurrentTenant:
+    __slots__ = ("name", "monthsUnpaid", "staySchedule")
     name: str
     monthsUnpaid: typing.List[datetime]
     staySchedule: StaySchedule
 
+    def copy(self) -> "CurrentTenant":
+        return CurrentTenant(self.name, list(self.monthsUnpaid), self.staySchedule)
+
     def initialWeeksStayed(self) -> float:
         if self.staySchedule == StaySchedule.FULLTIME:
             return 4.0
@@ -63,6 +139,15 @@ class MonthNotFoundError(Exception):
     pass
 
 
+class UnwrittenUpdatesError(Exception):
+    """
+    Attempted to re-stack the sheet while the server still had journaled
+    updates for it that haven't been written yet.
+    """
+
+    pass
+
+
 class GoogleSheet:
     """
     Interacts with the Google Sheet where we store audit info for the rent roll
@@ -88,42 +173,379 @@ class GoogleSheet:
     Jake Deerin,    4,              False
     Mac Mathis,     1.5,            True
     ...
+
+    That's the original (v1) layout; new sheets use the more compact v2 layout
+    instead (see SheetLayoutV2), and v1 sheets can be converted with
+    migrateToV2. The format is detected from the sheet whenever it's read.
     """
 
-    def __init__(self):
-        self.START_YEAR = RENTBOT_START_TIME.year
-        self.START_MONTH = RENTBOT_START_TIME.month
+    def __init__(
+        self,
+        connection=None,
+        journalPath: typing.Optional[str] = None,
+        sheetsUrl: typing.Optional[str] = None,
+        startTime: typing.Optional[datetime] = None,
+        cachePath: typing.Optional[str] = None,
+        sharedCache: typing.Optional[SharedCache] = None,
+        quota: typing.Optional[SheetsQuota] = None,
+    ):
+        """
+        Opens the sheet at sheetsUrl (RENTBOT_GSHEETS_URL by default), whose
+        first month is startTime's (RENTBOT_START_TIME's by default); pass a
+        connection (e.g. a FakeConnection, or an already-authenticated
+        gspread client) to use it instead of connecting to Google. Updates are
+        journaled to journalPath (by default RENTBOT_JOURNAL_PATH, but only
+        for the real Google sheet) before being written to the sheet.
+
+        If there's a copy of the sheet saved at cachePath (by default
+        RENTBOT_SHEET_CACHE_PATH, again only for the real Google sheet), it's
+        used instead of downloading the sheet, and checked against the sheet
+        in the background.
+
+        Pass a sharedCache to share downloads of the sheet and the amounts
+        owed with any other instances using the same cache (see
+        sharedCache.py), and a quota to share the Sheets API quota with the
+        other sheets opened with the same connection.
+        """
+        self.sheetsUrl = sheetsUrl or SHEETS_URL
+        startTime = startTime or RENTBOT_START_TIME
+        if not self.sheetsUrl or startTime is None:
+            raise ValueError(
+                "Need a sheet URL and start time (RENTBOT_GSHEETS_URL and RENTBOT_START_TIME)"
+            )
+        self.START_YEAR = startTime.year
+        self.START_MONTH = startTime.month
         self.MAX_USERS = 20
         self.MONTH_BLOCK_SIZE = 25  # allocate 25 rows to each month
 
-        if SHEETS_KEY:
-            key = json.loads(SHEETS_KEY)
-            self._connection = gspread.service_account_from_dict(key)
-            print("Loaded connection from dict")
+        if connection is not None:
+            self._connection = connection
+        elif SHEETS_BACKEND == "memory":
+            self._connection = FakeConnection()
+            print("Using an in-memory sheet")
         else:
-            self._connection = gspread.service_account(filename=SHEETS_KEY_PATH)
-            print(f"Loaded connection from key path '{SHEETS_KEY_PATH}'")
-        self._sheet = self._connection.open_by_url(SHEETS_URL)
-        self._wksheet = self._sheet.sheet1
+            self._connection = connectToGoogle()
+        self._sheet = self._connection.open_by_url(self.sheetsUrl)
+        self._quota = quota or SheetsQuota()
+        self._wksheet = SheetsClient(self._sheet.sheet1, quota=self._quota)
+        self._amountsOwedView: typing.Optional[AmountsOwedView] = None
+        # The last download of the sheet, already parsed
+        self._model: typing.Optional[SheetModel] = None
+        # Concurrent reads of the sheet share 1 API call; each write bumps the
+        # generation, so reads started after it never share an older read
+        self._readFlight = SingleFlight("sheet.read")
+        self._writeGeneration = 0
+        # Archive worksheet title -> the sheet version it was downloaded at,
+        # and its rows (so it's only downloaded again once the sheet changes,
+        # e.g. when archiveSheet.py archives more months)
+        self._archiveRows: typing.Dict[str, typing.Tuple[str, typing.List[list]]] = {}
+        self._sharedCache = sharedCache
+        self._sharedKey = getSheetKey(self.sheetsUrl)
+        self._onSheetChangedCallback: typing.Optional[typing.Callable] = None
+        if sharedCache:
+            # (only weakly referencing the sheet, so it can still be closed)
+            sheetRef = weakref.ref(self)
+
+            def onSheetChanged(sheetVersion: str):
+                googleSheet = sheetRef()
+                if googleSheet:
+                    googleSheet._onSheetChanged(sheetVersion)
+
+            self._onSheetChangedCallback = onSheetChanged
+            sharedCache.subscribe(makeKey("changed", self._sharedKey), onSheetChanged)
+
+        isDefaultSheet = connection is None and SHEETS_BACKEND == "google"
+        if journalPath is None and isDefaultSheet:
+            journalPath = JOURNAL_PATH
+        if cachePath is None and isDefaultSheet:
+            cachePath = SHEET_CACHE_PATH
+        self._cache = SheetCache(cachePath) if cachePath else None
+        # Set once we know the amounts owed we have are up to date (i.e. right
+        # away, unless they came from the cache)
+        self._isRevalidated = threading.Event()
+        self._isRevalidated.set()
+        self._journalReplayer: typing.Optional[JournalReplayer] = None
+        if journalPath:
+            self._journalReplayer = JournalReplayer(
+                SheetJournal(journalPath), self._writeJournaledUpdates
+            )
+            # Catch up on anything journaled before the last restart
+            if not self._journalReplayer.flush():
+                self._journalReplayer.flushInBackground()
 
-        if self._isEmptySheet():
+        if self._loadFromCache():
+            return
+        allRows = self._getAllRows()
+        if len(allRows) == 0:
             print("Empty sheet; initializing...")
             self.initializeNewSheet()
             print("Sheet initialized!")
+            allRows = self._getAllRows()
+        self.formatVersion = self._getLayout(allRows).version
+        print(f"Loaded sheet (format v{self.formatVersion})")
 
     def initializeNewSheet(self):
-        createCurrentTenantsHeader = {
-            "range": "A1:C1",
-            "values": [["Name", "Months Unpaid", "Stay Schedule"]],
-        }
-        sheetUpdates = [createCurrentTenantsHeader]
-        self._wksheet.batch_update(sheetUpdates)
+        self._wksheet.batch_update(SheetLayoutV2.getInitialUpdates())
 
-    def _isEmptySheet(self) -> bool:
-        return len(self._getAllRows()) == 0
+    def _loadFromCache(self) -> bool:
+        """
+        Loads the sheet from the local cache (if there's a usable one) and
+        starts checking it against the real sheet in the background, returning
+        whether it was loaded
+        """
+        if not self._cache or self.hasUnwrittenUpdates():
+            return False
+        cached = self._cache.load()
+        if not cached or cached.get("sheetsUrl") != self.sheetsUrl:
+            return False
+        try:
+            model = SheetModel(self, cached["rows"])
+            if cached["amountsOwed"] is None:
+                # (saved before they were ever needed, so total them up now;
+                # with no sheet version, they get revalidated like any others)
+                view = AmountsOwedView()
+                view.update(SheetSnapshot(self, cached["rows"]))
+            else:
+                view = AmountsOwedView.fromDict(cached["amountsOwed"])
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Ignoring the sheet cache, since it couldn't be parsed ({e!r})")
+            return False
+        self._model = model
+        self.formatVersion = model.layout.version
+        self._amountsOwedView = view
+        self._isRevalidated.clear()
+        threading.Thread(target=self._revalidateCache, daemon=True).start()
+        print(f"Loaded sheet from the cache (format v{self.formatVersion})")
+        return True
+
+    def close(self):
+        """
+        Stops listening for the other instances' changes to the sheet (once
+        it's no longer going to be used)
+        """
+        if self._sharedCache and self._onSheetChangedCallback:
+            self._sharedCache.unsubscribe(
+                makeKey("changed", self._sharedKey), self._onSheetChangedCallback
+            )
+            self._onSheetChangedCallback = None
+
+    def _revalidateCache(self):
+        with tracing.startTrace("job.revalidateSheetCache"):
+            try:
+                # Rebuilds the amounts owed if the sheet's changed since
+                self._getAmountsOwedView(refresh=False)
+                self.formatVersion = self._model.layout.version
+            except Exception as e:
+                print(f"Couldn't check the cached sheet against the real one ({e!r})")
+            finally:
+                self._isRevalidated.set()
+
+    def _saveToCache(self, allRows: typing.List[list]):
+        """
+        Saves the given rows (which should be the current sheet's) and the
+        amounts owed (if we have them) to the cache
+        """
+        if not self._cache:
+            return
+        view = self._amountsOwedView
+        try:
+            self._cache.save(
+                {
+                    "sheetsUrl": self.sheetsUrl,
+                    "rows": allRows,
+                    "amountsOwed": view.toDict() if view else None,
+                }
+            )
+        except OSError as e:
+            print(f"Couldn't save the sheet cache ({e!r})")
+
+    def _getLayout(self, allRows: typing.List[list]) -> "SheetLayout":
+        """
+        Returns the layout for the sheet the given rows came from, based on the
+        format marker at the top of it (v1 sheets don't have one)
+        """
+        if allRows and allRows[0] and allRows[0][0] == FORMAT_MARKER:
+            version = int(allRows[0][1])
+            if version == SheetLayoutV2.version:
+                return SheetLayoutV2(self, allRows)
+            raise ValueError(f"Unknown sheet format version {version}")
+        return SheetLayoutV1(self, allRows)
+
+    def _getArchiveTitle(self, year: int) -> str:
+        return f"{ARCHIVE_TITLE_PREFIX} {year}"
+
+    def _getArchiveWorksheet(
+        self, title: str
+    ) -> typing.Tuple[typing.Optional[SheetsClient], typing.List[list]]:
+        """
+        Returns the given archive worksheet and its rows, or None and the rows
+        of an empty v2 sheet if it doesn't exist yet (see _addArchiveWorksheet)
+        """
+        try:
+            archiveWksheet = SheetsClient(
+                self._sheet.worksheet(title), quota=self._quota
+            )
+        except gspread.exceptions.WorksheetNotFound:
+            return None, applyUpdates([], SheetLayoutV2.getInitialUpdates())
+        return archiveWksheet, archiveWksheet.get_all_values(
+            value_render_option=VALUE_RENDER_OPTION
+        )
+
+    def _addArchiveWorksheet(
+        self, title: str, sheetUpdates: typing.List[dict]
+    ) -> SheetsClient:
+        """
+        Creates the given archive worksheet, with enough rows for the given
+        updates (which should set it up as a v2 sheet) and then some
+        """
+        return SheetsClient(
+            self._sheet.add_worksheet(
+                title, rows=getLastRow(sheetUpdates) + GROW_ROWS, cols=10
+            ),
+            quota=self._quota,
+        )
+
+    def _getArchivedMonthData(self, title: str, time: datetime) -> MonthData:
+        sheetVersion = self._getSheetVersion()
+        cachedVersion, archiveRows = self._archiveRows.get(title, (None, []))
+        if cachedVersion != sheetVersion:
+            _, archiveRows = self._getArchiveWorksheet(title)
+            self._archiveRows[title] = (sheetVersion, archiveRows)
+        return SheetLayoutV2(self, archiveRows).getMonthBlockData(archiveRows, time)
+
+    @tracing.traced("sheet.archivePaidMonths")
+    def archivePaidMonths(self) -> typing.List[typing.Tuple[int, int]]:
+        """
+        Moves the months everyone's paid for to the yearly archive worksheets
+        (see SheetArchiver), returning the (year, month)s that were archived
+        """
+        self.flushJournal()
+        archivedMonths = SheetArchiver(self).archive()
+        self._writeGeneration += 1
+        if archivedMonths:
+            self._amountsOwedView = None
+            self._model = None
+        return archivedMonths
+
+    @tracing.traced("sheet.migrateToV2")
+    def migrateToV2(self, chunkMonths: int = 12):
+        """
+        Converts a v1 sheet to the v2 layout (see SheetMigrator); does nothing
+        if the sheet is already v2
+        """
+        if self.formatVersion == SheetLayoutV2.version:
+            return
+        self.flushJournal()
+        newWorksheet = SheetMigrator(self, chunkMonths).migrate()
+        self._writeGeneration += 1
+        self._wksheet = SheetsClient(newWorksheet, quota=self._quota)
+        self.formatVersion = SheetLayoutV2.version
+        self._amountsOwedView = None
+        self._model = None
+
+    def _getModel(self, allRows: typing.List[list]) -> "SheetModel":
+        """
+        Returns the parsed model of the given rows, reusing the last one if the
+        sheet hasn't changed since (comparing the rows is a lot cheaper than
+        parsing them again)
+        """
+        if self._model is None or self._model.allRows != allRows:
+            self._model = SheetModel(self, allRows)
+        return self._model
+
+    def hasUnwrittenUpdates(self) -> bool:
+        """Whether any journaled updates are still waiting to be written"""
+        return bool(
+            self._journalReplayer and self._journalReplayer.journal.getPending()
+        )
+
+    def _writeJournaledUpdates(
+        self, sheetUpdates: typing.List[dict], maxRetries: typing.Optional[int]
+    ):
+        self._wksheet.batch_update(sheetUpdates, maxRetries=maxRetries)
+
+    def flushJournal(self):
+        """
+        Writes any journaled updates to the sheet now, e.g. for operations that
+        rewrite the sheet's layout (which the journaled updates were made
+        against), or before a one-shot job exits
+        """
+        if self._journalReplayer and not self._journalReplayer.flush():
+            raise RuntimeError("Couldn't write the journaled updates to the sheet")
 
     def _getAllRows(self) -> typing.List[list]:
-        return self._wksheet.get_all_values()
+        return self._readFlight.do(
+            ("getAllRows", self._writeGeneration), self._downloadAllRows
+        )
+
+    def _downloadAllRows(self) -> typing.List[list]:
+        if not self._journalReplayer:
+            return self._downloadSheetRows()
+        # Show updates that haven't made it to the sheet yet as if they had
+        # (checking for them first, in case they're written in the meantime)
+        pending = self._journalReplayer.journal.getPending()
+        allRows = self._downloadSheetRows()
+        for entry in pending:
+            allRows = applyUpdates(allRows, entry.updates)
+        return allRows
+
+    def _downloadSheetRows(self) -> typing.List[list]:
+        """
+        Downloads the sheet's rows, unless another instance already has (this
+        version of them) and shared them
+        """
+        if not self._sharedCache:
+            return self._wksheet.get_all_values(value_render_option=VALUE_RENDER_OPTION)
+        # (checking the version first, so the rows are never newer than it)
+        key = makeKey("rows", self._sharedKey, self._getSheetVersion())
+        allRows = self._sharedCache.getJson(key)
+        if allRows is None:
+            allRows = self._wksheet.get_all_values(
+                value_render_option=VALUE_RENDER_OPTION
+            )
+            self._sharedCache.setJson(key, allRows)
+        return allRows
+
+    def _shareSheet(
+        self, sheetVersion: str, allRows: typing.Optional[typing.List[list]] = None
+    ):
+        """
+        Shares the given version of the sheet's rows (if given) and the amounts
+        owed (if we have them) with the other instances
+        """
+        view = self._amountsOwedView
+        if not self._sharedCache or self.hasUnwrittenUpdates():
+            return
+        if allRows is not None:
+            self._sharedCache.setJson(
+                makeKey("rows", self._sharedKey, sheetVersion), allRows
+            )
+        if view:
+            self._sharedCache.setJson(
+                makeKey("amountsOwed", self._sharedKey, sheetVersion), view.toDict()
+            )
+
+    def _getSharedAmountsOwed(
+        self, sheetVersion: str
+    ) -> typing.Optional["AmountsOwedView"]:
+        if not self._sharedCache or self.hasUnwrittenUpdates():
+            return None
+        data = self._sharedCache.getJson(
+            makeKey("amountsOwed", self._sharedKey, sheetVersion)
+        )
+        return AmountsOwedView.fromDict(data) if data else None
+
+    def _onSheetChanged(self, sheetVersion: str):
+        """
+        Called when another instance writes to the sheet, to pick up the
+        amounts owed it shared instead of rebuilding them
+        """
+        view = self._amountsOwedView
+        if view and view.sheetVersion == sheetVersion:
+            return
+        sharedView = self._getSharedAmountsOwed(sheetVersion)
+        if sharedView:
+            self._amountsOwedView = sharedView
 
     def _getMonthStartRow(self, time: datetime) -> int:
         monthsFromStart = 12 * (time.year - self.START_YEAR) + (
@@ -132,7 +554,11 @@ class GoogleSheet:
         # Need the +1 to allow padding for the initial block of users
         return self.MONTH_BLOCK_SIZE * (monthsFromStart + 1)
 
-    def _parseMonthYearString(self, time: str) -> datetime:
+    def _parseMonthYearString(self, time: typing.Union[str, float]) -> datetime:
+        if isinstance(time, (int, float)):
+            # Someone typed the month in by hand, and the sheet made it a date
+            date = SHEETS_EPOCH + timedelta(days=time)
+            return datetime(year=date.year, month=date.month, day=1)
         timePieces = time.split("/")
         return datetime(year=int(timePieces[1]), month=int(timePieces[0]), day=1)
 
@@ -156,11 +582,17 @@ class GoogleSheet:
         return startRowIndex < len(allRows) and allRows[startRowIndex][0]
 
     @classmethod
-    def _toBool(cls, cellValue: str) -> bool:
+    def _toBool(cls, cellValue: typing.Union[bool, str]) -> bool:
+        if isinstance(cellValue, bool):
+            return cellValue
+        # Sheets written before we stored booleans have "True"/"False" text
         return cellValue.lower() == "true"
 
     @classmethod
-    def _toFloat(cls, cellValue: str) -> float:
+    def _toFloat(cls, cellValue: typing.Union[float, str]) -> float:
+        if isinstance(cellValue, (int, float)):
+            return float(cellValue)
+        # A number that was typed into a text cell (e.g. "1,000.00")
         return float(cellValue.replace(",", ""))
 
     @classmethod
@@ -169,9 +601,9 @@ class GoogleSheet:
     ) -> typing.Dict[str, MonthlyTenant]:
         """Get the tenants from a given month's data rows."""
         tenants = {}
-        for name, weeksStayedStr, paidStr, *_unused in tenantRows:
+        for name, weeksStayed, isPaid, *_unused in tenantRows:
             tenants[name] = MonthlyTenant(
-                name, cls._toFloat(weeksStayedStr), cls._toBool(paidStr)
+                name, cls._toFloat(weeksStayed), cls._toBool(isPaid)
             )
         return tenants
 
@@ -186,22 +618,31 @@ class GoogleSheet:
             return None
 
         startRowIndex = self._getMonthStartRow(time) - 1
-        totalRent = self._toFloat(allRows[startRowIndex + 1][1])
-        totalUtility = self._toFloat(allRows[startRowIndex + 2][1])
+        blockRows = allRows[startRowIndex : startRowIndex + self.MONTH_BLOCK_SIZE]
+        return self._parseMonthBlockRows(blockRows, time)
 
-        tenants = {}
-        tenantRows = self._getSuccessiveDataRows(allRows, startIndex=startRowIndex + 4)
+    def _parseMonthBlockRows(
+        self, blockRows: typing.List[list], time: datetime
+    ) -> MonthData:
+        """
+        Parses a month's block of rows (starting with the "<month/year>" row)
+        """
+        totalRent = self._toFloat(blockRows[1][1])
+        totalUtility = self._toFloat(blockRows[2][1])
+
+        tenantRows = self._getSuccessiveDataRows(blockRows, startIndex=4)
         tenants = self._getTenantsFromMonthRows(tenantRows)
 
         return MonthData(time.year, time.month, totalRent, totalUtility, tenants)
 
-    def _getCurrentTenant(self, row: typing.List[str]) -> CurrentTenant:
+    def _getCurrentTenant(self, row: list) -> CurrentTenant:
         name = row[0]
         monthsUnpaid = []
-        timeStrings = str(row[1]).strip().split(",")
-        for timeStr in timeStrings:
-            if timeStr:
-                monthsUnpaid.append(self._parseMonthYearString(timeStr))
+        # A single month that was typed in by hand may have become a date
+        times = [row[1]] if isinstance(row[1], (int, float)) else row[1].split(",")
+        for time in times:
+            if time != "":
+                monthsUnpaid.append(self._parseMonthYearString(time))
         try:
             staySchedule = StaySchedule(row[2])
         except ValueError:
@@ -214,8 +655,14 @@ class GoogleSheet:
         """
         Gets all the current tenants listed at the beginning of the sheet
         """
+        return self._parseCurrentTenantRows(
+            self._getSuccessiveDataRows(allRows, startIndex=1)
+        )
+
+    def _parseCurrentTenantRows(
+        self, tenantRows: typing.List[list]
+    ) -> typing.Dict[str, CurrentTenant]:
         initialTenants = {}
-        tenantRows = self._getSuccessiveDataRows(allRows, startIndex=1)
         for row in tenantRows:
             tenant = self._getCurrentTenant(row)
             initialTenants[tenant.name] = tenant
@@ -282,8 +729,7 @@ class GoogleSheet:
             monthlyTenantsUpdate = {
                 "range": f"A{startRow + 4}:C{startRow + 3 + len(newData.tenants)}",
                 "values": [
-                    [t.name, t.weeksStayed, str(t.isPaid)]
-                    for t in newData.tenants.values()
+                    [t.name, t.weeksStayed, t.isPaid] for t in newData.tenants.values()
                 ],
             }
 
@@ -301,34 +747,759 @@ class GoogleSheet:
             clearRemainingTenantsUpdate,
         ]
 
-    def _createMonthBlockData(
+    @tracing.traced("sheet.getSnapshot")
+    def getSnapshot(self) -> "SheetSnapshot":
+        """
+        Downloads the sheet into an in-memory snapshot that any number of
+        changes can be made to before writing them back with commitSnapshot
+        """
+        return SheetSnapshot(self, self._getAllRows())
+
+    @tracing.traced("sheet.commitSnapshot")
+    def commitSnapshot(self, snapshot: "SheetSnapshot"):
+        """
+        Writes all the changes made to the given snapshot back to the sheet in
+        a single batch update (does nothing if there weren't any changes)
+
+        If journaling is on, the changes are journaled first and count as
+        committed even if the sheet can't be written to right now; they're
+        retried in the background until it can.
+        """
+        sheetUpdates = snapshot.getSheetUpdates()
+        if not sheetUpdates:
+            return
+        if self._journalReplayer:
+            self._journalReplayer.journal.append(sheetUpdates)
+            # Don't make the command wait on retries; the replayer has those
+            isWritten = self._journalReplayer.flush(maxRetries=0)
+            if not isWritten:
+                self._journalReplayer.flushInBackground()
+        else:
+            self._wksheet.batch_update(sheetUpdates)
+            isWritten = True
+        self._writeGeneration += 1
+
+        if self._amountsOwedView:
+            self._amountsOwedView.update(snapshot)
+        if not isWritten:
+            # The sheet version will change once the journal's flushed, so the
+            # view (and the cache) will just be rebuilt then
+            return
+        allRows = applyUpdates(snapshot.getRows(), sheetUpdates)
+        if self._amountsOwedView or self._sharedCache:
+            sheetVersion = self._getSheetVersion()
+        if self._amountsOwedView:
+            self._amountsOwedView.sheetVersion = sheetVersion
+        self._saveToCache(allRows)
+        if self._sharedCache:
+            # (even without amounts owed to share, the other instances need to
+            # know theirs are out of date)
+            self._shareSheet(sheetVersion, allRows)
+            self._sharedCache.publish(makeKey("changed", self._sharedKey), sheetVersion)
+
+    def _getSheetVersion(self) -> str:
+        """
+        Returns when the sheet was last modified (by us or anyone else), which
+        is a lot cheaper to check than re-downloading the whole sheet
+        """
+        with metrics.SHEETS_REQUEST_SECONDS.time(operation="get_lastUpdateTime"):
+            with tracing.span("sheets.get_lastUpdateTime"):
+                return self._sheet.get_lastUpdateTime()
+
+    @tracing.traced("sheet.rebuildAmountsOwed")
+    def rebuildAmountsOwed(self) -> "AmountsOwedView":
+        """
+        Rebuilds the cached amounts owed from scratch using the current sheet
+        """
+        sheetVersion = self._getSheetVersion()
+        view = AmountsOwedView(sheetVersion)
+        snapshot = self.getSnapshot()
+        view.update(snapshot)
+        self._amountsOwedView = view
+        self._saveToCache(snapshot.getRows())
+        self._shareSheet(sheetVersion)
+        return view
+
+    @tracing.traced("sheet.addTenant")
+    def addTenant(self, tenantName: str, time: datetime):
+        """
+        Adds the given person to the rent roll (overall and for the current
+        month) if they aren't already on it, and if there's enough room
+        """
+        snapshot = self.getSnapshot()
+        snapshot.addTenant(tenantName, time)
+        self.commitSnapshot(snapshot)
+
+    @tracing.traced("sheet.removeTenant")
+    def removeTenant(self, tenantName: str, time: datetime):
+        """
+        Removes the given person from the rent roll
+        """
+        snapshot = self.getSnapshot()
+        snapshot.removeTenant(tenantName, time)
+        self.commitSnapshot(snapshot)
+
+    @tracing.traced("sheet.markRentAsPaid")
+    def markRentAsPaid(self, tenantName: str, time: datetime):
+        """
+        Marks the given person as having paid the rent for the month (raises
+        MonthNotFoundError if the month doesn't exist)
+        """
+        snapshot = self.getSnapshot()
+        snapshot.markRentAsPaid(tenantName, time)
+        self.commitSnapshot(snapshot)
+
+    @tracing.traced("sheet.setTotalRent")
+    def setTotalRent(self, totalRent: float, time: datetime):
+        """
+        Sets the total rent for the given month
+        """
+        snapshot = self.getSnapshot()
+        snapshot.setTotalRent(totalRent, time)
+        self.commitSnapshot(snapshot)
+
+    @tracing.traced("sheet.setTotalUtility")
+    def setTotalUtility(self, totalUtility: float, time: datetime):
+        """
+        Sets the total utility cost for the given month
+        """
+        snapshot = self.getSnapshot()
+        snapshot.setTotalUtility(totalUtility, time)
+        self.commitSnapshot(snapshot)
+
+    @tracing.traced("sheet.setWeeksStayed")
+    def setWeeksStayed(self, weeks: float, tenantName: str, time: datetime):
+        """
+        Sets how many weeks the given person stayed for the given month
+        """
+        snapshot = self.getSnapshot()
+        snapshot.setWeeksStayed(weeks, tenantName, time)
+        self.commitSnapshot(snapshot)
+
+    def _getAmountsOwedForMonth(self, monthData: MonthData) -> typing.Dict[str, float]:
+        monthKey = (monthData.year, monthData.month)
+        ledger = Ledger.fromMonthData([monthData])
+        return {
+            name: cents / 100
+            for name, cents in ledger.getMonthAmountsOwedCents()[monthKey].items()
+        }
+
+    @tracing.traced("sheet.getAmountsOwed")
+    def getAmountsOwed(self, refresh: bool = False) -> typing.Dict[str, float]:
+        """
+        Returns a dictionary of how much all the current tenants owe
+
+        This is read from the cached AmountsOwedView, which is only rebuilt if
+        asked to (refresh=True) or if someone else has edited the sheet since
+        we last saw it.
+        """
+        if not refresh and not self._isRevalidated.is_set():
+            # Still checking the cached amounts; they're very likely still
+            # right, so don't make anyone wait on that
+            return dict(self._amountsOwedView.amountsOwed)
+        amountsOwed = self._readFlight.do(
+            ("getAmountsOwed", refresh, self._writeGeneration),
+            lambda: self._getAmountsOwedView(refresh).amountsOwed,
+        )
+        return dict(amountsOwed)
+
+    def _getAmountsOwedView(self, refresh: bool) -> "AmountsOwedView":
+        if not refresh:
+            view = self._amountsOwedView
+            sheetVersion = self._getSheetVersion()
+            if view and view.sheetVersion == sheetVersion:
+                return view
+            # Another instance may have already rebuilt them
+            view = self._getSharedAmountsOwed(sheetVersion)
+            if view:
+                self._amountsOwedView = view
+                return view
+        print("Rebuilding amounts owed from the sheet")
+        return self.rebuildAmountsOwed()
+
+    @tracing.traced("sheet.createNewMonth")
+    def createNewMonth(self, time: datetime) -> MonthData:
+        """
+        Creates the data for the given month, if it doesn't already exist, and
+        returns it
+        """
+        snapshot = self.getSnapshot()
+        monthData = snapshot.createNewMonth(time)
+        self.commitSnapshot(snapshot)
+        return monthData
+
+
+def openSheetForMaintenance(serverJournalPath: str = JOURNAL_PATH) -> GoogleSheet:
+    """
+    Opens the sheet for a job that moves its rows around (see migrateSheet.py
+    and archiveSheet.py) while the server may be running
+
+    The job doesn't journal its own writes (or touch the server's sheet cache):
+    journaled updates are for the rows as they were when they were worked
+    out, so replaying them after the rows have moved would write them to the
+    wrong cells. For the same reason, this raises UnwrittenUpdatesError if the
+    server's journal (at serverJournalPath) still has updates waiting to be
+    written.
+    """
+    if serverJournalPath:
+        numPending = len(SheetJournal(serverJournalPath).getPending())
+        if numPending:
+            raise UnwrittenUpdatesError(
+                f"The server still has {numPending} unwritten sheet updates in "
+                f"'{serverJournalPath}'; try again once they've been written"
+            )
+    return GoogleSheet(journalPath="", cachePath="")
+
+
+class SheetLayout:
+    """
+    Where everything lives on a particular version of the sheet; created for
+    each download of the sheet, and copied for each snapshot of it
+    """
+
+    version = 0
+    # The most current tenants the sheet has room for (None if unlimited)
+    maxTenants: typing.Optional[int] = None
+
+    def getCurrentTenantData(
+        self, allRows: typing.List[list]
+    ) -> typing.Dict[str, CurrentTenant]:
+        raise NotImplementedError
+
+    def getMonthBlockData(
         self, allRows: typing.List[list], time: datetime
+    ) -> typing.Optional[MonthData]:
+        raise NotImplementedError
+
+    def getCurrentTenantsUpdates(
+        self, newData: typing.Dict[str, CurrentTenant]
     ) -> typing.List[dict]:
+        raise NotImplementedError
+
+    def getMonthBlockUpdates(self, newData: MonthData) -> typing.List[dict]:
+        raise NotImplementedError
+
+    def getIndexUpdates(self) -> typing.List[dict]:
+        """Returns the updates for any bookkeeping the layout needs"""
+        return []
+
+    def copy(self) -> "SheetLayout":
+        """Returns a copy that can be changed without affecting this one"""
+        return copy.copy(self)
+
+
+class SheetLayoutV1(SheetLayout):
+    """
+    The original layout, with fixed 25-row month blocks (see GoogleSheet)
+    """
+
+    version = 1
+
+    def __init__(self, sheet: GoogleSheet, allRows: typing.List[list]):
+        self._sheet = sheet
+        self.maxTenants = sheet.MAX_USERS
+
+    def getCurrentTenantData(
+        self, allRows: typing.List[list]
+    ) -> typing.Dict[str, CurrentTenant]:
+        return self._sheet._getCurrentTenantData(allRows)
+
+    def getMonthBlockData(
+        self, allRows: typing.List[list], time: datetime
+    ) -> typing.Optional[MonthData]:
+        return self._sheet._getMonthBlockData(allRows, time)
+
+    def getCurrentTenantsUpdates(
+        self, newData: typing.Dict[str, CurrentTenant]
+    ) -> typing.List[dict]:
+        return self._sheet._updateCurrentTenantsData(newData)
+
+    def getMonthBlockUpdates(self, newData: MonthData) -> typing.List[dict]:
+        return self._sheet._updateMonthBlockData(newData)
+
+
+def _getColumns(
+    allRows: typing.List[list], firstColumn: int, numColumns: int
+) -> typing.List[list]:
+    """
+    Returns just the given columns of every row, padded with blanks (rows from
+    the API are only as long as the widest row)
+    """
+    return [
+        (list(row[firstColumn : firstColumn + numColumns]) + [""] * numColumns)[
+            :numColumns
+        ]
+        for row in allRows
+    ]
+
+
+class SheetLayoutV2(SheetLayout):
+    """
+    A compact layout where month blocks only take up as many rows as they need,
+    and there's no limit on the number of tenants:
+
+    A                       B       C       D   E       F       G       H   I       J
+    RentBot Sheet Format,   2
+                                                Name,   Months Unpaid,  ... Month,  Rows
+    8/2021,                                     Mac,    8/2021          ... 8/2021, 3:10
+    Total Rent,             1697                Jake,                   ... 9/2021, 11:17
+    ...
+
+    - The current tenants are listed in columns E-G (from row 3 down)
+    - Month blocks (same format as v1) are stacked in columns A-C starting at
+    row 3, each with a couple of spare rows for people added mid-month
+    - The index in columns I-J says which rows each month's block is on; a block
+    that outgrows its rows gets moved to the bottom of the sheet
+    - Months that have been archived (see SheetArchiver) are listed in the
+    index with the name of the archive worksheet they were moved to instead
+    """
+
+    version = 2
+    FIRST_DATA_ROW = 3
+    TENANT_COLUMN = 4  # E
+    INDEX_COLUMN = 8  # I
+    MONTH_BLOCK_SPARE_ROWS = 2
+
+    def __init__(self, sheet: GoogleSheet, allRows: typing.List[list]):
+        self._sheet = sheet
+        self.maxTenants = None
+
+        self._tenantRows = _getColumns(allRows, self.TENANT_COLUMN, 3)
+        self._numCurrentTenants = len(
+            sheet._getSuccessiveDataRows(self._tenantRows, self.FIRST_DATA_ROW - 1)
+        )
+
+        # (year, month) -> (first row, last row) of that month's block
+        self.monthRanges: typing.Dict[
+            typing.Tuple[int, int], typing.Tuple[int, int]
+        ] = {}
+        indexRows = sheet._getSuccessiveDataRows(
+            _getColumns(allRows, self.INDEX_COLUMN, 2), self.FIRST_DATA_ROW - 1
+        )
+        # (year, month) -> name of the archive worksheet that month was moved to
+        self.archivedMonths: typing.Dict[typing.Tuple[int, int], str] = {}
+        for monthStr, rowsStr in indexRows:
+            time = sheet._parseMonthYearString(monthStr)
+            key = (time.year, time.month)
+            if ":" in rowsStr:
+                firstRow, lastRow = rowsStr.split(":")
+                self.monthRanges[key] = (int(firstRow), int(lastRow))
+            else:
+                self.archivedMonths[key] = rowsStr
+        self._numIndexRows = len(indexRows)
+        self._indexChanged = False
+
+    def copy(self) -> "SheetLayoutV2":
+        layout = copy.copy(self)
+        layout.monthRanges = dict(self.monthRanges)
+        layout.archivedMonths = dict(self.archivedMonths)
+        return layout
+
+    @classmethod
+    def getInitialUpdates(cls) -> typing.List[dict]:
+        """Returns the updates that set up a brand new, empty v2 sheet"""
+        return [
+            {"range": "A1:B1", "values": [[FORMAT_MARKER, cls.version]]},
+            {"range": "E2:G2", "values": [["Name", "Months Unpaid", "Stay Schedule"]]},
+            {"range": "I2:J2", "values": [["Month", "Rows"]]},
+        ]
+
+    def getCurrentTenantData(
+        self, allRows: typing.List[list]
+    ) -> typing.Dict[str, CurrentTenant]:
+        return self._sheet._parseCurrentTenantRows(
+            self._sheet._getSuccessiveDataRows(
+                self._tenantRows, self.FIRST_DATA_ROW - 1
+            )
+        )
+
+    def getMonthBlockData(
+        self, allRows: typing.List[list], time: datetime
+    ) -> typing.Optional[MonthData]:
+        key = (time.year, time.month)
+        if key in self.archivedMonths:
+            return self._sheet._getArchivedMonthData(self.archivedMonths[key], time)
+        monthRange = self.monthRanges.get(key)
+        if not monthRange:
+            return None
+        firstRow, lastRow = monthRange
+        blockRows = _getColumns(allRows[firstRow - 1 : lastRow], 0, 3)
+        return self._sheet._parseMonthBlockRows(blockRows, time)
+
+    def getCurrentTenantsUpdates(
+        self, newData: typing.Dict[str, CurrentTenant]
+    ) -> typing.List[dict]:
+        rows = [
+            [
+                t.name,
+                ",".join(list(set([f"{x.month}/{x.year}" for x in t.monthsUnpaid]))),
+                t.staySchedule.value,
+            ]
+            for t in newData.values()
+        ]
+        # Only clear out as many rows as there were tenants before
+        rows += [["", "", ""]] * (self._numCurrentTenants - len(rows))
+        self._numCurrentTenants = len(newData)
+        if not rows:
+            return []
+        firstRow = self.FIRST_DATA_ROW
+        return [{"range": f"E{firstRow}:G{firstRow + len(rows) - 1}", "values": rows}]
+
+    def _getNextFreeRow(self) -> int:
+        lastRows = [lastRow for _, lastRow in self.monthRanges.values()]
+        return max(lastRows, default=self.FIRST_DATA_ROW - 1) + 1
+
+    def getMonthBlockUpdates(self, newData: MonthData) -> typing.List[dict]:
+        """
+        Returns the updates to write the given month's block, moving it to the
+        bottom of the sheet if it no longer fits in the rows it had
+        """
+        sheetUpdates = []
+        key = (newData.year, newData.month)
+        rowsNeeded = 4 + len(newData.tenants)
+
+        monthRange = self.monthRanges.get(key)
+        if monthRange and monthRange[1] - monthRange[0] + 1 < rowsNeeded:
+            firstRow, lastRow = monthRange
+            sheetUpdates.append(
+                {
+                    "range": f"A{firstRow}:C{lastRow}",
+                    "values": [["", "", ""]] * (lastRow - firstRow + 1),
+                }
+            )
+            monthRange = None
+        if not monthRange:
+            # Changing an archived month brings it back onto the live sheet
+            self.archivedMonths.pop(key, None)
+            firstRow = self._getNextFreeRow()
+            monthRange = (
+                firstRow,
+                firstRow + rowsNeeded + self.MONTH_BLOCK_SPARE_ROWS - 1,
+            )
+            self.monthRanges[key] = monthRange
+            self._indexChanged = True
+
+        firstRow, lastRow = monthRange
+        rows = [
+            [f"{newData.month}/{newData.year}", "", ""],
+            ["Total Rent", newData.totalRent, ""],
+            ["Total Utility", newData.totalUtility, ""],
+            ["Name", "Weeks Stayed", "Paid?"],
+        ]
+        rows += [[t.name, t.weeksStayed, t.isPaid] for t in newData.tenants.values()]
+        rows += [["", "", ""]] * (lastRow - firstRow + 1 - len(rows))
+        sheetUpdates.append({"range": f"A{firstRow}:C{lastRow}", "values": rows})
+        return sheetUpdates
+
+    def getArchiveUpdates(
+        self,
+        archivedMonths: typing.Dict[typing.Tuple[int, int], str],
+        liveMonths: typing.List[MonthData],
+    ) -> typing.List[dict]:
+        """
+        Returns the updates that point the given months at the archive
+        worksheets they were copied to, and re-stack the remaining live months
+        from the top of the sheet so no empty gaps are left behind
+        """
+        oldLastRow = self._getNextFreeRow() - 1
+        self.archivedMonths.update(archivedMonths)
+        self.monthRanges = {}
+        self._indexChanged = True
+
+        sheetUpdates = []
+        for monthData in sorted(liveMonths, key=lambda m: (m.year, m.month)):
+            sheetUpdates += self.getMonthBlockUpdates(monthData)
+
+        newLastRow = self._getNextFreeRow() - 1
+        if oldLastRow > newLastRow:
+            sheetUpdates.append(
+                {
+                    "range": f"A{newLastRow + 1}:C{oldLastRow}",
+                    "values": [["", "", ""]] * (oldLastRow - newLastRow),
+                }
+            )
+        return sheetUpdates
+
+    def getIndexUpdates(self) -> typing.List[dict]:
+        if not self._indexChanged:
+            return []
+        indexEntries = {
+            key: f"{firstRow}:{lastRow}"
+            for key, (firstRow, lastRow) in self.monthRanges.items()
+        }
+        indexEntries.update(self.archivedMonths)
+        rows = [
+            [f"{month}/{year}", location]
+            for (year, month), location in sorted(indexEntries.items())
+        ]
+        rows += [["", ""]] * (self._numIndexRows - len(rows))
+        self._numIndexRows = len(indexEntries)
+        self._indexChanged = False
+        if not rows:
+            return []
+        firstRow = self.FIRST_DATA_ROW
+        return [{"range": f"I{firstRow}:J{firstRow + len(rows) - 1}", "values": rows}]
+
+
+class SheetMigrator:
+    """
+    Converts a v1 sheet to the v2 layout without downloading it all at once
+
+    Basic algorithm:
+    1) Read the current tenants from the top of the v1 sheet
+    2) Create a new worksheet with as many rows as the old one (plus spare),
+    and set it up as an empty v2 sheet
+    3) Read "chunkMonths" v1 month blocks at a time, and write each chunk's
+    months to the new worksheet (until we reach the end of the old worksheet)
+    4) Write the current tenants and the month index to the new worksheet
+    5) Make the new worksheet the first one (i.e. the one RentBot uses), and
+    keep the old one around as a backup
+    """
+
+    def __init__(self, sheet: GoogleSheet, chunkMonths: int = 12):
+        self._sheet = sheet
+        self.chunkMonths = chunkMonths
+
+    def _getMonth(self, monthsFromStart: int) -> datetime:
+        monthIndex = self._sheet.START_MONTH - 1 + monthsFromStart
+        return datetime(
+            self._sheet.START_YEAR + monthIndex // 12, monthIndex % 12 + 1, 1
+        )
+
+    def migrate(self):
+        sheet = self._sheet
+        blockSize = sheet.MONTH_BLOCK_SIZE
+        oldWorksheet = sheet._sheet.sheet1
+        oldWksheet = sheet._wksheet
+
+        (tenantRows,) = oldWksheet.batch_get(
+            [f"A1:C{blockSize}"], value_render_option=VALUE_RENDER_OPTION
+        )
+        currentTenants = sheet._getCurrentTenantData(tenantRows)
+
+        # A v2 month block never takes more rows than the v1 one it came from,
+        # so this fits every month (with spare rows for the months to come;
+        # past those, SheetsClient adds more as needed)
+        newWorksheet = sheet._sheet.add_worksheet(
+            f"{oldWorksheet.title} (v2)",
+            rows=oldWorksheet.row_count + GROW_ROWS,
+            cols=10,
+        )
+        newWksheet = SheetsClient(newWorksheet, quota=sheet._quota)
+        newWksheet.batch_update(SheetLayoutV2.getInitialUpdates())
+        layout = SheetLayoutV2(sheet, [])
+
+        monthsFromStart = 0
+        while blockSize * (monthsFromStart + 1) <= oldWorksheet.row_count:
+            firstRow = blockSize * (monthsFromStart + 1)
+            lastRow = firstRow + blockSize * self.chunkMonths - 1
+            (chunkRows,) = oldWksheet.batch_get(
+                [f"A{firstRow}:C{lastRow}"], value_render_option=VALUE_RENDER_OPTION
+            )
+            chunkRows = _getColumns(chunkRows, 0, 3)
+
+            sheetUpdates = []
+            numMonths = 0
+            for i in range(self.chunkMonths):
+                blockRows = chunkRows[i * blockSize : (i + 1) * blockSize]
+                if not blockRows or not blockRows[0][0]:
+                    continue
+                time = self._getMonth(monthsFromStart + i)
+                monthData = sheet._parseMonthBlockRows(blockRows, time)
+                sheetUpdates += layout.getMonthBlockUpdates(monthData)
+                numMonths += 1
+            if numMonths:
+                print(f"Migrating {numMonths} months from row {firstRow}...")
+                newWksheet.batch_update(sheetUpdates)
+            monthsFromStart += self.chunkMonths
+
+        sheetUpdates = layout.getCurrentTenantsUpdates(currentTenants)
+        sheetUpdates += layout.getIndexUpdates()
+        newWksheet.batch_update(sheetUpdates)
+
+        oldTitle = oldWorksheet.title
+        oldWorksheet.update_title(f"{oldTitle} (v1 backup)")
+        newWorksheet.update_title(oldTitle)
+        sheet._sheet.reorder_worksheets(
+            [newWorksheet]
+            + [w for w in sheet._sheet.worksheets() if w.id != newWorksheet.id]
+        )
+        print(f"Migrated sheet to v2; the old sheet is now '{oldTitle} (v1 backup)'")
+        return newWorksheet
+
+
+class SheetArchiver:
+    """
+    Moves settled months off of the live (v2) sheet onto one archive worksheet
+    per year, so the sheet every command downloads stays about the same size
+
+    A month is settled once every tenant on it has paid and no current tenant
+    still lists it as unpaid. Archived months stay in the live sheet's index
+    (pointing at their archive worksheet), so looking them up still works; if
+    one is changed later, it's moved back onto the live sheet.
+
+    Basic algorithm:
+    1) Download the live sheet and find all the settled months
+    2) For each year, copy that year's settled months to the bottom of its
+    archive worksheet (creating it if needed) in one update
+    3) In one update to the live sheet, point the index at the archives and
+    re-stack the remaining months from the top
+    """
+
+    def __init__(self, sheet: GoogleSheet):
+        self._sheet = sheet
+
+    def archive(self) -> typing.List[typing.Tuple[int, int]]:
+        """Archives all the settled months, and returns which ones they were"""
+        sheet = self._sheet
+        snapshot = sheet.getSnapshot()
+        layout = snapshot.layout
+        if not isinstance(layout, SheetLayoutV2):
+            print("Only v2 sheets can be archived (see migrateToV2); skipping")
+            return []
+
+        monthsOwed = {(t.year, t.month) for t in snapshot.getMonthsOwed()}
+        settledMonths: typing.Dict[int, typing.List[MonthData]] = {}
+        liveMonths = []
+        for year, month in sorted(layout.monthRanges):
+            monthData = snapshot.getMonthData(datetime(year, month, 1))
+            isPaid = all(t.isPaid for t in monthData.tenants.values())
+            if isPaid and (year, month) not in monthsOwed:
+                settledMonths.setdefault(year, []).append(monthData)
+            else:
+                liveMonths.append(monthData)
+        if not settledMonths:
+            return []
+
+        archivedMonths = {}
+        for year, monthsData in settledMonths.items():
+            title = sheet._getArchiveTitle(year)
+            archiveWksheet, archiveRows = sheet._getArchiveWorksheet(title)
+            archiveLayout = SheetLayoutV2(sheet, archiveRows)
+            sheetUpdates = []
+            if archiveWksheet is None:
+                sheetUpdates += SheetLayoutV2.getInitialUpdates()
+            for monthData in monthsData:
+                sheetUpdates += archiveLayout.getMonthBlockUpdates(monthData)
+                archivedMonths[(monthData.year, monthData.month)] = title
+            sheetUpdates += archiveLayout.getIndexUpdates()
+            if archiveWksheet is None:
+                archiveWksheet = sheet._addArchiveWorksheet(title, sheetUpdates)
+            archiveWksheet.batch_update(sheetUpdates)
+            sheet._archiveRows.pop(title, None)
+            print(f"Archived {len(monthsData)} months to '{title}'")
+
+        sheet._wksheet.batch_update(
+            layout.getArchiveUpdates(archivedMonths, liveMonths)
+            + layout.getIndexUpdates()
+        )
+        return sorted(archivedMonths)
+
+
+class SheetModel:
+    """
+    The parsed contents of one download of the sheet: the current tenants by
+    name, the months any of them still owe for, and each month's data by
+    (year, month), which is parsed the first time it's asked for and then kept
+
+    The model is shared by every snapshot made from the same rows, so it's
+    never changed; snapshots get their own copies of anything they change.
+    """
+
+    __slots__ = ("allRows", "layout", "currentTenants", "monthsOwed", "_months")
+
+    def __init__(self, sheet: GoogleSheet, allRows: typing.List[list]):
+        self.allRows = allRows
+        self.layout = sheet._getLayout(allRows)
+        self.currentTenants: typing.Dict[str, CurrentTenant] = (
+            self.layout.getCurrentTenantData(allRows)
+        )
+        self.monthsOwed: typing.Tuple[datetime, ...] = tuple(
+            sorted(
+                {
+                    datetime(year=t.year, month=t.month, day=1)
+                    for tenant in self.currentTenants.values()
+                    for t in tenant.monthsUnpaid
+                }
+            )
+        )
+        self._months: typing.Dict[
+            typing.Tuple[int, int], typing.Optional[MonthData]
+        ] = {}
+
+    def getMonthData(self, time: datetime) -> typing.Optional[MonthData]:
+        """Returns a copy of the given month's data, or None if it doesn't exist"""
+        key = (time.year, time.month)
+        if key not in self._months:
+            self._months[key] = self.layout.getMonthBlockData(self.allRows, time)
+        monthData = self._months[key]
+        return monthData.copy() if monthData else None
+
+
+class SheetSnapshot:
+    """
+    An in-memory copy of the rent roll, loaded from a single download of the
+    sheet. Commands can make any number of changes to it, which are then
+    written back together by GoogleSheet.commitSnapshot
+
+    Only the parts of the sheet that were actually changed (the current tenants
+    and/or individual month blocks) are included in the final sheet updates.
+    """
+
+    def __init__(self, sheet: GoogleSheet, allRows: typing.List[list]):
+        self._sheet = sheet
+        self._model = sheet._getModel(allRows)
+        self.layout = self._model.layout.copy()
+        self.currentTenants = {
+            name: tenant.copy() for name, tenant in self._model.currentTenants.items()
+        }
+        self._months: typing.Dict[typing.Tuple[int, int], MonthData] = {}
+        self._currentTenantsChanged = False
+        self._changedMonths: typing.List[typing.Tuple[int, int]] = []
+
+    @staticmethod
+    def _monthKey(time: datetime) -> typing.Tuple[int, int]:
+        return (time.year, time.month)
+
+    @staticmethod
+    def _monthStart(time: datetime) -> datetime:
+        # Unpaid months are stored as just the month/year, so drop the day here
+        # too (otherwise 2 commands in one batch could count a month twice)
+        return datetime(year=time.year, month=time.month, day=1)
+
+    def _markMonthChanged(self, monthData: MonthData):
+        key = (monthData.year, monthData.month)
+        if key not in self._changedMonths:
+            self._changedMonths.append(key)
+
+    def getMonthData(self, time: datetime) -> typing.Optional[MonthData]:
+        """Returns the given month's data, or None if it doesn't exist"""
+        key = self._monthKey(time)
+        if key not in self._months:
+            self._months[key] = self._model.getMonthData(time)
+        return self._months[key]
+
+    def createNewMonth(self, time: datetime) -> MonthData:
         """
         Creates the basic, empty block of data for the given month, if it
         doesn't already exist
 
         Basic algorithm:
-        1) Go to the given start row for a month; if it already exists, exit
-        2) Get all the users from the initial data
-        3) Add the month/year and rent/utility (both as 0.0)
-        4) Add all the current users w/ "unpaid" status and:
+        1) If the month already exists, return it
+        2) Add the month/year and rent/utility (both as 0.0)
+        3) Add all the current users w/ "unpaid" status and:
             -   0 weeks stayed if they're irregular tenants
             -   4 weeks stayed if they're full-time
-        5) For all the current users, add the current month/year as unpaid to
+        4) For all the current users, add the current month/year as unpaid to
         the initial data
         """
-        sheetUpdates = []
-        if self._monthDataExists(allRows, time):
-            return sheetUpdates
-
-        # TODO: Refactor this into separate "updateCurrentTenants"/"updateMonth"
-        # functions
-        currentTenants = self._getCurrentTenantData(allRows)
-        for _, tenant in currentTenants.items():
-            tenant.monthsUnpaid.append(time)
+        monthData = self.getMonthData(time)
+        if monthData:
+            return monthData
 
-        sheetUpdates += self._updateCurrentTenantsData(currentTenants)
+        for tenant in self.currentTenants.values():
+            tenant.monthsUnpaid.append(self._monthStart(time))
+        self._currentTenantsChanged = True
 
         monthData = MonthData(
             time.year,
@@ -339,12 +1510,12 @@ class GoogleSheet:
                 tenant.name: MonthlyTenant(
                     tenant.name, tenant.initialWeeksStayed(), False
                 )
-                for tenant in currentTenants.values()
+                for tenant in self.currentTenants.values()
             },
         )
-        sheetUpdates += self._updateMonthBlockData(monthData)
-
-        return sheetUpdates
+        self._months[self._monthKey(time)] = monthData
+        self._markMonthChanged(monthData)
+        return monthData
 
     def addTenant(self, tenantName: str, time: datetime):
         """
@@ -353,36 +1524,32 @@ class GoogleSheet:
 
         Basic algorithm:
         1) Check if the user exists in the initial data; if they do, exit
-        2) If we're already at the max capacity of users, exit
+        2) If we're already at the max capacity of users (v1 sheets only), exit
         3) Add the user to the initial rows as a FULLTIME tenant
         4) Go to the current month and add them to the next available row w/ 0
         weeks stayed
         """
-        allRows = self._getAllRows()
-        currentTenants = self._getCurrentTenantData(allRows)
-        if tenantName in currentTenants:
+        if tenantName in self.currentTenants:
             return
 
-        if len(currentTenants) >= self.MAX_USERS:
+        maxTenants = self.layout.maxTenants
+        if maxTenants is not None and len(self.currentTenants) >= maxTenants:
             # TODO: Throw some kind of exception instead
             return
 
-        monthData = self._getMonthBlockData(allRows, time)
-        if not monthData:
-            allRows, monthData = self.createNewMonth(time)
+        monthData = self.createNewMonth(time)
 
         newTenant = CurrentTenant(
-            tenantName, monthsUnpaid=[time], staySchedule=StaySchedule.FULLTIME
+            tenantName,
+            monthsUnpaid=[self._monthStart(time)],
+            staySchedule=StaySchedule.FULLTIME,
         )
-        currentTenants[tenantName] = newTenant
+        self.currentTenants[tenantName] = newTenant
         monthData.tenants[tenantName] = MonthlyTenant(
             tenantName, newTenant.initialWeeksStayed(), False
         )
-
-        sheetUpdates = []
-        sheetUpdates += self._updateCurrentTenantsData(currentTenants)
-        sheetUpdates += self._updateMonthBlockData(monthData)
-        self._wksheet.batch_update(sheetUpdates)
+        self._currentTenantsChanged = True
+        self._markMonthChanged(monthData)
 
     def removeTenant(self, tenantName: str, time: datetime):
         """
@@ -393,21 +1560,16 @@ class GoogleSheet:
         2) If they do, remove them from the initial data at the top
         3) Go to the current month and remove them from there as well
         """
-        allRows = self._getAllRows()
-        currentTenants = self._getCurrentTenantData(allRows)
-        if tenantName not in currentTenants:
+        if tenantName not in self.currentTenants:
             return
 
-        del currentTenants[tenantName]
-        monthData = self._getMonthBlockData(allRows, time)
-        if monthData and tenantName in monthData.tenants:
-            del monthData.tenants[tenantName]
+        del self.currentTenants[tenantName]
+        self._currentTenantsChanged = True
 
-        sheetUpdates = []
-        sheetUpdates += self._updateCurrentTenantsData(currentTenants)
+        monthData = self.getMonthData(time)
         if monthData:
-            sheetUpdates += self._updateMonthBlockData(monthData)
-        self._wksheet.batch_update(sheetUpdates)
+            monthData.tenants.pop(tenantName, None)
+            self._markMonthChanged(monthData)
 
     def markRentAsPaid(self, tenantName: str, time: datetime):
         """
@@ -416,108 +1578,60 @@ class GoogleSheet:
         Basic algorithm:
         1) Check if the user exists in the initial data; if they don't, exit
         2) Mark them as having paid for that month (if the month does not exist,
-        raise MonthNotFoundError)
+        raise MonthNotFoundError without changing anything)
         3) Remove the month as being unpaid from the initial data
         """
-        allRows = self._getAllRows()
-        currentTenants = self._getCurrentTenantData(allRows)
-        if tenantName not in currentTenants:
+        if tenantName not in self.currentTenants:
             return
 
-        currentTenants[tenantName].monthsUnpaid = list(
-            filter(
-                lambda t: t.year != time.year and t.month != time.month,
-                currentTenants[tenantName].monthsUnpaid,
-            )
-        )
-        monthData = self._getMonthBlockData(allRows, time)
-        print(monthData)
+        monthData = self.getMonthData(time)
         if monthData is None:
             raise MonthNotFoundError
         if tenantName in monthData.tenants:
             monthData.tenants[tenantName].isPaid = True
+        self._markMonthChanged(monthData)
 
-        sheetUpdates = []
-        sheetUpdates += self._updateCurrentTenantsData(currentTenants)
-        sheetUpdates += self._updateMonthBlockData(monthData)
-        self._wksheet.batch_update(sheetUpdates)
+        self.currentTenants[tenantName].monthsUnpaid = list(
+            filter(
+                lambda t: t.year != time.year and t.month != time.month,
+                self.currentTenants[tenantName].monthsUnpaid,
+            )
+        )
+        self._currentTenantsChanged = True
 
     def setTotalRent(self, totalRent: float, time: datetime):
         """
-        Sets the total rent for the given month
-
-        Basic algorithm:
-        1) Check if the month exists in the data; if it doesn't, create it
-        2) Update the month data to include the rent amt
+        Sets the total rent for the given month (creating the month if it
+        doesn't exist yet)
         """
-        allRows = self._getAllRows()
-        monthData = self._getMonthBlockData(allRows, time)
-        if not monthData:
-            allRows, monthData = self.createNewMonth(time)
-
+        monthData = self.createNewMonth(time)
         monthData.totalRent = totalRent
-
-        sheetUpdates = []
-        sheetUpdates += self._updateMonthBlockData(monthData)
-        self._wksheet.batch_update(sheetUpdates)
+        self._markMonthChanged(monthData)
 
     def setTotalUtility(self, totalUtility: float, time: datetime):
         """
-        Sets the total utility cost for the given month
-
-        Basic algorithm:
-        1) Check if the month exists in the data; if it doesn't, create it
-        2) Update the month data to include the utility amt
+        Sets the total utility cost for the given month (creating the month if
+        it doesn't exist yet)
         """
-        allRows = self._getAllRows()
-        monthData = self._getMonthBlockData(allRows, time)
-        if not monthData:
-            allRows, monthData = self.createNewMonth(time)
-
+        monthData = self.createNewMonth(time)
         monthData.totalUtility = totalUtility
-
-        sheetUpdates = []
-        sheetUpdates += self._updateMonthBlockData(monthData)
-        self._wksheet.batch_update(sheetUpdates)
+        self._markMonthChanged(monthData)
 
     def setWeeksStayed(self, weeks: float, tenantName: str, time: datetime):
         """
-        Sets the total utility cost for the given month
+        Sets how many weeks the given person stayed for the given month
 
         Basic algorithm:
         1) Check if the user exists in initial data; if they don't, exit
         2) Check if the given month exists; if it doesn't, create it
         3) Update the month data to include how many weeks they stayed
         """
-        allRows = self._getAllRows()
-        currentTenants = self._getCurrentTenantData(allRows)
-        if tenantName not in currentTenants:
+        if tenantName not in self.currentTenants:
             return
 
-        monthData = self._getMonthBlockData(allRows, time)
-        if not monthData:
-            allRows, monthData = self.createNewMonth(time)
-
+        monthData = self.createNewMonth(time)
         monthData.tenants[tenantName].weeksStayed = weeks
-
-        sheetUpdates = []
-        sheetUpdates += self._updateMonthBlockData(monthData)
-        self._wksheet.batch_update(sheetUpdates)
-
-    def _getAmountsOwedForMonth(self, monthData: MonthData) -> typing.Dict[str, float]:
-        totalWeeksStayed = sum(map(lambda x: x.weeksStayed, monthData.tenants.values()))
-        # Prevent division by 0 error (totals will still be 0)
-        if totalWeeksStayed == 0:
-            totalWeeksStayed += 1
-        totalCost = monthData.totalRent + monthData.totalUtility
-
-        amountsOwed = {}
-        unpaidTenants = list(filter(lambda x: not x.isPaid, monthData.tenants.values()))
-        for tenant in unpaidTenants:
-            amountsOwed[tenant.name] = totalCost * (
-                tenant.weeksStayed / totalWeeksStayed
-            )
-        return amountsOwed
+        self._markMonthChanged(monthData)
 
     def getAmountsOwed(self) -> typing.Dict[str, float]:
         """
@@ -526,39 +1640,121 @@ class GoogleSheet:
         Basic algorithm:
         1) Load all the current tenants; if there are none, return an empty dict
         2) Get all the months that haven't been paid for and load their data
-        3) For each of them, calculate how much each person owes and add it to
-        the total (if everyone's paid up, this'll be 0.0 for everyone)
+        3) Split all of their bills at once and add up how much each person owes
+        (if everyone's paid up, this'll be 0.0 for everyone)
         4) Return the totals
         """
-        allRows = self._getAllRows()
-        currentTenants = self._getCurrentTenantData(allRows)
-        if not currentTenants:
+        if not self.currentTenants:
             return {}
 
+        tenantNames = list(self.currentTenants)
+        ledger = Ledger.fromMonthData(
+            [self.getMonthData(month) for month in self.getMonthsOwed()], tenantNames
+        )
+        return ledger.getAmountsOwed(tenantNames)
+
+    def getRows(self) -> typing.List[list]:
+        """Returns the sheet rows this snapshot was made from"""
+        return self._model.allRows
+
+    def getChangedMonths(self) -> typing.List[typing.Tuple[int, int]]:
+        """Returns the (year, month) of every month changed in this snapshot"""
+        return list(self._changedMonths)
+
+    def getMonthsOwed(self) -> typing.List[datetime]:
+        """Returns every month that any current tenant hasn't paid for"""
+        if not self._currentTenantsChanged:
+            return list(self._model.monthsOwed)
         monthsOwed = set()
-        for tenant in currentTenants.values():
-            monthsOwed = monthsOwed.union(set(tenant.monthsUnpaid))
-
-        amountsOwed = {name: 0.0 for name in currentTenants}
-        for month in monthsOwed:
-            monthData = self._getMonthBlockData(allRows, month)
-            monthAmountsOwed = self._getAmountsOwedForMonth(monthData)
-            for tenant in amountsOwed:
-                if tenant not in monthAmountsOwed:
-                    continue
-                amountsOwed[tenant] += monthAmountsOwed[tenant]
+        for tenant in self.currentTenants.values():
+            monthsOwed.update(self._monthStart(t) for t in tenant.monthsUnpaid)
+        return sorted(monthsOwed)
 
-        return amountsOwed
+    def getSheetUpdates(self) -> typing.List[dict]:
+        """
+        Returns the Google Sheet updates for everything that's changed in this
+        snapshot
+        """
+        sheetUpdates = []
+        if self._currentTenantsChanged:
+            sheetUpdates += self.layout.getCurrentTenantsUpdates(self.currentTenants)
+        for key in self._changedMonths:
+            sheetUpdates += self.layout.getMonthBlockUpdates(self._months[key])
+        sheetUpdates += self.layout.getIndexUpdates()
+        return sheetUpdates
+
+
+class AmountsOwedView:
+    """
+    A materialized copy of how much each current tenant owes, so that showing
+    the rents doesn't need to re-download the sheet and re-total every unpaid
+    month each time
+
+    It stores each unpaid month's amounts owed separately; when a snapshot is
+    committed, only the months it changed (or that just became unpaid) get
+    re-totaled, and months that everyone has paid are dropped.
+    """
+
+    def __init__(self, sheetVersion: str = ""):
+        # When the sheet was last modified as of this view being up to date
+        self.sheetVersion = sheetVersion
+        self.monthAmountsOwedCents: typing.Dict[
+            typing.Tuple[int, int], typing.Dict[str, int]
+        ] = {}
+        self.amountsOwed: typing.Dict[str, float] = {}
+
+    def toDict(self) -> dict:
+        return {
+            "sheetVersion": self.sheetVersion,
+            "monthAmountsOwedCents": [
+                [year, month, monthCents]
+                for (year, month), monthCents in self.monthAmountsOwedCents.items()
+            ],
+            "amountsOwed": self.amountsOwed,
+        }
 
-    def createNewMonth(self, time: datetime) -> typing.Tuple[list, MonthData]:
+    @classmethod
+    def fromDict(cls, data: dict) -> "AmountsOwedView":
+        view = cls(data["sheetVersion"])
+        view.monthAmountsOwedCents = {
+            (year, month): monthCents
+            for year, month, monthCents in data["monthAmountsOwedCents"]
+        }
+        view.amountsOwed = data["amountsOwed"]
+        return view
+
+    def update(self, snapshot: SheetSnapshot):
         """
-        Creates the data for the given month, if it doesn't already exist
+        Brings the view up to date with the given (already committed) snapshot
 
         Basic algorithm:
-        1) Check if the given month exists; if it doesn't, create it
-        2) Return the rows and MonthData
+        1) Get all the months any current tenant hasn't paid for
+        2) Forget the months no one owes money for anymore
+        3) Re-total the months that changed in the snapshot or that we haven't
+        seen yet (all in one ledger)
+        4) Sum up each tenant's total across all the unpaid months
         """
-        allRows = self._getAllRows()
-        self._wksheet.batch_update(self._createMonthBlockData(allRows, time))
-        allRows = self._getAllRows()
-        return allRows, self._getMonthBlockData(allRows, time)
+        monthsOwed = {(t.year, t.month): t for t in snapshot.getMonthsOwed()}
+
+        for key in list(self.monthAmountsOwedCents):
+            if key not in monthsOwed:
+                del self.monthAmountsOwedCents[key]
+
+        changedMonths = set(snapshot.getChangedMonths())
+        staleMonths = [
+            snapshot.getMonthData(time)
+            for key, time in monthsOwed.items()
+            if key in changedMonths or key not in self.monthAmountsOwedCents
+        ]
+        if staleMonths:
+            ledger = Ledger.fromMonthData(staleMonths)
+            self.monthAmountsOwedCents.update(ledger.getMonthAmountsOwedCents())
+
+        self.amountsOwed = {
+            name: sum(
+                monthCents.get(name, 0)
+                for monthCents in self.monthAmountsOwedCents.values()
+            )
+            / 100
+            for name in snapshot.currentTenants
+        }
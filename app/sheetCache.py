@@ -0,0 +1,47 @@
+"""
+A local copy of the sheet as of our last write to it, so a freshly started
+server can answer "/rent show" right away instead of first downloading (and
+parsing) the whole sheet; GoogleSheet checks the copy against the real sheet in
+the background, and re-downloads it if anyone's changed it since.
+
+The copy is 1 compact JSON file with the sheet's rows, when the sheet was last
+modified (as of the copy), and the materialized amounts owed.
+"""
+
+import json
+import os
+import typing
+
+# Bumped whenever what's saved changes, so old files are just ignored
+CACHE_FORMAT_VERSION = 1
+
+
+class SheetCache:
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> typing.Optional[dict]:
+        """
+        Returns what was last saved, or None if nothing (usable) was saved
+        """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable sheet cache '{self.path}' ({e!r})")
+            return None
+        if data.get("formatVersion") != CACHE_FORMAT_VERSION:
+            return None
+        return data
+
+    def save(self, data: dict):
+        tempPath = f"{self.path}.tmp"
+        with open(tempPath, "w") as f:
+            json.dump(
+                dict(data, formatVersion=CACHE_FORMAT_VERSION),
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(tempPath, self.path)
@@ -0,0 +1,251 @@
+"""
+Wraps the gspread worksheet RentBot uses so that bursts of commands slow down
+instead of failing when they run into the Google Sheets API quotas.
+
+By default, Sheets allows 60 read requests and 60 write requests per minute per
+user (see https://developers.google.com/sheets/api/limits). We mirror those
+limits with local token buckets, and if Google still tells us to back off (HTTP
+429) or has a hiccup (HTTP 5xx), we retry with exponential backoff.
+"""
+
+import collections
+import os
+import random
+import threading
+import time
+import typing
+
+from gspread.exceptions import APIError
+from gspread.utils import a1_range_to_grid_range
+
+from . import metrics, tracing
+
+READS_PER_MINUTE = int(os.environ.get("RENTBOT_SHEETS_READS_PER_MINUTE", "60"))
+WRITES_PER_MINUTE = int(os.environ.get("RENTBOT_SHEETS_WRITES_PER_MINUTE", "60"))
+MAX_RETRIES = 5
+BASE_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 32.0
+# Extra rows to add when a write doesn't fit in the worksheet's grid, so that
+# the next few months' blocks don't each need rows added too
+GROW_ROWS = 250
+
+
+class VirtualClock:
+    """
+    A clock that only moves when something sleeps on it, so tests can simulate
+    waiting on the quota without actually waiting
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += max(seconds, 0.0)
+
+
+class TokenBucket:
+    """
+    Allows up to "capacity" requests at once, refilling at "capacity" requests
+    every "periodSeconds"; acquiring a token when there are none left waits
+    until one is refilled
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        periodSeconds: float = 60.0,
+        clock: typing.Callable[[], float] = time.monotonic,
+        sleep: typing.Callable[[float], None] = time.sleep,
+    ):
+        self.capacity = capacity
+        self.refillPerSecond = capacity / periodSeconds
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(capacity)
+        self._lastRefill = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self.capacity,
+            self._tokens + (now - self._lastRefill) * self.refillPerSecond,
+        )
+        self._lastRefill = now
+
+    def acquire(self) -> float:
+        """Takes 1 token, waiting if needed; returns how long it waited"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                waitSeconds = (1 - self._tokens) / self.refillPerSecond
+            self._sleep(waitSeconds)
+            waited += waitSeconds
+
+
+class SheetsQuota:
+    """
+    The read and write buckets for one Google account, which every worksheet
+    it opens (in any spreadsheet) has to share, since that's what Google's
+    quota is per
+    """
+
+    def __init__(
+        self,
+        readsPerMinute: int = READS_PER_MINUTE,
+        writesPerMinute: int = WRITES_PER_MINUTE,
+        clock: typing.Callable[[], float] = time.monotonic,
+        sleep: typing.Callable[[float], None] = time.sleep,
+    ):
+        self.readBucket = TokenBucket(readsPerMinute, clock=clock, sleep=sleep)
+        self.writeBucket = TokenBucket(writesPerMinute, clock=clock, sleep=sleep)
+
+
+def getLastRow(data: typing.List[dict]) -> int:
+    """Returns the last row (numbered from 1) the given updates write to"""
+    return max(
+        (
+            a1_range_to_grid_range(update["range"]).get("startRowIndex", 0)
+            + len(update["values"])
+            for update in data
+        ),
+        default=0,
+    )
+
+
+def _isRetryable(error: APIError) -> bool:
+    statusCode = getattr(error.response, "status_code", error.code)
+    return statusCode == 429 or statusCode >= 500
+
+
+class SheetsClient:
+    """
+    Stands in for the gspread worksheet, with the same get_all_values,
+    batch_update and batch_get methods, but every call:
+
+    1) Waits for a token from the read or write bucket
+    2) Retries on rate limits/server errors, with exponential backoff (plus a
+    bit of random jitter so parallel requests don't retry in lockstep)
+    3) Gets counted in requestCounts by operation name
+
+    With simulateQuota=True, all the waiting happens on a VirtualClock instead
+    (see simulatedSeconds), which is handy for tests. Clients for worksheets
+    opened with the same account should share a quota (otherwise each one gets
+    its own buckets).
+    """
+
+    def __init__(
+        self,
+        worksheet,
+        readsPerMinute: int = READS_PER_MINUTE,
+        writesPerMinute: int = WRITES_PER_MINUTE,
+        maxRetries: int = MAX_RETRIES,
+        simulateQuota: bool = False,
+        quota: typing.Optional[SheetsQuota] = None,
+    ):
+        self._worksheet = worksheet
+        self.maxRetries = maxRetries
+        self.virtualClock = VirtualClock() if simulateQuota else None
+        if self.virtualClock:
+            self._clock = self.virtualClock.time
+            self._sleep = self.virtualClock.sleep
+        else:
+            self._clock = time.monotonic
+            self._sleep = time.sleep
+        self.quota = quota or SheetsQuota(
+            readsPerMinute, writesPerMinute, clock=self._clock, sleep=self._sleep
+        )
+        self._readBucket = self.quota.readBucket
+        self._writeBucket = self.quota.writeBucket
+
+        self.requestCounts: typing.Counter[str] = collections.Counter()
+        self.retryCounts: typing.Counter[str] = collections.Counter()
+        self.throttledSeconds = 0.0
+
+    @property
+    def simulatedSeconds(self) -> float:
+        """How much (virtual) time has passed, if simulating the quota"""
+        return self.virtualClock.now if self.virtualClock else 0.0
+
+    def _call(
+        self,
+        operation: str,
+        bucket: TokenBucket,
+        func: typing.Callable,
+        maxRetries: typing.Optional[int] = None,
+    ):
+        maxRetries = self.maxRetries if maxRetries is None else maxRetries
+        for attempt in range(maxRetries + 1):
+            waited = bucket.acquire()
+            self.throttledSeconds += waited
+            metrics.SHEETS_THROTTLED_SECONDS.inc(waited)
+            self.requestCounts[operation] += 1
+            start = time.perf_counter()
+            try:
+                with tracing.span(
+                    f"sheets.{operation}", attempt=attempt, throttledSeconds=waited
+                ):
+                    result = func()
+            except APIError as e:
+                isRetrying = _isRetryable(e) and attempt < maxRetries
+                self._observe(operation, start, "retry" if isRetrying else "error")
+                if not isRetrying:
+                    raise
+                delay = min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2**attempt)
+                delay += random.uniform(0, BASE_BACKOFF_SECONDS)
+                print(f"Sheets {operation} failed ({e}); retrying in {delay:.1f}s")
+                self.retryCounts[operation] += 1
+                with tracing.span("sheets.backoff", seconds=delay):
+                    self._sleep(delay)
+            except Exception:
+                self._observe(operation, start, "error")
+                raise
+            else:
+                self._observe(operation, start, "ok")
+                return result
+
+    def _observe(self, operation: str, start: float, outcome: str):
+        metrics.SHEETS_REQUEST_SECONDS.observe(
+            time.perf_counter() - start, operation=operation, outcome=outcome
+        )
+
+    def get_all_values(self, **kwargs) -> typing.List[list]:
+        return self._call(
+            "get_all_values",
+            self._readBucket,
+            lambda: self._worksheet.get_all_values(**kwargs),
+        )
+
+    def batch_get(self, ranges: typing.List[str], **kwargs):
+        return self._call(
+            "batch_get",
+            self._readBucket,
+            lambda: self._worksheet.batch_get(ranges, **kwargs),
+        )
+
+    def add_rows(self, rows: int):
+        return self._call(
+            "add_rows", self._writeBucket, lambda: self._worksheet.add_rows(rows)
+        )
+
+    def batch_update(
+        self, data: typing.List[dict], maxRetries: typing.Optional[int] = None, **kwargs
+    ):
+        # Writing past the bottom of the worksheet's grid fails, so make room
+        # first (e.g. for a month block appended to a full sheet)
+        missingRows = getLastRow(data) - self._worksheet.row_count
+        if missingRows > 0:
+            self.add_rows(missingRows + GROW_ROWS)
+        return self._call(
+            "batch_update",
+            self._writeBucket,
+            lambda: self._worksheet.batch_update(data, **kwargs),
+            maxRetries,
+        )
@@ -0,0 +1,185 @@
+"""
+Lightweight request tracing, so we can see where the time in a slow command
+went without any outside service.
+
+Each webhook request or background job starts a trace (startTrace), and
+everything it calls can time itself as a nested span:
+
+    with tracing.startTrace("webhook"):
+        with tracing.span("sheet.getSnapshot"):
+            ...
+
+Finished spans are kept in memory (the most recent MAX_RECENT_SPANS of them)
+for /debug/traces, and appended as JSON lines to RENTBOT_TRACES_PATH if it's
+set. /debug/traces?format=chrome returns them in the Chrome trace event
+format, which chrome://tracing or https://ui.perfetto.dev show as flame charts.
+(/debug/traces needs a signed X-RentBot-Profile header; see profiler.py.)
+"""
+
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import typing
+import uuid
+from dataclasses import asdict, dataclass, field
+
+TRACES_PATH = os.environ.get("RENTBOT_TRACES_PATH", "")
+MAX_RECENT_SPANS = 5000
+
+
+@dataclass
+class Span:
+    traceId: str
+    spanId: str
+    parentId: typing.Optional[str]
+    name: str
+    # Seconds since the epoch
+    startTime: float
+    durationSeconds: float = 0.0
+    attributes: typing.Dict[str, typing.Any] = field(default_factory=dict)
+    error: typing.Optional[str] = None
+
+    def setAttribute(self, name: str, value: typing.Any):
+        self.attributes[name] = value
+
+
+_currentSpan: contextvars.ContextVar[typing.Optional[Span]] = contextvars.ContextVar(
+    "rentbot_current_span", default=None
+)
+
+
+class SpanExporter:
+    """
+    Keeps the most recent finished spans in memory, and appends each one to a
+    JSON-lines file (if given a path)
+    """
+
+    def __init__(self, path: str = TRACES_PATH, maxRecentSpans: int = MAX_RECENT_SPANS):
+        self.path = path
+        self._recentSpans: typing.Deque[Span] = collections.deque(maxlen=maxRecentSpans)
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            self._recentSpans.append(span)
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(asdict(span), default=str) + "\n")
+
+    def getRecentSpans(
+        self, traceId: typing.Optional[str] = None, maxTraces: int = 20
+    ) -> typing.List[Span]:
+        """
+        Returns the spans for the given trace, or for the most recent
+        "maxTraces" traces, in the order they finished
+        """
+        with self._lock:
+            spans = list(self._recentSpans)
+        if traceId:
+            return [span for span in spans if span.traceId == traceId]
+        traceIds = []
+        for span in reversed(spans):
+            if span.traceId not in traceIds:
+                traceIds.append(span.traceId)
+        recentTraceIds = set(traceIds[:maxTraces])
+        return [span for span in spans if span.traceId in recentTraceIds]
+
+
+EXPORTER = SpanExporter()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: typing.Any) -> typing.Iterator[Span]:
+    """
+    Times the "with" block as a child of the current span (or as the start of
+    a new trace, if there isn't one)
+    """
+    parent = _currentSpan.get()
+    newSpan = Span(
+        traceId=parent.traceId if parent else uuid.uuid4().hex,
+        spanId=uuid.uuid4().hex[:16],
+        parentId=parent.spanId if parent else None,
+        name=name,
+        startTime=time.time(),
+        attributes=attributes,
+    )
+    token = _currentSpan.set(newSpan)
+    start = time.perf_counter()
+    try:
+        yield newSpan
+    except BaseException as e:
+        newSpan.error = repr(e)
+        raise
+    finally:
+        newSpan.durationSeconds = time.perf_counter() - start
+        _currentSpan.reset(token)
+        EXPORTER.export(newSpan)
+
+
+@contextlib.contextmanager
+def startTrace(name: str, **attributes: typing.Any) -> typing.Iterator[Span]:
+    """Like span, but always starts a new trace"""
+    token = _currentSpan.set(None)
+    try:
+        with span(name, **attributes) as rootSpan:
+            yield rootSpan
+    finally:
+        _currentSpan.reset(token)
+
+
+def traced(name: str, newTrace: bool = False) -> typing.Callable:
+    """
+    Decorator that times every call to the function as a span (or as a new
+    trace, e.g. for background jobs)
+    """
+
+    def decorator(func: typing.Callable) -> typing.Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with (startTrace if newTrace else span)(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def getCurrentTraceId() -> typing.Optional[str]:
+    currentSpan = _currentSpan.get()
+    return currentSpan.traceId if currentSpan else None
+
+
+def toJsonLines(spans: typing.List[Span]) -> str:
+    return "".join(json.dumps(asdict(span), default=str) + "\n" for span in spans)
+
+
+def toChromeTrace(spans: typing.List[Span]) -> dict:
+    """
+    Converts the spans to Chrome's trace event format, with each trace on its
+    own row
+    """
+    rows: typing.Dict[str, int] = {}
+    events = []
+    for span in sorted(spans, key=lambda s: s.startTime):
+        row = rows.setdefault(span.traceId, len(rows) + 1)
+        args = dict(span.attributes, traceId=span.traceId)
+        if span.error:
+            args["error"] = span.error
+        events.append(
+            {
+                "name": span.name,
+                "cat": "rentbot",
+                "ph": "X",
+                "ts": span.startTime * 1e6,
+                "dur": span.durationSeconds * 1e6,
+                "pid": 1,
+                "tid": row,
+                "args": args,
+            }
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
@@ -0,0 +1,17 @@
+import os
+
+# Run against an in-memory sheet (see app/fakeSheet.py), so the tests don't
+# need Google credentials or a network connection
+os.environ["RENTBOT_GSHEETS_BACKEND"] = "memory"
+for name, default in [
+    ("RENTBOT_GSHEETS_URL", "memory://rentbot"),
+    ("RENTBOT_START_TIME", "2021-08-01"),
+    ("GROUPME_BOT_ID", "test-bot"),
+    ("CENTENNIAL_APARTMENT_USERNAME", ""),
+    ("CENTENNIAL_APARTMENT_PASSWORD", ""),
+    ("GEORGIA_POWER_USERNAME", ""),
+    ("GEORGIA_POWER_PASSWORD", ""),
+    ("XFINITY_USERNAME", ""),
+    ("XFINITY_PASSWORD", ""),
+]:
+    os.environ.setdefault(name, default)
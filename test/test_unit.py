@@ -1,13 +1,50 @@
+import argparse
+import dataclasses
 import datetime
+import http.server
+import json
+import os
+import threading
+import time
 
 import pytest
+from fastapi.testclient import TestClient
+from gspread.exceptions import APIError
 
-from app.main import AddCommand, RemoveCommand
-from app.sheet import GoogleSheet, MonthData, MonthlyTenant, MonthNotFoundError
+from app import getRents, main, metrics, pipeline, tracing
+from app.billScheduler import BillScheduler, getNextQuietTime
+from app.coalescing import Debouncer, SingleFlight
+from app.fakeRedis import FakeRedisServer
+from app.fakeSheet import FakeConnection, FakeSpreadsheet, makeAPIError
+from app.getRents import retry_func
+from app.households import Household, HouseholdRouter, SheetPool
+from app.httpScrape import BotChallengeError, HttpBillClient
+from app.journal import SheetJournal, coalesceUpdates
+from app.ledger import Ledger
+from app.main import AddCommand, BatchCommand, RemoveCommand, app
+from app.networkCapture import NetworkCapture
+from app.pipeline import Checkpoint, MonthPipeline, getRunMonths
+from app.profiler import Profiler, signProfileRequest
+from app.scrapeSandbox import ScrapeSandboxError, runSandboxed
+from app.sharedCache import MemorySharedCache, RedisSharedCache, makeKey
+from app.sheet import (
+    AmountsOwedView,
+    GoogleSheet,
+    MonthData,
+    MonthlyTenant,
+    MonthNotFoundError,
+    SheetLayoutV2,
+    SheetSnapshot,
+    UnwrittenUpdatesError,
+    openSheetForMaintenance,
+)
+from app.sheetsClient import GROW_ROWS, SheetsClient, SheetsQuota, VirtualClock
 
-googleSheetConnection = GoogleSheet()
+fakeConnection = FakeConnection()
+googleSheetConnection = GoogleSheet(connection=fakeConnection)
 googleSheetConnection.START_YEAR = 2021
 googleSheetConnection.START_MONTH = 8
+googleSheetConnection.addTenant("Jake Deerin", datetime.datetime(2021, 8, 1))
 
 
 @pytest.fixture
@@ -102,9 +139,9 @@ def testNoTotalRentHasNoCharges(unpaidSeptemberNoRentPosted):
 
 def testPartiallyPaidMonthCharges(partiallyPaidAugustRent):
     expected = {
-        "Andrew Wittenmyer": 183.49391304347824,
-        "David Deerin": 91.74695652173912,
-        "Manny Jonson": 183.49391304347824,
+        "Andrew Wittenmyer": 183.49,
+        "David Deerin": 91.75,
+        "Manny Jonson": 183.49,
     }
 
     monthAmountsOwed = googleSheetConnection._getAmountsOwedForMonth(
@@ -113,6 +150,20 @@ def testPartiallyPaidMonthCharges(partiallyPaidAugustRent):
     assert monthAmountsOwed == expected
 
 
+def testLedgerSharesAddUpToMonthTotal(
+    partiallyPaidAugustRent, unpaidSeptemberNoRentPosted
+):
+    ledger = Ledger.fromMonthData(
+        [partiallyPaidAugustRent, unpaidSeptemberNoRentPosted]
+    )
+    shareCents = ledger.getShareCents()
+    assert shareCents[0].sum() == 211018
+    assert shareCents[1].sum() == 0
+
+    amountsOwed = ledger.getAmountsOwed(["Manny Jonson", "Jake Deerin", "Nobody"])
+    assert amountsOwed == {"Manny Jonson": 183.49, "Jake Deerin": 0.0, "Nobody": 0.0}
+
+
 def testGettingTenantFromRemovalMsg():
     input = "/rent remove  Andrew Wittenmyer"
     expected = "Andrew Wittenmyer"
@@ -235,3 +286,1283 @@ def testTenantRowsWithExtraDataOkay():
     assert tenants["Jake Deerin"] == MonthlyTenant(
         name="Jake Deerin", weeksStayed=4.0, isPaid=True
     )
+
+
+def testBatchCommandSplitsMultipleRentLines():
+    input = "/rent rent-amt 1697\nthanks!\n  /rent utility-amt 413.18\n/rent show"
+    expected = ["/rent rent-amt 1697", "/rent utility-amt 413.18", "/rent show"]
+
+    cmd = BatchCommand()
+    assert cmd.getCommandLines(input) == expected
+
+
+def testBatchCommandAddsMissingPrefixes():
+    input = "/rent batch\nrent-amt 1697\n\n/rent weeks-stayed 2\n"
+    expected = ["/rent rent-amt 1697", "/rent weeks-stayed 2"]
+
+    cmd = BatchCommand()
+    assert cmd.getCommandLines(input) == expected
+
+
+def testAmountsOwedViewMatchesSnapshotAfterUpdates():
+    input = [
+        ["Name", "Months Unpaid", "Stay Schedule"],
+        ["Mac Mathis", "8/2021", "FULLTIME"],
+        ["Jake Deerin", "8/2021", "HALFTIME"],
+    ]
+    # Pad out the current tenants block so August starts on the right row
+    for i in range(21):
+        input.append([""])
+    input += [
+        ["8/2021"],
+        ["Total Rent", "1,000.00"],
+        ["Total Utility", "200.00"],
+        ["Name", "Weeks Stayed", "Paid?"],
+        ["Mac Mathis", "4", "False"],
+        ["Jake Deerin", "2", "False"],
+    ]
+    snapshot = SheetSnapshot(googleSheetConnection, input)
+    view = AmountsOwedView()
+    view.update(snapshot)
+    assert view.amountsOwed == {"Mac Mathis": 800.0, "Jake Deerin": 400.0}
+
+    snapshot.markRentAsPaid("Jake Deerin", datetime.datetime(2021, 8, 1))
+    view.update(snapshot)
+    assert view.amountsOwed == snapshot.getAmountsOwed()
+    assert view.amountsOwed == {"Mac Mathis": 800.0, "Jake Deerin": 0.0}
+
+
+def testSheetReadsTypedValues():
+    connection = FakeConnection()
+    googleSheet = GoogleSheet(connection=connection)
+    googleSheet.addTenant("Mac Mathis", datetime.datetime(2021, 8, 1))
+    rows = connection.spreadsheet.sheet1.get_all_values(
+        value_render_option="UNFORMATTED_VALUE"
+    )
+    assert ["Mac Mathis", 4.0, False] in [row[:3] for row in rows]
+
+    # A month typed in by hand is read as a date serial number (8/1/2021)
+    tenant = googleSheet._getCurrentTenant(["Mac Mathis", 44409, "FULLTIME"])
+    assert tenant.monthsUnpaid == [datetime.datetime(2021, 8, 1)]
+
+
+class FlakyWorksheet:
+    def __init__(self, errors: list):
+        self.errors = errors
+
+    def get_all_values(self):
+        if self.errors:
+            raise self.errors.pop(0)
+        return [["Name", "Months Unpaid", "Stay Schedule"]]
+
+
+def testSheetsClientThrottlesBurstsToQuota():
+    client = SheetsClient(FlakyWorksheet([]), readsPerMinute=60, simulateQuota=True)
+    for i in range(90):
+        client.get_all_values()
+
+    assert client.requestCounts["get_all_values"] == 90
+    # The first 60 go through right away, then 1 per second
+    assert client.simulatedSeconds == pytest.approx(30.0)
+
+
+def testSheetsShareOneQuota(monkeypatch):
+    clock = VirtualClock()
+    quota = SheetsQuota(readsPerMinute=60, clock=clock.time, sleep=clock.sleep)
+    clients = [SheetsClient(FlakyWorksheet([]), quota=quota) for _ in range(2)]
+    for i in range(45):
+        for client in clients:
+            client.get_all_values()
+    # 90 reads between them, so they're throttled like 1 client making 90
+    assert clock.now == pytest.approx(30.0)
+
+    monkeypatch.setattr("app.sheet.SHEETS_BACKEND", "memory")
+    pool = SheetPool()
+    with pool.checkout(_makeHousehold("1")) as firstSheet:
+        with pool.checkout(_makeHousehold("2")) as secondSheet:
+            assert firstSheet._wksheet.quota is secondSheet._wksheet.quota
+
+
+def testSheetsClientRetriesRateLimitErrors():
+    client = SheetsClient(
+        FlakyWorksheet([makeAPIError(429), makeAPIError(503)]), simulateQuota=True
+    )
+    assert client.get_all_values() == [["Name", "Months Unpaid", "Stay Schedule"]]
+    assert client.requestCounts["get_all_values"] == 3
+    assert client.retryCounts["get_all_values"] == 2
+
+
+def testSheetsClientDoesNotRetryOtherErrors():
+    client = SheetsClient(FlakyWorksheet([makeAPIError(400)]), simulateQuota=True)
+    with pytest.raises(APIError):
+        client.get_all_values()
+    assert client.retryCounts["get_all_values"] == 0
+
+
+@pytest.fixture
+def compactSheetRows() -> list:
+    return [
+        ["RentBot Sheet Format", "2"],
+        ["", "", "", "", "Name", "Months Unpaid", "Stay Schedule", "", "Month", "Rows"],
+        ["8/2021", "", "", "", "Mac Mathis", "8/2021", "FULLTIME", "", "8/2021", "3:8"],
+        ["Total Rent", "1,000.00", "", "", "Jake Deerin", "", "HALFTIME"],
+        ["Total Utility", "200.00"],
+        ["Name", "Weeks Stayed", "Paid?"],
+        ["Mac Mathis", "4", "False"],
+        ["Jake Deerin", "2", "True"],
+    ]
+
+
+def testLoadingCompactSheet(compactSheetRows):
+    snapshot = SheetSnapshot(googleSheetConnection, compactSheetRows)
+    assert snapshot.layout.version == 2
+    assert list(snapshot.currentTenants) == ["Mac Mathis", "Jake Deerin"]
+
+    monthData = snapshot.getMonthData(datetime.datetime(2021, 8, 1))
+    assert monthData.totalRent == 1000.0
+    assert monthData.tenants["Jake Deerin"] == MonthlyTenant(
+        name="Jake Deerin", weeksStayed=2.0, isPaid=True
+    )
+    assert snapshot.getMonthData(datetime.datetime(2021, 9, 1)) is None
+
+
+def testCompactSheetMovesMonthThatOutgrowsItsRows(compactSheetRows):
+    snapshot = SheetSnapshot(googleSheetConnection, compactSheetRows)
+    snapshot.addTenant("Taylor Daniel", datetime.datetime(2021, 8, 1))
+    assert snapshot.layout.maxTenants is None
+
+    sheetUpdates = snapshot.getSheetUpdates()
+    assert {"range": "A3:C8", "values": [["", "", ""]] * 6} in sheetUpdates
+    assert {"range": "I3:J3", "values": [["8/2021", "9:17"]]} in sheetUpdates
+    assert snapshot.layout.monthRanges == {(2021, 8): (9, 17)}
+
+
+def testCompactSheetAddsNewMonthsAtTheBottom(compactSheetRows):
+    snapshot = SheetSnapshot(googleSheetConnection, compactSheetRows)
+    snapshot.createNewMonth(datetime.datetime(2021, 9, 14))
+
+    sheetUpdates = snapshot.getSheetUpdates()
+    assert {
+        "range": "I3:J4",
+        "values": [["8/2021", "3:8"], ["9/2021", "9:16"]],
+    } in sheetUpdates
+    assert SheetLayoutV2.getInitialUpdates()[0]["values"] == [
+        ["RentBot Sheet Format", 2]
+    ]
+
+
+def testCompactSheetArchivesMonths(compactSheetRows):
+    compactSheetRows[2][8:] = ["7/2021", "RentBot Archive 2021"]
+    compactSheetRows[3] += ["", "8/2021", "3:8"]
+    snapshot = SheetSnapshot(googleSheetConnection, compactSheetRows)
+    layout = snapshot.layout
+    assert layout.archivedMonths == {(2021, 7): "RentBot Archive 2021"}
+    assert layout.monthRanges == {(2021, 8): (3, 8)}
+
+    septemberData = snapshot.createNewMonth(datetime.datetime(2021, 9, 1))
+    snapshot.getSheetUpdates()
+    sheetUpdates = layout.getArchiveUpdates(
+        {(2021, 8): "RentBot Archive 2021"}, [septemberData]
+    )
+    assert sheetUpdates[0]["range"] == "A3:C10"
+    assert {"range": "A11:C16", "values": [["", "", ""]] * 6} in sheetUpdates
+    assert layout.getIndexUpdates() == [
+        {
+            "range": "I3:J5",
+            "values": [
+                ["7/2021", "RentBot Archive 2021"],
+                ["8/2021", "RentBot Archive 2021"],
+                ["9/2021", "3:10"],
+            ],
+        }
+    ]
+
+
+def testFakeSheetRecordsCallsAndEnforcesQuota():
+    clock = VirtualClock()
+    spreadsheet = FakeSpreadsheet(readsPerMinute=1, clock=clock.time)
+    worksheet = spreadsheet.sheet1
+    worksheet.batch_update([{"range": "A1:B2", "values": [["Name", 2], ["", ""]]}])
+    assert worksheet.get_all_values() == [["Name", "2"]]
+    with pytest.raises(APIError):
+        worksheet.get_all_values()
+    clock.sleep(60)
+    assert worksheet.batch_get(["B1:B1"]) == [[["2"]]]
+
+    calls = spreadsheet.calls
+    assert [call.operation for call in calls] == [
+        "batch_update",
+        "get_all_values",
+        "get_all_values",
+        "batch_get",
+    ]
+    assert calls[2].error is not None
+    assert spreadsheet.getBytesTransferred() > 0
+
+
+def testArchivingAYearOfMonthsGrowsTheArchiveWorksheet():
+    connection = FakeConnection()
+    googleSheet = GoogleSheet(
+        connection=connection, startTime=datetime.datetime(2022, 1, 1)
+    )
+    tenantNames = [f"Tenant {i}" for i in range(6)]
+    snapshot = googleSheet.getSnapshot()
+    for tenantName in tenantNames:
+        snapshot.addTenant(tenantName, datetime.datetime(2022, 1, 1))
+    for month in range(1, 13):
+        time = datetime.datetime(2022, month, 1)
+        snapshot.createNewMonth(time)
+        for tenantName in tenantNames:
+            snapshot.markRentAsPaid(tenantName, time)
+    googleSheet.commitSnapshot(snapshot)
+
+    assert len(googleSheet.archivePaidMonths()) == 12
+    archive = connection.spreadsheet.worksheet("RentBot Archive 2022")
+    assert archive.row_count >= len(archive.rows) > 100
+    decemberData = googleSheet.getSnapshot().getMonthData(
+        datetime.datetime(2022, 12, 1)
+    )
+    assert set(decemberData.tenants) == set(tenantNames)
+
+
+def _addPaidMonths(googleSheet: GoogleSheet, tenantNames: list, months: range):
+    snapshot = googleSheet.getSnapshot()
+    for month in months:
+        time = datetime.datetime(2022, month, 1)
+        snapshot.createNewMonth(time)
+        for tenantName in tenantNames:
+            snapshot.markRentAsPaid(tenantName, time)
+    googleSheet.commitSnapshot(snapshot)
+
+
+def testArchivedMonthsArchivedElsewhereAreFound():
+    connection = FakeConnection()
+    startTime = datetime.datetime(2022, 1, 1)
+    googleSheet = GoogleSheet(connection=connection, startTime=startTime)
+    googleSheet.addTenant("Mac Mathis", startTime)
+    _addPaidMonths(googleSheet, ["Mac Mathis"], range(1, 7))
+    googleSheet.archivePaidMonths()
+    assert googleSheet.getSnapshot().getMonthData(datetime.datetime(2022, 3, 1))
+
+    # e.g. archiveSheet.py, run while the server's up
+    otherSheet = GoogleSheet(connection=connection, startTime=startTime)
+    _addPaidMonths(otherSheet, ["Mac Mathis"], range(7, 13))
+    otherSheet.archivePaidMonths()
+    snapshot = googleSheet.getSnapshot()
+    assert snapshot.layout.archivedMonths[(2022, 12)] == "RentBot Archive 2022"
+    assert snapshot.getMonthData(datetime.datetime(2022, 12, 1)) is not None
+
+
+def testMigratingALongV1HistorySizesTheV2Worksheet():
+    connection = FakeConnection()
+    connection.spreadsheet.sheet1.rows = [["Name", "Months Unpaid", "Stay Schedule"]]
+    startTime = datetime.datetime(2018, 1, 1)
+    googleSheet = GoogleSheet(connection=connection, startTime=startTime)
+    assert googleSheet.formatVersion == 1
+    tenantNames = [f"Tenant {i}" for i in range(12)]
+    months = [datetime.datetime(2018 + i // 12, i % 12 + 1, 1) for i in range(72)]
+    snapshot = googleSheet.getSnapshot()
+    for tenantName in tenantNames:
+        snapshot.addTenant(tenantName, startTime)
+    for month in months:
+        snapshot.createNewMonth(month)
+    googleSheet.commitSnapshot(snapshot)
+    connection.spreadsheet.resetCalls()
+
+    googleSheet.migrateToV2()
+    newWorksheet = connection.spreadsheet.sheet1
+    assert newWorksheet.row_count >= len(newWorksheet.rows) > 1000
+    assert connection.spreadsheet.getCallCounts()["add_rows"] == 0
+    # Each chunk is written before the next one is read
+    operations = [call.operation for call in connection.spreadsheet.calls]
+    lastReadIndex = len(operations) - 1 - operations[::-1].index("batch_get")
+    assert operations[:lastReadIndex].count("batch_update") > 1
+    lastMonthData = googleSheet.getSnapshot().getMonthData(months[-1])
+    assert set(lastMonthData.tenants) == set(tenantNames)
+
+
+def testSheetsClientGrowsTheGridToFitWrites():
+    worksheet = FakeSpreadsheet().add_worksheet("Small", rows=10, cols=3)
+    with pytest.raises(APIError):
+        worksheet.batch_update([{"range": "A11:A11", "values": [["x"]]}])
+    client = SheetsClient(worksheet, simulateQuota=True)
+    client.batch_update([{"range": "A11:A12", "values": [["x"], ["y"]]}])
+    assert worksheet.row_count == 12 + GROW_ROWS
+    assert client.requestCounts == {"add_rows": 1, "batch_update": 1}
+    assert worksheet.get_all_values()[-1] == ["y"]
+
+
+def testSheetCommandsUseOneReadAndOneWrite():
+    connection = FakeConnection()
+    googleSheet = GoogleSheet(connection=connection)
+    connection.spreadsheet.resetCalls()
+
+    googleSheet.addTenant("Mac Mathis", datetime.datetime(2021, 8, 1))
+    assert connection.spreadsheet.getCallCounts() == {
+        "get_all_values": 1,
+        "batch_update": 1,
+    }
+
+
+def testSnapshotsShareParsedModelWithoutSharingChanges():
+    googleSheet = GoogleSheet(connection=FakeConnection())
+    googleSheet.addTenant("Mac Mathis", datetime.datetime(2021, 8, 1))
+    august = datetime.datetime(2021, 8, 1)
+
+    snapshot = googleSheet.getSnapshot()
+    snapshot.markRentAsPaid("Mac Mathis", august)
+    assert snapshot.getMonthData(august).tenants["Mac Mathis"].isPaid
+
+    otherSnapshot = googleSheet.getSnapshot()
+    assert otherSnapshot._model is snapshot._model
+    assert not otherSnapshot.getMonthData(august).tenants["Mac Mathis"].isPaid
+    assert otherSnapshot.currentTenants["Mac Mathis"].monthsUnpaid == [august]
+
+
+def testJournaledUpdatesSurviveSheetOutage(tmp_path):
+    journalPath = str(tmp_path / "journal.jsonl")
+    connection = FakeConnection()
+    googleSheet = GoogleSheet(connection=connection, journalPath=journalPath)
+    replayer = googleSheet._journalReplayer
+    replayer.retrySeconds = 60
+
+    snapshot = googleSheet.getSnapshot()
+    snapshot.addTenant("Mac Mathis", datetime.datetime(2021, 8, 1))
+    connection.spreadsheet.failNext(makeAPIError(503))
+    googleSheet.commitSnapshot(snapshot)
+    assert len(SheetJournal(journalPath).getPending()) == 1
+    # The tenant shows up even before the sheet has them
+    assert "Mac Mathis" in googleSheet.getSnapshot().currentTenants
+
+    replayer.flushInBackground()
+    replayer._thread.join(timeout=5)
+    assert SheetJournal(journalPath).getPending() == []
+    restartedSheet = GoogleSheet(connection=connection)
+    assert "Mac Mathis" in restartedSheet.getSnapshot().currentTenants
+
+
+def testMaintenanceWaitsForTheServersJournal(tmp_path):
+    journalPath = str(tmp_path / "journal.jsonl")
+    journal = SheetJournal(journalPath)
+    seq = journal.append([{"range": "E3:G3", "values": [["Mac Mathis", "", ""]]}])
+    with pytest.raises(UnwrittenUpdatesError):
+        openSheetForMaintenance(journalPath)
+
+    journal.acknowledge(seq)
+    googleSheet = openSheetForMaintenance(journalPath)
+    # The job's own writes aren't journaled at all
+    assert googleSheet._journalReplayer is None
+    googleSheet.addTenant("Mac Mathis", datetime.datetime(2021, 8, 1))
+    assert SheetJournal(journalPath).getPending() == []
+
+
+def testRestartedSheetAnswersFromCacheThenRevalidates(tmp_path):
+    cachePath = str(tmp_path / "sheet-cache.json")
+    connection = FakeConnection()
+    googleSheet = GoogleSheet(connection=connection, cachePath=cachePath)
+    googleSheet.addTenant("Mac Mathis", datetime.datetime(2021, 8, 1))
+    googleSheet.setTotalRent(1000, datetime.datetime(2021, 8, 1))
+    assert googleSheet.getAmountsOwed() == {"Mac Mathis": 1000.0}
+
+    # Someone edits the sheet while we're down
+    GoogleSheet(connection=connection).setTotalRent(1200, datetime.datetime(2021, 8, 1))
+    connection.spreadsheet.resetCalls()
+    connection.spreadsheet.latencySeconds = 0.2
+    restartedSheet = GoogleSheet(connection=connection, cachePath=cachePath)
+    # Answered from the cache, without waiting on the (slow) sheet
+    assert restartedSheet.getAmountsOwed() == {"Mac Mathis": 1000.0}
+    assert restartedSheet._isRevalidated.wait(timeout=5)
+    assert restartedSheet.getAmountsOwed() == {"Mac Mathis": 1200.0}
+    assert connection.spreadsheet.getCallCounts()["get_all_values"] == 1
+
+
+def testWritesAreCachedBeforeAmountsOwedAreNeeded(tmp_path):
+    cachePath = str(tmp_path / "sheet-cache.json")
+    connection = FakeConnection()
+    googleSheet = GoogleSheet(connection=connection, cachePath=cachePath)
+    googleSheet.addTenant("Mac Mathis", datetime.datetime(2021, 8, 1))
+    googleSheet.setTotalRent(1000, datetime.datetime(2021, 8, 1))
+    assert googleSheet._amountsOwedView is None
+
+    restartedSheet = GoogleSheet(connection=connection, cachePath=cachePath)
+    # Totaled up from the cached rows, before the sheet's even been checked
+    assert restartedSheet._amountsOwedView.amountsOwed == {"Mac Mathis": 1000.0}
+    assert restartedSheet._isRevalidated.wait(timeout=5)
+    assert restartedSheet.getAmountsOwed() == {"Mac Mathis": 1000.0}
+
+
+def testInstancesShareSheetReadsAndInvalidations():
+    server = FakeRedisServer()
+    server.start()
+    connection = FakeConnection()
+    sheetA = GoogleSheet(
+        connection=connection, sharedCache=RedisSharedCache(server.url)
+    )
+    sheetB = GoogleSheet(
+        connection=connection, sharedCache=RedisSharedCache(server.url)
+    )
+    sheetA.addTenant("Mac Mathis", datetime.datetime(2021, 8, 1))
+    assert sheetA.getAmountsOwed() == sheetB.getAmountsOwed() == {"Mac Mathis": 0.0}
+    deadline = time.monotonic() + 5
+    while server.commands.count("SUBSCRIBE") < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    connection.spreadsheet.resetCalls()
+    sheetA.setTotalRent(1000, datetime.datetime(2021, 8, 1))
+    deadline = time.monotonic() + 5
+    while sheetB._amountsOwedView.amountsOwed["Mac Mathis"] == 0.0:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert sheetB.getAmountsOwed() == {"Mac Mathis": 1000.0}
+    # Neither instance had to download the sheet again
+    assert connection.spreadsheet.getCallCounts()["get_all_values"] == 0
+    server.stop()
+
+
+def testWritesArePublishedEvenWithoutAmountsOwed():
+    sharedCache = MemorySharedCache()
+    connection = FakeConnection()
+    sheetA = GoogleSheet(connection=connection, sharedCache=sharedCache)
+    sheetB = GoogleSheet(connection=connection, sharedCache=sharedCache)
+    sheetB.addTenant("Mac Mathis", datetime.datetime(2021, 8, 1))
+    assert sheetB.getAmountsOwed() == {"Mac Mathis": 0.0}
+    messages = []
+    sharedCache.subscribe(makeKey("changed", sheetA._sharedKey), messages.append)
+
+    sheetA.setTotalRent(1000, datetime.datetime(2021, 8, 1))
+    assert sheetA._amountsOwedView is None
+    assert messages == [connection.spreadsheet.get_lastUpdateTime()]
+    connection.spreadsheet.resetCalls()
+    assert sheetB.getAmountsOwed() == {"Mac Mathis": 1000.0}
+    # (rebuilt from the rows the writer shared)
+    assert connection.spreadsheet.getCallCounts()["get_all_values"] == 0
+
+
+def testCoalesceUpdatesKeepsLastWriteToEachCell():
+    coalesced = coalesceUpdates(
+        [
+            [{"range": "A1:C1", "values": [["a", "b", "c"]]}],
+            [{"range": "B1:B2", "values": [["B"], ["x"]]}],
+        ]
+    )
+    assert coalesced == [
+        {"range": "A1:C1", "values": [["a", "B", "c"]]},
+        {"range": "B2:B2", "values": [["x"]]},
+    ]
+
+
+def testHistogramRendersCumulativeBuckets():
+    histogram = metrics.Histogram(
+        "test_seconds", "Test histogram", ["outcome"], buckets=[0.1, 1.0]
+    )
+    histogram.observe(0.05, outcome="ok")
+    histogram.observe(0.5, outcome="ok")
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{outcome="ok",le="0.1"} 1',
+        'test_seconds_bucket{outcome="ok",le="1.0"} 2',
+        'test_seconds_bucket{outcome="ok",le="+Inf"} 2',
+        'test_seconds_sum{outcome="ok"} 0.55',
+        'test_seconds_count{outcome="ok"} 2',
+    ]
+
+
+def testRetryFuncRecordsScrapeMetrics():
+    errors = [RuntimeError("Page didn't load")]
+
+    def flakyScrape():
+        if errors:
+            raise errors.pop()
+        return "charges"
+
+    assert retry_func(flakyScrape, 2, "test-provider") == "charges"
+    assert metrics.SCRAPE_RETRIES.get(provider="test-provider") == 1
+    assert (
+        metrics.SCRAPE_SECONDS.getCount(provider="test-provider", outcome="error") == 1
+    )
+    assert metrics.SCRAPE_SECONDS.getCount(provider="test-provider", outcome="ok") == 1
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs /proc")
+def testScrapeSandboxEnforcesLimitsAndKillsLeftovers():
+    assert runSandboxed("json:loads", ["[1, 2]"]) == [1, 2]
+
+    # A "browser" left running in the background is killed
+    assert runSandboxed("os:system", ["sleep 31.337 &"]) == 0
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                assert b"31.337" not in f.read()
+        except OSError:
+            continue
+
+    with pytest.raises(ScrapeSandboxError, match="within"):
+        runSandboxed("time:sleep", [30], deadlineSeconds=0.5)
+    hog = "[[b'x' * 2**20 for _ in range(200)], __import__('time').sleep(30)]"
+    with pytest.raises(ScrapeSandboxError, match="memory"):
+        runSandboxed("builtins:eval", [hog], deadlineSeconds=20, maxRssBytes=2**26)
+
+
+class FakeCdpDriver:
+    def __init__(self, responses: dict):
+        self.responses = responses
+        self.events = []
+        for i, (url, body) in enumerate(responses.items()):
+            response = {"url": url, "status": 200, "mimeType": "application/json"}
+            self.events += [
+                {
+                    "method": "Network.responseReceived",
+                    "params": {"requestId": str(i), "response": response},
+                },
+                {"method": "Network.loadingFinished", "params": {"requestId": str(i)}},
+            ]
+
+    def get_log(self, logType: str) -> list:
+        events, self.events = self.events, []
+        return [{"message": json.dumps({"message": event})} for event in events]
+
+    def execute_cdp_cmd(self, command: str, params: dict) -> dict:
+        url = list(self.responses)[int(params["requestId"])]
+        return {"body": json.dumps(self.responses[url]), "base64Encoded": False}
+
+
+def testNetworkCaptureReadsChargesFromPortalJson():
+    driver = FakeCdpDriver(
+        {
+            "https://portal.example/api/profile": {
+                "name": "Mac",
+                "since": "2020-01-01",
+            },
+            "https://portal.example/api/billing/history": {
+                "summary": {"balance": "$0.00"},
+                "transactions": [
+                    {
+                        "postedDate": "2024-12-27T00:00:00Z",
+                        "type": "Bill",
+                        "amount": 105.5,
+                    },
+                    {
+                        "postedDate": "2025-01-10",
+                        "type": "Payment",
+                        "amount": "-$105.50",
+                    },
+                    {
+                        "date": "01/14/2025",
+                        "description": "Rent",
+                        "chargeAmount": "$1,697.00",
+                        "paymentAmount": 0,
+                    },
+                ],
+            },
+        }
+    )
+    records = NetworkCapture(driver, r"billing").waitForChargeRecords(timeout=1)
+    assert [(r["date"], r["charge_cents"], r["payment_cents"]) for r in records] == [
+        ("2024-12-27", 10550, 0),
+        ("2025-01-10", 0, 10550),
+        ("2025-01-14", 169700, 0),
+    ]
+
+
+class BillPortalStandIn:
+    """A local bill portal whose billing API needs a login cookie"""
+
+    def __init__(self, billingResponse: dict = None):
+        self.numLogins = 0
+        self.isChallenging = False
+        self.billingResponse = billingResponse or BILLING_RESPONSE
+        standIn = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if standIn.isChallenging:
+                    return self._send(503, "text/html", CHALLENGE_PAGE)
+                if self.path != "/api/billing":
+                    return self._send(200, "text/html", "<form>Log in</form>")
+                if "session=ok" not in self.headers.get("Cookie", ""):
+                    self.send_response(302)
+                    self.send_header("Location", "/login")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self._send(200, "application/json", json.dumps(standIn.billingResponse))
+
+            def do_POST(self):
+                form = self.rfile.read(int(self.headers["Content-Length"])).decode()
+                if form != "username=mac&password=hunter2":
+                    return self._send(401, "text/html", "Wrong password")
+                standIn.numLogins += 1
+                self.send_response(303)
+                self.send_header("Set-Cookie", "session=ok; Path=/")
+                self.send_header("Location", "/")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def _send(self, status: int, contentType: str, body: str):
+                self.send_response(status)
+                self.send_header("Content-Type", contentType)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+
+BILLING_RESPONSE = {
+    "bills": [
+        {"billDate": "2025-01-02", "description": "Bill", "amount": 82.25},
+        {"billDate": "2025-01-20", "description": "Payment", "amount": -82.25},
+    ]
+}
+CHALLENGE_PAGE = "<html><head><title>Just a moment...</title></head></html>"
+
+
+def testHttpFastPathReusesCookiesAndFallsBackOnChallenge(tmp_path, monkeypatch):
+    portal = BillPortalStandIn()
+    try:
+        client = HttpBillClient(
+            "internet",
+            f"{portal.url}/api/billing",
+            loginUrl=f"{portal.url}/login",
+            cookieDir=str(tmp_path),
+        )
+        records = client.fetchChargeRecords("mac", "hunter2")
+        assert [(r["charge_cents"], r["payment_cents"]) for r in records] == [
+            (8225, 0),
+            (0, 8225),
+        ]
+        # A restarted server uses the saved cookies instead of logging in again
+        restartedClient = HttpBillClient(
+            "internet",
+            f"{portal.url}/api/billing",
+            loginUrl=f"{portal.url}/login",
+            cookieDir=str(tmp_path),
+        )
+        assert restartedClient.fetchChargeRecords("mac", "hunter2") == records
+        assert portal.numLogins == 1
+
+        browserScrapes = []
+
+        def scrapeWithBrowser(username: str, password: str):
+            browserScrapes.append(username)
+            return getRents.recent_charges_from_records(records[:1])
+
+        provider = getRents.BillProvider(
+            "internet", "mac", "hunter2", scrapeWithBrowser, restartedClient
+        )
+        monkeypatch.setitem(getRents.PROVIDERS, "internet", provider)
+        monkeypatch.setattr(getRents, "SCRAPE_IN_SANDBOX", False)
+        assert len(getRents.fetch_provider_charges("internet")) == 2
+        assert browserScrapes == []
+
+        portal.isChallenging = True
+        with pytest.raises(BotChallengeError):
+            restartedClient.fetchChargeRecords("mac", "hunter2")
+        assert len(getRents.fetch_provider_charges("internet")) == 1
+        assert browserScrapes == ["mac"]
+        assert metrics.SCRAPE_PATHS.get(provider="internet", path="http") == 1
+        assert metrics.SCRAPE_PATHS.get(provider="internet", path="browser") == 1
+    finally:
+        portal.stop()
+
+
+def testHttpFastPathHistoryOnlyCountsTheMonthsBill(tmp_path):
+    portal = BillPortalStandIn(
+        {
+            "bills": [
+                {"billDate": "2025-01-05", "description": "Bill", "amount": 80.00},
+                {"billDate": "2025-01-20", "description": "Payment", "amount": -80.0},
+                {"billDate": "2025-02-05", "description": "Bill", "amount": 82.25},
+                {"billDate": "2025-02-20", "description": "Payment", "amount": -82.25},
+            ]
+        }
+    )
+    try:
+        client = HttpBillClient(
+            "internet",
+            f"{portal.url}/api/billing",
+            loginUrl=f"{portal.url}/login",
+            cookieDir=str(tmp_path),
+        )
+        internet = getRents.recent_charges_from_records(
+            client.fetchChargeRecords("mac", "hunter2")
+        )
+    finally:
+        portal.stop()
+    assert len(internet) == 4
+    apartment = _makeCharges(("2025-03-01", 170000))
+    charges = getRents.get_monthly_charges(
+        apartment, apartment.iloc[:0], internet, datetime.date(2025, 3, 1)
+    )
+    assert charges == getRents.MonthlyCharges(170000, 8225)
+
+
+def _makeCharges(*bills):
+    """Makes a provider's recent charges from (date, cents) bills"""
+    return getRents.recent_charges_from_records(
+        [
+            {
+                "date": billDate,
+                "description": "Bill",
+                "charge_cents": cents,
+                "payment_cents": 0,
+                "balance_cents": cents,
+            }
+            for billDate, cents in bills
+        ]
+    )
+
+
+def testOnlyTheMonthsInternetBillCounts():
+    apartment = _makeCharges(("2025-03-01", 170000))
+    electricity = _makeCharges(("2025-02-27", 8000))
+    # The scrapers get the whole history, payments and all
+    internet = getRents.recent_charges_from_records(
+        [
+            {
+                "date": billDate,
+                "description": description,
+                "charge_cents": chargeCents,
+                "payment_cents": paymentCents,
+                "balance_cents": 0,
+            }
+            for billDate, description, chargeCents, paymentCents in [
+                ("2024-12-05", "Bill", 5000, 0),
+                ("2025-01-05", "Bill", 5000, 0),
+                ("2025-01-20", "Payment", 0, 5000),
+                ("2025-02-05", "Bill", 5500, 0),
+                ("2025-02-20", "Payment", 0, 5500),
+            ]
+        ]
+    )
+    charges = getRents.get_monthly_charges(
+        apartment, electricity, internet, datetime.date(2025, 3, 1)
+    )
+    assert charges == getRents.MonthlyCharges(170000, 8000 + 5500)
+    charges = getRents.get_monthly_charges(
+        apartment,
+        electricity,
+        internet,
+        datetime.date(2025, 3, 1),
+        internet_window=(datetime.date(2024, 12, 29), datetime.date(2025, 1, 12)),
+    )
+    assert charges == getRents.MonthlyCharges(170000, 8000 + 5000)
+
+
+def testBillSchedulerWaitsForLateBillsInQuietHours(tmp_path):
+    portals = {
+        "apartment": _makeCharges(("2025-02-01", 170000), ("2025-03-01", 170000)),
+        "electricity": _makeCharges(("2025-01-28", 9000), ("2025-02-27", 8000)),
+        # Xfinity posts mid-month
+        "internet": _makeCharges(("2025-01-15", 5000), ("2025-02-15", 5000)),
+    }
+    scrapes = []
+
+    def scrape(provider: str):
+        scrapes.append(provider)
+        return portals[provider]
+
+    now = datetime.datetime(2025, 3, 1, 9, 0)
+    readyCharges = []
+
+    def makeScheduler() -> BillScheduler:
+        return BillScheduler(
+            scrape,
+            readyCharges.append,
+            statePath=str(tmp_path / "schedule.json"),
+            quietHours=(1, 6),
+            now=lambda: now,
+        )
+
+    scheduler = makeScheduler()
+    scheduler.startMonth(datetime.date(2025, 3, 4))
+    assert not scheduler.tick()
+    assert sorted(scrapes) == ["apartment", "electricity", "internet"]
+    assert scheduler.getExpectedDate("internet") == datetime.date(2025, 3, 15)
+    assert scheduler.schedules["internet"].nextPollAt == datetime.datetime(
+        2025, 3, 15, 1, 0
+    )
+    assert readyCharges == []
+
+    # Nothing's polled before then, even after a restart
+    now = datetime.datetime(2025, 3, 10, 2, 0)
+    scheduler = makeScheduler()
+    assert scheduler.isPending()
+    assert not scheduler.tick()
+    assert len(scrapes) == 3
+
+    now = datetime.datetime(2025, 3, 15, 1, 0)
+    portals["internet"] = _makeCharges(
+        ("2025-01-15", 5000), ("2025-02-15", 5000), ("2025-03-15", 5500)
+    )
+    assert scheduler.tick()
+    assert scrapes[3:] == ["internet"]
+    assert readyCharges == [getRents.MonthlyCharges(170000, 8000 + 5500)]
+    assert metrics.BILL_POLLS.get(provider="internet", outcome="notPosted") == 1
+
+    assert getNextQuietTime(datetime.datetime(2025, 3, 1, 23, 30), (22, 5)) == (
+        datetime.datetime(2025, 3, 1, 23, 30)
+    )
+    assert getNextQuietTime(datetime.datetime(2025, 3, 1, 7, 0), (22, 5)) == (
+        datetime.datetime(2025, 3, 1, 22, 0)
+    )
+
+
+def testBillSchedulerStatusDoesntWaitOnScrapesAndKeepsErrors(tmp_path):
+    portals = {
+        "apartment": _makeCharges(("2025-03-01", 170000)),
+        "electricity": _makeCharges(("2025-03-01", 8000)),
+        "internet": _makeCharges(("2025-03-01", 5000)),
+    }
+    isScraping = threading.Event()
+    canFinishScraping = threading.Event()
+
+    def scrape(provider: str):
+        isScraping.set()
+        canFinishScraping.wait(5)
+        return portals[provider]
+
+    readyCharges = []
+
+    def onBillsReady(monthlyCharges: getRents.MonthlyCharges):
+        if not readyCharges:
+            readyCharges.append(None)
+            raise RuntimeError("The sheet is down")
+        readyCharges.append(monthlyCharges)
+
+    scheduler = BillScheduler(
+        scrape,
+        onBillsReady,
+        statePath=str(tmp_path / "schedule.json"),
+        quietHours=None,
+        now=lambda: datetime.datetime(2025, 3, 1, 9, 0),
+    )
+    scheduler.startMonth(datetime.date(2025, 3, 1))
+    scheduler.runInBackground()
+    assert isScraping.wait(5)
+    # The scrape is still going, but the status doesn't wait for it
+    statusThread = threading.Thread(target=scheduler.getStatus)
+    statusThread.start()
+    statusThread.join(1)
+    assert not statusThread.is_alive()
+    canFinishScraping.set()
+    scheduler._thread.join(5)
+
+    assert scheduler.isPending()
+    assert scheduler.getStatus()["lastError"] == "RuntimeError('The sheet is down')"
+    scheduler.runInBackground()
+    scheduler._thread.join(5)
+    assert not scheduler.isPending()
+    assert scheduler.getStatus()["lastError"] is None
+    assert readyCharges[1] == getRents.MonthlyCharges(170000, 8000 + 5000)
+
+
+def testBillSchedulerOnlyStartsWithTheServer(tmp_path, monkeypatch):
+    # Importing the server (e.g. from the pipeline job) doesn't resume scraping
+    assert main.BILL_SCHEDULER is None
+
+    monkeypatch.setattr(
+        main,
+        "BillScheduler",
+        lambda **kwargs: BillScheduler(
+            statePath=str(tmp_path / "schedule.json"), **kwargs
+        ),
+    )
+    with TestClient(app):
+        assert main.BILL_SCHEDULER is not None
+        assert not main.BILL_SCHEDULER.isPending()
+    monkeypatch.setattr(main, "BILL_SCHEDULER", None)
+
+
+def testMetricsEndpointCountsIgnoredMessages():
+    client = TestClient(app)
+    client.post("/", json={"text": "who wants tacos", "name": "Mac Mathis"})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert (
+        'rentbot_command_duration_seconds_count{command="none",outcome="ignored"}'
+        in response.text
+    )
+
+
+def testWebhookDropsChatterAndBotMessagesUnparsed(monkeypatch):
+    handledMessages = []
+    monkeypatch.setattr(
+        main, "handleGroupMeMessage", lambda msg: handledMessages.append(msg)
+    )
+    assert not main.mightBeCommand(b'{"text": "who wants tacos", "name": "Mac"}')
+    assert main.mightBeCommand(b'{"text": "\\/rent show", "name": "Mac"}')
+
+    client = TestClient(app)
+    response = client.post("/", content=b'{"text": "who wants tacos", "attachments"')
+    assert response.json() == ["Not a RentBot command", 200]
+    assert handledMessages == []
+    response = client.post("/", content=b'{"text": "/rent show"')
+    assert response.status_code == 422
+
+    monkeypatch.undo()
+    response = client.post(
+        "/", json={"text": "/rent show", "name": "RentBot", "sender_type": "bot"}
+    )
+    assert response.json() == ["Not a RentBot command", 200]
+
+
+def testSheetCallsAreTracedAsNestedSpans():
+    with tracing.startTrace("test") as rootSpan:
+        googleSheetConnection.addTenant("Mac Mathis", datetime.datetime(2021, 8, 1))
+
+    spans = tracing.EXPORTER.getRecentSpans(rootSpan.traceId)
+    spansByName = {span.name: span for span in spans}
+    assert spansByName["sheet.addTenant"].parentId == rootSpan.spanId
+    addTenantId = spansByName["sheet.addTenant"].spanId
+    assert spansByName["sheet.getSnapshot"].parentId == addTenantId
+    assert (
+        spansByName["sheets.get_all_values"].parentId
+        == spansByName["sheet.getSnapshot"].spanId
+    )
+    assert spansByName["sheets.batch_update"].durationSeconds >= 0
+
+
+def testDebugTracesEndpointReturnsChromeTrace(monkeypatch):
+    monkeypatch.setattr(main, "PROFILER", Profiler(secret="shh"))
+    client = TestClient(app)
+    # (mentions "/rent", so it isn't dropped before being traced)
+    client.post("/", json={"text": "tacos before /rent?", "name": "Mac Mathis"})
+
+    params = {"format": "chrome"}
+    assert client.get("/debug/traces", params=params).status_code == 403
+    headers = {"X-RentBot-Profile": signProfileRequest("shh")}
+    response = client.get("/debug/traces", params=params, headers=headers)
+    events = response.json()["traceEvents"]
+    assert events[-1]["name"] == "webhook"
+    assert events[-1]["args"]["outcome"] == "ignored"
+
+
+def testProfilerKeepsOnlyNewestProfiles(tmp_path):
+    profiler = Profiler(directory=str(tmp_path), sampleRate=0.0, maxFiles=2)
+    with profiler.profile("skipped"):
+        pass
+    assert profiler.listProfiles() == []
+
+    for name in ["first", "second", "third"]:
+        with profiler.profile(name, force=True):
+            sum(range(1000))
+    profiles = profiler.listProfiles()
+    assert [fileName.split("-", 1)[1] for fileName in profiles] == [
+        "third.prof",
+        "second.prof",
+    ]
+    assert profiler.getProfilePath("../secrets.prof") is None
+
+
+def testProfilesCanOnlyBeSeenWithASignedRequest(tmp_path, monkeypatch):
+    profiler = Profiler(directory=str(tmp_path), secret="shh")
+    with profiler.profile("webhook", force=True):
+        sum(range(1000))
+    (fileName,) = profiler.listProfiles()
+    monkeypatch.setattr(main, "PROFILER", profiler)
+    client = TestClient(app)
+
+    for path in ["/debug/profiles", f"/debug/profiles/{fileName}"]:
+        assert client.get(path).status_code == 403
+        wrongHeaders = {"X-RentBot-Profile": signProfileRequest("wrong")}
+        assert client.get(path, headers=wrongHeaders).status_code == 403
+    headers = {"X-RentBot-Profile": signProfileRequest("shh")}
+    assert client.get("/debug/profiles", headers=headers).json() == {
+        "profiles": [fileName]
+    }
+    response = client.get(f"/debug/profiles/{fileName}", headers=headers)
+    assert response.status_code == 200
+
+
+def testProfilerOnlyTrustsFreshSignatures():
+    profiler = Profiler(secret="shh")
+    assert profiler.isValidSignature(signProfileRequest("shh"))
+    assert not profiler.isValidSignature(signProfileRequest("wrong"))
+    assert not profiler.isValidSignature(signProfileRequest("shh", timestamp=0))
+    assert not Profiler(secret="").isValidSignature(signProfileRequest(""))
+
+
+def _makeHousehold(groupId: str) -> Household:
+    return Household(
+        groupId=groupId,
+        botId=f"bot-{groupId}",
+        sheetsUrl=f"memory://{groupId}",
+        startTime=datetime.datetime(2021, 8, 1),
+    )
+
+
+def testSheetPoolClosesIdleAndLeastRecentlyUsedSheets():
+    clock = VirtualClock()
+    pool = SheetPool(
+        maxSheets=2,
+        idleSeconds=60,
+        openSheet=lambda household: GoogleSheet(
+            connection=FakeConnection(),
+            sheetsUrl=household.sheetsUrl,
+            startTime=household.startTime,
+        ),
+        clock=clock.time,
+    )
+    households = [_makeHousehold(str(i)) for i in range(3)]
+    with pool.checkout(households[0]) as firstSheet:
+        pass
+    with pool.checkout(households[1]):
+        # The first household's sheet is reused rather than opened again
+        with pool.checkout(households[0]) as sheet:
+            assert sheet is firstSheet
+    with pool.checkout(households[2]):
+        pass
+    assert len(pool) == 2
+    with pool.checkout(households[0]) as sheet:
+        assert sheet is firstSheet
+        clock.sleep(61)
+    assert len(pool) == 1
+
+
+def testSheetPoolUnsubscribesClosedSheets():
+    server = FakeRedisServer()
+    server.start()
+    sharedCache = RedisSharedCache(server.url)
+    connection = FakeConnection()
+    clock = VirtualClock()
+    pool = SheetPool(
+        maxSheets=1,
+        idleSeconds=60,
+        openSheet=lambda household: GoogleSheet(
+            connection=connection,
+            sheetsUrl=household.sheetsUrl,
+            startTime=household.startTime,
+            sharedCache=sharedCache,
+        ),
+        clock=clock.time,
+    )
+    for _ in range(3):
+        with pool.checkout(_makeHousehold("1")) as sheet:
+            channel = makeKey("changed", sheet._sharedKey)
+        clock.sleep(61)
+        with pool.checkout(_makeHousehold("2")):
+            pass
+    assert len(pool) == 1
+    assert channel not in sharedCache._callbacks
+    deadline = time.monotonic() + 5
+    while server.getNumSubscribers(channel) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert server.getNumSubscribers(channel) == 0
+    server.stop()
+
+
+def testWebhookRoutesMessagesByGroup(monkeypatch):
+    households = [_makeHousehold("1"), _makeHousehold("2")]
+    pool = SheetPool()
+    sentMessages = []
+    monkeypatch.setattr(main, "HOUSEHOLDS", HouseholdRouter(households))
+    monkeypatch.setattr(main, "SHEET_POOL", pool)
+    monkeypatch.setattr(
+        main, "sendBotMessage", lambda botId, text: sentMessages.append(botId)
+    )
+    client = TestClient(app)
+
+    client.post("/", json={"text": "/rent add", "name": "Mac", "group_id": "2"})
+    assert sentMessages == ["bot-2"]
+    with pool.checkout(households[1]) as googleSheet:
+        assert googleSheet.getAmountsOwed() == {"Mac": 0.0}
+    with pool.checkout(households[0]) as googleSheet:
+        assert googleSheet.getAmountsOwed() == {}
+
+    response = client.post("/", json={"text": "/rent show", "name": "Mac"})
+    assert response.json()[1] == 404
+
+
+def testBatchWithBadArgumentsWritesNothing(monkeypatch):
+    household = _makeHousehold("batch")
+    pool = SheetPool()
+    sentMessages = []
+    monkeypatch.setattr(main, "HOUSEHOLDS", HouseholdRouter([household]))
+    monkeypatch.setattr(main, "SHEET_POOL", pool)
+    monkeypatch.setattr(
+        main, "sendBotMessage", lambda botId, text: sentMessages.append(text)
+    )
+    client = TestClient(app)
+    client.post("/", json={"text": "/rent add", "name": "Mac", "group_id": "batch"})
+    with pool.checkout(household) as googleSheet:
+        spreadsheet = googleSheet._sheet
+    spreadsheet.resetCalls()
+    sentMessages.clear()
+
+    text = "/rent batch\nadd Dee\nrent-amt 1697\nutility-amt lots"
+    response = client.post("/", json={"text": text, "name": "Mac", "group_id": "batch"})
+    assert response.json()[1] == 400
+    assert len(sentMessages) == 1
+    assert "couldn't read that amount" in sentMessages[0]
+    assert "batch_update" not in spreadsheet.getCallCounts()
+    with pool.checkout(household) as googleSheet:
+        assert googleSheet.getAmountsOwed() == {"Mac": 0.0}
+
+
+def testUnchangedScrapedChargesAreNotRewrittenOrAnnounced(monkeypatch):
+    household = _makeHousehold("charges")
+    pool = SheetPool()
+    sentMessages = []
+    monkeypatch.setattr(main, "SHEET_POOL", pool)
+    monkeypatch.setattr(
+        main, "sendBotMessage", lambda botId, text: sentMessages.append(text)
+    )
+
+    main._setRents(household, getRents.MonthlyCharges(169700, 12050))
+    assert "rent $0.00 -> $1697.00, utilities $0.00 -> $120.50" in sentMessages[0]
+    assert sentMessages[1].startswith("=== Rents Due ===")
+
+    with pool.checkout(household) as googleSheet:
+        spreadsheet = googleSheet._sheet
+    spreadsheet.resetCalls()
+    sentMessages.clear()
+    main._setRents(household, getRents.MonthlyCharges(169700, 12050))
+    assert sentMessages == []
+    assert "batch_update" not in spreadsheet.getCallCounts()
+
+    main._setRents(household, getRents.MonthlyCharges(169700, 9925))
+    assert sentMessages[0].endswith("utilities $120.50 -> $99.25")
+    assert spreadsheet.getCallCounts()["batch_update"] == 1
+
+
+def testMonthPipelineResumesFromCheckpoint(tmp_path, monkeypatch):
+    households = [
+        dataclasses.replace(_makeHousehold("pipeline"), scrapeBills=True),
+        _makeHousehold("pipeline-2"),
+    ]
+    sentMessages = []
+    monkeypatch.setattr(main, "SHEET_POOL", SheetPool())
+    monkeypatch.setattr(
+        main, "sendBotMessage", lambda botId, text: sentMessages.append(botId)
+    )
+    portals = {
+        "apartment": _makeCharges(("2025-03-01", 170000), ("2025-03-03", 3000)),
+        "electricity": _makeCharges(("2025-02-27", 8000)),
+        "internet": _makeCharges(("2025-01-15", 5000), ("2025-02-15", 5500)),
+    }
+    scrapes = []
+
+    def scrape(provider: str):
+        scrapes.append(provider)
+        if provider == "electricity" and scrapes.count(provider) == 1:
+            raise RuntimeError("Georgia Power is down")
+        return portals[provider]
+
+    def runPipeline(month: datetime.datetime, isDryRun: bool = False) -> dict:
+        checkpoint = Checkpoint(
+            str(tmp_path / f"{month:%Y-%m}.json"), isReadOnly=isDryRun
+        )
+        return MonthPipeline(
+            households, month, month.date(), checkpoint, isDryRun, scrape
+        ).run()
+
+    flushedSheets = []
+    flushJournal = GoogleSheet.flushJournal
+
+    def recordFlush(googleSheet: GoogleSheet):
+        flushedSheets.append(googleSheet.sheetsUrl)
+        flushJournal(googleSheet)
+
+    monkeypatch.setattr(GoogleSheet, "flushJournal", recordFlush)
+
+    march = datetime.datetime(2025, 3, 1)
+    with pytest.raises(RuntimeError):
+        runPipeline(march)
+    assert scrapes == ["internet", "electricity"]
+    assert sentMessages == []
+    # Every sheet the new month was added to is flushed, scraped bills or not
+    assert flushedSheets == ["memory://pipeline", "memory://pipeline-2"]
+
+    # The rerun picks up with the scrape that failed
+    timings = runPipeline(march)
+    assert list(timings) == ["scrape", "compute", "write", "announce"]
+    assert scrapes[2:] == ["electricity", "apartment"]
+    assert sentMessages == ["bot-pipeline"] * 3 + ["bot-pipeline-2"]
+    with main.SHEET_POOL.checkout(households[0]) as googleSheet:
+        monthData = googleSheet.getSnapshot().getMonthData(march)
+    assert (monthData.totalRent, monthData.totalUtility) == (1700.0, 30.0 + 135.0)
+
+    assert runPipeline(march) == {}
+    assert len(scrapes) == 4
+
+    april = datetime.datetime(2025, 4, 1)
+    portals["apartment"] = _makeCharges(("2025-04-01", 170000))
+    runPipeline(april, isDryRun=True)
+    assert len(sentMessages) == 4
+    assert not (tmp_path / "2025-04.json").exists()
+    with main.SHEET_POOL.checkout(households[0]) as googleSheet:
+        assert googleSheet.getSnapshot().getMonthData(april) is None
+
+
+def testPipelineRunsForOneHouseholdGetTheirOwnCheckpoint(tmp_path, monkeypatch):
+    households = [_makeHousehold("pipeline-a"), _makeHousehold("pipeline-b")]
+    monkeypatch.setattr(main, "HOUSEHOLDS", HouseholdRouter(households))
+    monkeypatch.setattr(main, "SHEET_POOL", SheetPool())
+    monkeypatch.setattr(main, "sendBotMessage", lambda botId, text: None)
+    monkeypatch.setattr(pipeline, "CHECKPOINT_DIR", str(tmp_path))
+    march = datetime.datetime(2025, 3, 1)
+    args = {"month": march, "dry_run": False}
+
+    assert pipeline.runMonth(argparse.Namespace(group_id="pipeline-a", **args)) == 0
+    assert pipeline.runMonth(argparse.Namespace(group_id=None, **args)) == 0
+    # The full run still did the household that wasn't in the first one
+    with main.SHEET_POOL.checkout(households[1]) as googleSheet:
+        assert googleSheet.getSnapshot().getMonthData(march) is not None
+    assert pipeline.getCheckpointPath(march) != pipeline.getCheckpointPath(
+        march, "pipeline-a"
+    )
+
+
+def testPipelineMonthOverrideUsesTheNextMonthsBills():
+    assert getRunMonths(datetime.datetime(2025, 3, 1)) == (
+        datetime.datetime(2025, 3, 1),
+        datetime.date(2025, 4, 1),
+    )
+    assert getRunMonths(datetime.datetime(2024, 12, 1))[1] == datetime.date(2025, 1, 1)
+
+
+def testSingleFlightSharesOneCallAmongConcurrentCallers():
+    flight = SingleFlight("test.read")
+    release = threading.Event()
+    numCalls = []
+
+    def read():
+        numCalls.append(1)
+        release.wait(5)
+        return ["rows"]
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(flight.do("rows", read)))
+        for i in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    deadline = time.time() + 5
+    while metrics.COALESCED_CALLS.get(operation="test.read") < 4:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(numCalls) == 1
+    assert results == [["rows"]] * 5
+
+
+def testDebouncerDropsRepeatsWithinWindow():
+    clock = VirtualClock()
+    debouncer = Debouncer(windowSeconds=10, clock=clock.time)
+    assert debouncer.shouldProceed("=== Rents Due ===")
+    assert not debouncer.shouldProceed("=== Rents Due ===")
+    assert debouncer.shouldProceed("something else")
+    clock.sleep(10)
+    assert debouncer.shouldProceed("=== Rents Due ===")